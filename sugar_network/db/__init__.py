@@ -354,8 +354,10 @@ from sugar_network.db.metadata import \
         Enum, List, Aggregated, Blob, Localized, Reference, Author, \
         IndexableText
 from sugar_network.db.index import index_flush_timeout, \
-        index_flush_threshold, index_write_queue
+        index_flush_threshold, index_write_queue, index_query_cache, \
+        index_shards, index_compact_hour
+from sugar_network.db.storage import storage_backend, storage_wal
 from sugar_network.db.resource import Resource
-from sugar_network.db.directory import Directory
+from sugar_network.db.directory import Directory, document_cache_size
 from sugar_network.db.volume import Volume
 from sugar_network.db.routes import Routes
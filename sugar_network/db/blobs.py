@@ -15,22 +15,35 @@
 
 import os
 import shutil
+import struct
+import bisect
 import logging
 import hashlib
 import mimetypes
 from collections import Iterable
 from contextlib import contextmanager
-from os.path import exists, abspath, join, dirname, isdir, basename
+from os.path import exists, abspath, join, dirname, isdir
 
 from PythonMagick import Image
 
 from sugar_network import toolkit, assets
 from sugar_network.toolkit.router import File
-from sugar_network.toolkit import http, ranges, inotify, enforce
+from sugar_network.toolkit import http, ranges, inotify, coroutine, enforce
 
 
 _META_SUFFIX = '.meta'
 
+# Blob meta index record header: digest, seqno, length of serialized meta
+_INDEX_HEADER = struct.Struct('<40sqI')
+
+# Compact the log of blob metas when it contains that many times more
+# records than the number of indexed blobs
+_INDEX_GARBAGE = 2
+
+# Compact the log of reference counters when it contains that many times
+# more lines than the number of counted blobs
+_REFS_GARBAGE = 2
+
 _logger = logging.getLogger('db.blobs')
 
 
@@ -39,6 +52,13 @@ class Blobs(object):
     def __init__(self, root, seqno):
         self._root = abspath(root)
         self._seqno = seqno
+        self._refs = _Refs(join(self._root, 'var', 'blobs.refs'))
+
+        index_path = join(self._root, 'var', 'blobs.index')
+        if not exists(index_path):
+            _import_metas(self._blob_path(), index_path)
+        self._index = _MetaIndex(index_path)
+        self._index.open()
 
     @property
     def root(self):
@@ -59,20 +79,20 @@ class Blobs(object):
 
     def walk(self, path=None, include=None, recursive=True, all_files=False):
         if path is None:
-            is_files = False
-            root = self._blob_path()
-        else:
-            path = path.strip('/').split('/')
-            enforce(not [i for i in path if i == '..'],
-                    http.BadRequest, 'Relative paths are not allowed')
-            is_files = True
-            root = self.path(path)
+            for digest, meta in self._index.find(include):
+                yield File(self._blob_path(digest), digest, meta)
+            return
+
+        path = path.strip('/').split('/')
+        enforce(not [i for i in path if i == '..'],
+                http.BadRequest, 'Relative paths are not allowed')
+        root = self.path(path)
 
         for root, __, files in os.walk(root):
             if include is not None and \
                     not ranges.contains(include, int(os.stat(root).st_mtime)):
                 continue
-            api_path = root[len(self._root) + 7:] if is_files else None
+            api_path = root[len(self._root) + 7:]
             for filename in files:
                 if filename.endswith(_META_SUFFIX):
                     if not all_files:
@@ -122,12 +142,19 @@ class Blobs(object):
 
         with write_blob() as (blob, digest):
             path = self._blob_path(digest)
+            orig_meta = self._index.get(digest)
+            if blob is not None and exists(path) and orig_meta is not None \
+                    and all([orig_meta.get(k) == v for k, v in meta]):
+                # The same content is already stored, keep its seqno
+                _logger.debug('Reuse %r file', path)
+                os.unlink(blob.name)
+                return File(path, digest, orig_meta)
             seqno = self._seqno.next()
             meta.append(('x-seqno', str(seqno)))
             if blob is not None:
                 meta.append(('content-length', str(blob.tell())))
                 blob.name = path
-        _write_meta(path, meta, seqno)
+        self._index.put(digest, meta)
 
         _logger.debug('Post %r file', path)
 
@@ -135,7 +162,18 @@ class Blobs(object):
             path = None
         return File(path, digest, meta)
 
+    def ref(self, digest):
+        """Count one more reference to the blob."""
+        self._refs.add(digest)
+
     def update(self, path, meta):
+        digest = _digest(path)
+        if digest is not None:
+            orig_meta = self._index.get(digest)
+            enforce(orig_meta is not None, http.NotFound, 'No such blob')
+            orig_meta.update(meta)
+            self._index.put(digest, orig_meta)
+            return
         path = self.path(path)
         enforce(exists(path + _META_SUFFIX), http.NotFound, 'No such blob')
         orig_meta = _read_meta(path)
@@ -146,11 +184,16 @@ class Blobs(object):
         path = self.path(digest)
         if not isinstance(digest, basestring):
             digest = os.sep.join(digest)
-        if exists(path + _META_SUFFIX):
+        meta = self._index.get(digest) if _is_digest(digest) else None
+        if meta is not None:
             if thumb:
                 thumb_path = self._thumb_path(digest, thumb)
                 if exists(thumb_path + _META_SUFFIX):
-                    path = thumb_path
+                    return File(thumb_path, digest, _read_meta(thumb_path))
+            if not exists(path):
+                path = None
+            return File(path, digest, meta)
+        elif exists(path + _META_SUFFIX):
             meta = _read_meta(path)
             if not exists(path):
                 path = None
@@ -164,9 +207,57 @@ class Blobs(object):
             return blob
 
     def delete(self, path):
+        """Release a reference to the blob or delete a file.
+
+        Blobs are being deleted only after releasing all references
+        counted by `ref()` calls.
+
+        """
+        if _is_digest(path) and self._refs.add(path, -1) > 0:
+            _logger.debug('Keep %r blob, it is still referenced', path)
+            return
         self._delete(path, self.path(path), None)
 
+    def gc(self, refs):
+        """Remove blobs that are not referenced.
+
+        Should be called only when there are no other writers.
+
+        :param refs:
+            dictionary with digests of all referenced blobs
+            and the number of references
+        :returns:
+            the number of freed bytes
+
+        """
+        self._refs.reset(refs)
+        freed = 0
+        for digest, meta in self._index.find():
+            if digest in refs:
+                continue
+            if meta.get('status', '').startswith('410'):
+                # Keep removal seqno to deliver it while syncing
+                continue
+            self._index.remove(digest)
+            freed += self._wipe(self._blob_path(digest))
+        self._index.compact()
+        for root, __, files in os.walk(join(self._root, 'thumbs')):
+            for filename in files:
+                if filename.endswith(_META_SUFFIX):
+                    continue
+                if filename not in refs:
+                    freed += self._wipe(join(root, filename))
+        _logger.info('Garbage collecting freed %s bytes', freed)
+        return freed
+
+    def close(self):
+        self._refs.close()
+        self._index.close()
+
     def wipe(self, path):
+        digest = _digest(path)
+        if digest is not None:
+            self._index.remove(digest)
         path = self.path(path)
         if exists(path + _META_SUFFIX):
             os.unlink(path + _META_SUFFIX)
@@ -179,7 +270,16 @@ class Blobs(object):
             yield
 
     def diff(self, r, path=None, recursive=True, yield_files=True):
-        is_files = path is not None
+        if path is None:
+            for blob in self.walk(include=r):
+                if yield_files:
+                    if not exists(blob.path):
+                        blob.path = None
+                    yield blob
+                else:
+                    yield
+            return
+
         checkin_seqno = None
 
         for root, rel_root, filename in self.walk(path, r, recursive, True):
@@ -191,7 +291,7 @@ class Blobs(object):
                 if exists(path):
                     stat = os.stat(path)
                     if seqno != int(stat.st_mtime):
-                        _logger.debug('Found updated %r blob', path)
+                        _logger.debug('Found updated %r file', path)
                         seqno = self._seqno.next()
                         meta = _read_meta(path)
                         meta['x-seqno'] = str(seqno)
@@ -201,12 +301,9 @@ class Blobs(object):
                     continue
                 if meta is None:
                     meta = _read_meta(path)
-                if is_files:
-                    digest = join(rel_root, filename[:-len(_META_SUFFIX)])
-                    meta['path'] = digest
-                else:
-                    digest = filename[:-len(_META_SUFFIX)]
-            elif not is_files or exists(path + _META_SUFFIX):
+                digest = join(rel_root, filename[:-len(_META_SUFFIX)])
+                meta['path'] = digest
+            elif exists(path + _META_SUFFIX):
                 continue
             else:
                 _logger.debug('Found new %r blob', path)
@@ -231,9 +328,11 @@ class Blobs(object):
 
     def patch(self, patch, seqno=0):
         if 'path' in patch.meta:
+            digest = None
             path = self.path(patch.meta.pop('path'))
         else:
-            path = self._blob_path(patch.digest)
+            digest = patch.digest
+            path = self._blob_path(digest)
         if not patch.size:
             self._delete(patch.digest, path, seqno)
             return
@@ -241,25 +340,45 @@ class Blobs(object):
             os.makedirs(dirname(path))
         if patch.path:
             os.rename(patch.path, path)
-        if exists(path + _META_SUFFIX):
+        if digest is not None:
+            meta = self._index.get(digest) or {}
+        elif exists(path + _META_SUFFIX):
             meta = _read_meta(path)
-            meta.update(patch.meta)
         else:
-            meta = patch.meta
+            meta = {}
+        meta.update(patch.meta)
         meta['x-seqno'] = str(seqno)
-        _write_meta(path, meta, seqno)
+        if digest is not None:
+            self._index.put(digest, meta)
+        else:
+            _write_meta(path, meta, seqno)
 
     def poll_thumbs(self):
-        root = self._blob_path()
+        # Follow the index on its own since it might be written
+        # by another process
+        index = _MetaIndex(self._index.path)
+        root = dirname(index.path)
         if not exists(root):
             os.makedirs(root)
-        for event, path in inotify.monitor(root):
-            if event != inotify.EVENT_FILE_UPDATED or \
-                    not path.endswith(_META_SUFFIX):
-                continue
-            path = join(root, path[:-len(_META_SUFFIX)])
-            blob = File(path, basename(path), _read_meta(path))
-            self._post_thumb(blob, False)
+        try:
+            with inotify.Inotify() as monitor:
+                # Writers keep the index opened, thus, follow writes
+                # and replacing the file on compacting
+                monitor.add_watch(root,
+                        inotify.IN_MODIFY | inotify.IN_MOVED_TO)
+                while True:
+                    for digest in index.reload():
+                        meta = index.get(digest)
+                        if meta is not None:
+                            blob = File(self._blob_path(digest), digest, meta)
+                            self._post_thumb(blob, False)
+                    coroutine.select([monitor.fileno()], [], [])
+                    for __ in monitor.read():
+                        # Reading new records is cheap, no need to
+                        # filter events of other files
+                        pass
+        finally:
+            index.close()
 
     def populate_thumbs(self, seqno=None, force=False):
         for blob in self.walk(include=[[seqno, None]] if seqno else None):
@@ -287,7 +406,14 @@ class Blobs(object):
     def _delete(self, digest, path, seqno):
         if digest.startswith('assets/'):
             return
-        if exists(path + _META_SUFFIX):
+        meta = self._index.get(digest) if _is_digest(digest) else None
+        if meta is not None:
+            if seqno is None:
+                seqno = self._seqno.next()
+            meta['status'] = '410 Gone'
+            meta['x-seqno'] = str(seqno)
+            self._index.put(digest, meta)
+        elif exists(path + _META_SUFFIX):
             if seqno is None:
                 seqno = self._seqno.next()
             meta = _read_meta(path)
@@ -298,6 +424,15 @@ class Blobs(object):
             _logger.debug('Delete %r file', path)
             os.unlink(path)
 
+    def _wipe(self, path):
+        size = 0
+        for i in (path, path + _META_SUFFIX):
+            if exists(i):
+                size += os.stat(i).st_size
+                os.unlink(i)
+        _logger.debug('Wipe %r orphaned file, %s bytes', path, size)
+        return size
+
     def _blob_path(self, digest=None):
         if not digest:
             return join(self._root, 'blobs')
@@ -307,13 +442,239 @@ class Blobs(object):
         return join(self._root, 'thumbs', str(thumb), digest[:2], digest)
 
 
+class _Refs(object):
+    """Persistent reference counters of blobs.
+
+    Counter changes are being appended to the log that is being replayed
+    on opening, and, compacted if it contains too many obsolete lines.
+    Blobs posted before introducing counters are not counted until
+    the first garbage collecting.
+
+    """
+
+    def __init__(self, path):
+        self._path = path
+        self._counts = {}
+        self._fd = None
+
+        lines = 0
+        if exists(path):
+            with file(path) as f:
+                for line in f:
+                    try:
+                        digest, delta = line.split()
+                        delta = int(delta)
+                    except ValueError:
+                        # Broken on crash
+                        continue
+                    self._update(digest, delta)
+                    lines += 1
+        if lines > len(self._counts) * _REFS_GARBAGE:
+            self.reset(self._counts)
+
+    def add(self, digest, delta=1):
+        self._append('%s %s\n' % (digest, delta))
+        return self._update(digest, delta)
+
+    def reset(self, counts):
+        self.close()
+        self._counts = dict(counts)
+        with toolkit.new_file(self._path) as f:
+            for digest, count in self._counts.items():
+                f.write('%s %s\n' % (digest, count))
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def _update(self, digest, delta):
+        count = self._counts.get(digest, 0) + delta
+        if count > 0:
+            self._counts[digest] = count
+        else:
+            self._counts.pop(digest, None)
+        return count
+
+    def _append(self, line):
+        if self._fd is None:
+            if not exists(dirname(self._path)):
+                os.makedirs(dirname(self._path))
+            self._fd = os.open(self._path,
+                    os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+        os.write(self._fd, line)
+
+
+class _MetaIndex(object):
+    """Metadata of all blobs kept in one binary file.
+
+    The file is a log of records, each one is a fixed size header
+    followed by serialized meta, empty meta stands for removed blobs.
+    The log is being read to memory on opening to serve metas by digest
+    and to scan them in seqno order; records are being appended on
+    changes and the log is compacted if it contains too many obsolete
+    records.
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._metas = {}
+        self._seqnos = []
+        self._offset = 0
+        self._records = 0
+        self._file = None
+        self._fd = None
+
+    def open(self):
+        self.reload()
+        if exists(self.path) and os.stat(self.path).st_size > self._offset:
+            _logger.warning('Truncate broken tail of %r', self.path)
+            with file(self.path, 'r+b') as f:
+                f.truncate(self._offset)
+        if self._records > len(self._metas) * _INDEX_GARBAGE:
+            self.compact()
+
+    def reload(self):
+        """Read records appended since the last reading.
+
+        :returns:
+            list of digests of changed blobs
+
+        """
+        if not exists(self.path):
+            return []
+        # Keep the file opened to detect compacting by inode changes,
+        # inode of the opened file cannot be reused
+        if self._file is None or os.fstat(self._file.fileno()).st_ino != \
+                os.stat(self.path).st_ino:
+            self.close()
+            self._file = file(self.path, 'rb')
+            self._metas.clear()
+            del self._seqnos[:]
+            self._offset = 0
+            self._records = 0
+
+        changed = []
+        f = self._file
+        f.seek(self._offset)
+        while True:
+            header = f.read(_INDEX_HEADER.size)
+            if len(header) < _INDEX_HEADER.size:
+                break
+            digest, seqno, size = _INDEX_HEADER.unpack(header)
+            meta = f.read(size)
+            if len(meta) < size:
+                # Broken on crash or being written at the moment
+                break
+            self._update(digest, seqno, _decode_meta(meta))
+            self._offset += _INDEX_HEADER.size + size
+            changed.append(digest)
+        return changed
+
+    def get(self, digest):
+        if digest in self._metas:
+            return dict(self._metas[digest][1])
+
+    def find(self, r=None):
+        """Iterate blobs in seqno order.
+
+        :param r:
+            seqno ranges to scan, all blobs if `None`
+        :returns:
+            generator object which yields tuples of digest and meta
+
+        """
+        if r is None:
+            found = [i for __, i in self._seqnos]
+        else:
+            found = []
+            for start, end in r:
+                pos = bisect.bisect_left(self._seqnos, (start,))
+                for seqno, digest in self._seqnos[pos:]:
+                    if end is not None and seqno > end:
+                        break
+                    found.append(digest)
+        for digest in found:
+            meta = self.get(digest)
+            if meta is not None:
+                yield digest, meta
+
+    def put(self, digest, meta):
+        seqno = int(dict(meta).get('x-seqno') or 0)
+        self._append(digest, seqno, meta)
+
+    def remove(self, digest):
+        if digest in self._metas:
+            self._append(digest, 0, {})
+
+    def compact(self):
+        with toolkit.new_file(self.path) as f:
+            for seqno, digest in self._seqnos:
+                meta = _encode_meta(self._metas[digest][1])
+                f.write(_INDEX_HEADER.pack(digest, seqno, len(meta)))
+                f.write(meta)
+            offset = f.tell()
+        # The append descriptor still refers to the replaced file
+        self.close()
+        self._file = file(self.path, 'rb')
+        self._offset = offset
+        self._records = len(self._metas)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def _append(self, digest, seqno, meta):
+        meta = _encode_meta(meta)
+        if self._fd is None:
+            if not exists(dirname(self.path)):
+                os.makedirs(dirname(self.path))
+            self._fd = os.open(self.path,
+                    os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+        os.write(self._fd, _INDEX_HEADER.pack(digest, seqno, len(meta)) + meta)
+        if self._file is None:
+            self._file = file(self.path, 'rb')
+        self._offset += _INDEX_HEADER.size + len(meta)
+        self._update(digest, seqno, _decode_meta(meta))
+
+    def _update(self, digest, seqno, meta):
+        self._records += 1
+        if digest in self._metas:
+            orig_seqno = self._metas.pop(digest)[0]
+            pos = bisect.bisect_left(self._seqnos, (orig_seqno, digest))
+            del self._seqnos[pos]
+        if meta:
+            self._metas[digest] = (seqno, meta)
+            bisect.insort(self._seqnos, (seqno, digest))
+
+
+def _import_metas(root, index_path):
+    """Build blob meta index from `.meta` files of previous layout."""
+    if not exists(root):
+        return
+    _logger.info('Import blob metas from %r', root)
+    index = _MetaIndex(index_path)
+    for path, __, files in os.walk(root):
+        for filename in files:
+            digest = filename[:-len(_META_SUFFIX)]
+            if filename.endswith(_META_SUFFIX) and _is_digest(digest):
+                meta = _read_meta(join(path, digest))
+                seqno = int(meta.get('x-seqno') or 0)
+                index._update(digest, seqno, meta)
+    index.compact()
+
+
 def _write_meta(path, meta, seqno=None):
     meta_path = path + _META_SUFFIX
+    if seqno is None and 'x-seqno' in dict(meta):
+        seqno = int(dict(meta)['x-seqno'])
     with toolkit.new_file(meta_path) as f:
-        for key, value in meta.items() if isinstance(meta, dict) else meta:
-            if seqno is None and key == 'x-seqno':
-                seqno = int(value)
-            f.write(toolkit.ascii(key) + ': ' + toolkit.ascii(value) + '\n')
+        f.write(_encode_meta(meta))
     if exists(path):
         shutil.copystat(meta_path, path)
     if seqno:
@@ -322,15 +683,39 @@ def _write_meta(path, meta, seqno=None):
         os.utime(meta_path, (seqno, seqno))
 
 
-def _read_meta(path):
+def _is_digest(path):
+    return isinstance(path, basestring) and len(path) == 40 and \
+            '.' not in path and os.sep not in path
+
+
+def _digest(path):
+    if isinstance(path, File):
+        return path.digest
+    if not isinstance(path, basestring):
+        path = os.sep.join(path)
+    if _is_digest(path):
+        return path
+
+
+def _encode_meta(meta):
+    return ''.join([toolkit.ascii(key) + ': ' + toolkit.ascii(value) + '\n'
+            for key, value in (meta.items() if isinstance(meta, dict)
+                    else meta)])
+
+
+def _decode_meta(data):
     meta = {}
-    with file(path + _META_SUFFIX) as f:
-        for line in f:
-            key, value = line.split(':', 1)
-            meta[key] = value.strip()
+    for line in data.splitlines():
+        key, value = line.split(':', 1)
+        meta[key] = value.strip()
     return meta
 
 
+def _read_meta(path):
+    with file(path + _META_SUFFIX) as f:
+        return _decode_meta(f.read())
+
+
 def _lsdir(root, rel_root):
     for filename in os.listdir(root):
         path = join(root, filename)
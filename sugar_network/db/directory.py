@@ -13,23 +13,39 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import os
+import time
+import heapq
 import shutil
 import logging
-from os.path import exists, join
+from contextlib import contextmanager
+from collections import OrderedDict
+from os.path import exists, join, dirname, basename
 
 from sugar_network import toolkit
-from sugar_network.db.storage import Storage
-from sugar_network.db.metadata import Metadata, Guid
+from sugar_network.db.storage import open_storage, decode_meta
+from sugar_network.db.index import index_shards, shard_paths
+from sugar_network.db.metadata import Metadata, Guid, Aggregated
 from sugar_network.toolkit.router import ACL
-from sugar_network.toolkit import enforce
+from sugar_network.toolkit import Option, coroutine, jsonlib, enforce
 
 
+document_cache_size = Option(
+        'maximal number of bytes to keep encoded property metas '
+        'in per resource memory cache; 0 to disable caching',
+        default=4 * 1024 * 1024, type_cast=int)
+
 # To invalidate existed index on stcuture changes
-_LAYOUT_VERSION = 4
+_LAYOUT_VERSION = 6
 
 _STATE_HAS_SEQNO = 1
 _STATE_HAS_NOSEQNO = 2
 
+# Number of documents to fetch from the index at once in `diff()`
+_DIFF_CHUNK = 1024
+
+_READ_BUFFER = 65536
+
 
 _logger = logging.getLogger('db.directory')
 
@@ -56,9 +72,17 @@ class Directory(object):
         self._seqno = seqno
         self._storage = None
         self._index = None
+        self._journal = None
+        self._unsent = set()
+        self._seqnos = None
+        self._bulk = 0
         self._broadcast = broadcast
+        self.cache = toolkit.SizedCache(document_cache_size.value)
         self._state = toolkit.Bin(
                 join(root, 'index', self.metadata.name, 'state'), 0)
+        # Start from the current time to not repeat revisions
+        # of the previous sessions
+        self._revision = int(time.time() * 1000)
 
         self._open()
 
@@ -70,6 +94,11 @@ class Directory(object):
     def has_seqno(self):
         return self._state.value & _STATE_HAS_SEQNO
 
+    @property
+    def revision(self):
+        """Number that is being changed after any change of documents."""
+        return self._revision
+
     @property
     def has_noseqno(self):
         return self._state.value & _STATE_HAS_NOSEQNO
@@ -86,12 +115,15 @@ class Directory(object):
         shutil.rmtree(join(self._root, 'db', self.metadata.name),
                 ignore_errors=True)
         self._state.value = 0
+        self.cache.clear()
         self._open()
 
     def dilute(self):
         for doc in self:
             if 'seqno' in doc.record.get('guid'):
-                self._index.delete(doc.guid, self._postdelete, doc.guid, None)
+                with self._journaling(doc.guid):
+                    self._index.delete(doc.guid, self._postdelete,
+                            doc.guid, None)
                 continue
             doc.record.unset('seqno')
             for prop in self.metadata.keys():
@@ -100,20 +132,47 @@ class Directory(object):
                     continue
                 meta.pop('seqno')
                 doc.record.set(prop, **meta)
+        self._seqnos.clear(self._seqno.value + 1)
         self._state.value ^= _STATE_HAS_SEQNO
+        self._revision += 1
 
     def close(self):
         """Flush index write pending queue and close the index."""
         if self._index is None:
             return
         self._index.close()
+        self._storage.close()
+        self._journal.close()
+        self._seqnos.close()
         self._storage = None
         self._index = None
+        self._journal = None
+        self._seqnos = None
 
     def commit(self):
         """Flush pending chnages to disk."""
         self._index.commit()
 
+    @contextmanager
+    def bulk(self):
+        """Context manager to process multiple changes in one batch.
+
+        If the batch fails, index changes are being cancelled, and,
+        journaled documents are being reindexed from the storage,
+        which might already contain part of the changes.
+
+        """
+        self._bulk += 1
+        try:
+            with self._index.bulk():
+                yield
+        except:
+            if self._bulk == 1:
+                self._resync()
+            raise
+        finally:
+            self._bulk -= 1
+
     def create(self, props):
         """Create new document.
 
@@ -130,7 +189,9 @@ class Directory(object):
             guid = props['guid'] = toolkit.uuid()
         _logger.debug('Create %s[%s]: %r', self.metadata.name, guid, props)
         event = {'event': 'create', 'guid': guid}
-        self._index.store(guid, props, self._prestore, self.broadcast, event)
+        with self._journaling(guid):
+            self._index.store(guid, props, self._prestore,
+                    self.broadcast, event)
         return guid
 
     def update(self, guid, props, event='update'):
@@ -146,7 +207,9 @@ class Directory(object):
         event = {'event': event, 'guid': guid}
         if event['event'] == 'update':
             event['props'] = props.copy()
-        self._index.store(guid, props, self._prestore, self.broadcast, event)
+        with self._journaling(guid):
+            self._index.store(guid, props, self._prestore,
+                    self.broadcast, event)
 
     def delete(self, guid):
         """Delete document.
@@ -157,35 +220,41 @@ class Directory(object):
         """
         _logger.debug('Delete %s[%s]', self.metadata.name, guid)
         event = {'event': 'delete', 'guid': guid}
-        self._index.delete(guid, self._postdelete, guid, event)
+        with self._journaling(guid):
+            self._index.delete(guid, self._postdelete, guid, event)
 
     def get(self, guid):
         if not guid:
             return self.resource(None, None)
         cached_props = self._index.get_cached(guid)
-        record = self._storage.get(guid)
-        return self.resource(guid, record, cached_props)
+        return self.resource(guid, self._record(guid), cached_props)
 
     def __getitem__(self, guid):
         return self.get(guid)
 
     def find(self, **kwargs):
         mset = self._index.find(**kwargs)
+        documents = _Documents(self, mset)
+        if kwargs.get('total') == 'none':
+            return documents, None
+        return documents, mset.get_matches_estimated()
+
+    def cursor(self, guid, order_by=None, document=None):
+        """Continuation token to resume `find()` after the document.
 
-        def iterate():
-            for hit in mset:
-                guid = hit.document.get_value(0)
-                record = self._storage.get(guid)
-                yield self.resource(guid, record)
+        Pass `last` attribute of `find()` results as `document` to take
+        sorting values from the found document instead of reading it.
 
-        return iterate(), mset.get_matches_estimated()
+        """
+        return self._index.cursor(guid, order_by, document)
 
     def populate(self):
         """Populate the index.
 
         This function needs be called right after `init()` to pickup possible
         pending changes made during the previous session when index was not
-        propertly closed.
+        propertly closed. Only documents mentioned in the changes journal
+        will be processed if the journal is available.
 
         :returns:
             function is a generator that will be iterated after picking up
@@ -194,45 +263,174 @@ class Directory(object):
         """
         found = False
         migrate = self.empty
+        replay = self._journal.replayable and not migrate
 
-        for guid in self._storage.walk(self._state.mtime):
-            if not found:
-                _logger.info('Start populating %r index', self.metadata.name)
-                found = True
-
-            if migrate:
-                self._storage.migrate(guid)
-
-            record = self._storage.get(guid)
-            try:
-                props = {}
-                for name in self.metadata:
-                    meta = record.get(name)
-                    if meta is not None:
-                        props[name] = meta['value']
-                self._index.store(guid, props, self._preindex)
+        if replay:
+            guids = self._journal.tail()
+        else:
+            guids = self._storage.walk(self._state.mtime)
+
+        with self.bulk():
+            for guid in guids:
+                if not found:
+                    _logger.info('Start populating %r index',
+                            self.metadata.name)
+                    found = True
+
+                if migrate:
+                    self._storage.migrate(guid)
+
+                if replay and not self._storage.get(guid).exists:
+                    self._index.delete(guid)
+                else:
+                    self._reindex(self._index, guid)
                 yield
-            except Exception:
-                _logger.exception('Cannot populate %r in %r, invalidate it',
-                        guid, self.metadata.name)
-                record.invalidate()
 
+        # Replayed changes are in the index now
+        self._checkpoint()
+        self._journal.enable()
         if found:
             self._save_layout()
             self.commit()
 
+    def rebuild(self, jobs=1):
+        """Rebuild the index from scratch using several processes.
+
+        Documents are partitioned by GUID shards between `jobs` processes,
+        each of them builds its own partial index. Partial indexes are
+        merged using `xapian-compact` and the result replaces the current
+        index. Should be called only when there are no other writers.
+
+        :param jobs:
+            number of processes to spawn
+
+        """
+        name = self.metadata.name
+        index_path = join(self._root, 'index', name)
+        build_root = index_path + '.rebuild'
+        shutil.rmtree(build_root, ignore_errors=True)
+
+        shards = {}
+        for guid in self._storage.walk(0):
+            shards.setdefault(guid[:2], []).append(guid)
+        parts = [[] for __ in xrange(max(1, jobs))]
+        for guids in sorted(shards.values(), key=len, reverse=True):
+            min(parts, key=len).extend(guids)
+        parts = [i for i in parts if i]
+        if not parts:
+            _logger.info('Nothing to rebuild in %r', name)
+            return
+
+        _logger.info('Rebuild %r index from %s documents using %s processes',
+                name, sum([len(i) for i in parts]), len(parts))
+        ts = time.time()
+
+        results = []
+        for num, guids in enumerate(parts):
+            path = join(build_root, str(num))
+            child = coroutine.fork()
+            if child is None:
+                # pylint: disable-msg=W0212
+                os._exit(self._rebuild_part(path, guids))
+            # Watch right after forking, not after waiting for previous
+            # children, to not miss exit statuses of already reaped ones
+            result = coroutine.AsyncResult()
+            child.watch(result.set)
+            results.append(result)
+        failed = [i for i in results if i.get() != 0]
+        enforce(not failed, 'Failed to rebuild %r index', name)
+
+        state = 0
+        part_paths = []
+        for num in xrange(len(parts)):
+            path = join(build_root, str(num))
+            with file(join(path, 'rebuild')) as f:
+                state |= jsonlib.load(f)
+            os.unlink(join(path, 'rebuild'))
+            part_paths.append(path)
+        new_path = join(build_root, 'index')
+        if len(part_paths) == 1:
+            os.rename(part_paths[0], new_path)
+        else:
+            os.makedirs(new_path)
+            for path in shard_paths(new_path):
+                shard = basename(path)
+                toolkit.assert_call(['xapian-compact'] +
+                        [join(i, shard) for i in part_paths] + [path])
+
+        self._index.close()
+        self._journal.close()
+        if exists(index_path):
+            os.rename(index_path, join(build_root, 'old'))
+        os.rename(new_path, index_path)
+        self._state.value = state
+        self._state.commit()
+        self._save_layout()
+        self._index = self._index_class(index_path, self.metadata,
+                self._postcommit)
+        # Rebuilt index contains all documents
+        self._journal = _Journal(join(index_path, 'journal'))
+        self._journal.enable()
+        shutil.rmtree(build_root, ignore_errors=True)
+
+        _logger.info('Rebuilding %r index took %s seconds',
+                name, time.time() - ts)
+
+    def compact(self):
+        """Compact the index to reclaim space left by changes."""
+        _logger.info('Compact %r index', self.metadata.name)
+        self._seqnos.compact(self._is_seqno_actual)
+        return self._index.compact()
+
     def diff(self, r):
+        """Iterate documents changed within specified seqno ranges.
+
+        Changed properties are being looked up in the seqno index if it
+        covers the range. Otherwise, documents are being fetched from the
+        index ordered by seqno in chunks, and, the next chunk starts right
+        after the last document of the previous one, so, memory usage does
+        not depend on the number of changed documents.
+
+        :param r:
+            list of seqno ranges
+        :returns:
+            generator of (`document`, `props`) tuples, where `props` is
+            a list of properties changed within ranges, or `None` if all
+            properties should be checked
+
+        """
         for start, end in r:
+            if start >= self._seqnos.since:
+                for guid, props in self._seqnos.find(start, end):
+                    doc = self.resource(guid, self._record(guid))
+                    if doc.exists:
+                        yield doc, props
+                continue
             query = 'seqno:%s..' % start
             if end:
                 query += str(end)
-            docs, __ = self.find(query=query, order_by='seqno')
-            for doc in docs:
-                yield doc
+            after = None
+            while True:
+                mset = self._index.find(query=query, order_by='seqno',
+                        limit=_DIFF_CHUNK, after=after, total='none')
+                # Read the chunk at once, the index might be changed
+                # while processing yielded documents
+                guids = []
+                for hit in mset:
+                    guids.append(hit.document.get_value(0))
+                    last = hit.document
+                if len(guids) == _DIFF_CHUNK:
+                    after = self._index.cursor(guids[-1], 'seqno', last)
+                else:
+                    after = None
+                for guid in guids:
+                    yield self.resource(guid, self._record(guid)), None
+                if after is None:
+                    break
 
     def patch(self, guid, patch, seqno=False):
         """Apply changes for documents."""
-        doc = self.resource(guid, self._storage.get(guid))
+        doc = self.resource(guid, self._record(guid))
         merge = []
 
         for prop, meta in patch.items():
@@ -242,25 +440,33 @@ class Directory(object):
             doc.posts[prop] = meta['value']
             merge.append((prop, meta))
 
-        for prop, meta in merge:
-            if doc.post_seqno is None and seqno is not False:
-                if not seqno:
-                    seqno = self._seqno.next()
-                doc.post_seqno = seqno
-            doc.post(prop, **meta)
-
-        if merge and doc.exists:
-            # No need in after-merge event, further commit event
-            # is enough to avoid increasing events flow
-            self._index.store(guid, doc.posts, self._preindex)
+        if not merge:
+            return seqno
+
+        with self._journaling(guid):
+            for prop, meta in merge:
+                if doc.post_seqno is None and seqno is not False:
+                    if not seqno:
+                        seqno = self._seqno.next()
+                    doc.post_seqno = seqno
+                doc.post(prop, **meta)
+            self._append_seqnos(doc)
+            self._storage.sync()
+            self._revision += 1
+            if doc.exists:
+                # No need in after-merge event, further commit event
+                # is enough to avoid increasing events flow
+                self._index.store(guid, doc.posts, self._preindex)
 
         return seqno
 
     def broadcast(self, event):
+        self._revision += 1
         event['resource'] = self.metadata.name
         self._broadcast(event)
 
     def _open(self):
+        self._revision += 1
         index_path = join(self._root, 'index', self.metadata.name)
         if self._is_layout_stale():
             if exists(index_path):
@@ -270,11 +476,16 @@ class Directory(object):
             self._save_layout()
         self._index = self._index_class(index_path, self.metadata,
                 self._postcommit)
-        self._storage = Storage(join(self._root, 'db', self.metadata.name))
+        self._storage = open_storage(
+                join(self._root, 'db', self.metadata.name))
+        self._journal = _Journal(join(index_path, 'journal'))
+        self._seqnos = _SeqnoIndex(
+                join(self._root, 'db', self.metadata.name, 'seqnos'),
+                self._seqno.value + 1)
         _logger.debug('Open %r resource', self.resource)
 
     def _preindex(self, guid, changes):
-        doc = self.resource(guid, self._storage.get(guid), changes)
+        doc = self.resource(guid, self._record(guid), changes)
         for prop in self.metadata:
             enforce(doc[prop] is not None, 'Empty %r property', prop)
         if changes.get('seqno'):
@@ -284,13 +495,16 @@ class Directory(object):
         return doc
 
     def _prestore(self, guid, changes, event):
-        doc = self.resource(guid, self._storage.get(guid), posts=changes)
+        doc = self.resource(guid, self._record(guid), posts=changes)
         # It is important to iterate the `changes` by keys,
         # values might be changed during iteration
         for prop in changes.keys():
             if not doc.post_seqno and not doc.metadata[prop].acl & ACL.LOCAL:
                 doc.post_seqno = self._seqno.next()
             doc.post(prop, changes[prop])
+        self._append_seqnos(doc)
+        # Flush all changes at once if storage supports it
+        self._storage.sync()
         if not doc.exists:
             return None
         for prop in self.metadata.keys():
@@ -301,25 +515,486 @@ class Directory(object):
             self._state.value |= _STATE_HAS_NOSEQNO
         return doc
 
+    def _append_seqnos(self, doc):
+        if not doc.post_seqno:
+            return
+        props = [i for i in doc.posts
+                if i != 'seqno' and not self.metadata[i].acl & ACL.LOCAL]
+        self._seqnos.append(doc.post_seqno, doc.guid, props)
+
+    def _is_seqno_actual(self, seqno, guid, prop):
+        meta = self._storage.get(guid).get(prop)
+        if meta is None or prop not in self.metadata:
+            return False
+        if meta.get('seqno') == seqno:
+            return True
+        if isinstance(self.metadata[prop], Aggregated):
+            for agg in meta['value'].values():
+                if agg.get('seqno') == seqno:
+                    return True
+        return False
+
+    def _reindex(self, index, guid):
+        record = self._record(guid)
+        try:
+            props = {}
+            for name in self.metadata:
+                meta = record.get(name)
+                if meta is not None:
+                    props[name] = meta['value']
+            index.store(guid, props, self._preindex)
+        except Exception:
+            _logger.exception('Cannot populate %r in %r, invalidate it',
+                    guid, self.metadata.name)
+            record.invalidate()
+
+    def _resync(self):
+        try:
+            # Journal contains only not yet committed changes
+            for guid in self._journal.tail():
+                if self._storage.get(guid).exists:
+                    self._reindex(self._index, guid)
+                else:
+                    self._index.delete(guid)
+            self._checkpoint()
+        except Exception:
+            _logger.exception('Cannot resync %r index after failed batch',
+                    self.metadata.name)
+
+    def _rebuild_part(self, path, guids):
+        # Executed in child process
+        try:
+            # Do not share storage file offsets with the parent and siblings
+            self._storage.reopen()
+            self._state.value = 0
+            index = self._index_class(path, self.metadata)
+            with index.bulk():
+                for guid in guids:
+                    self._reindex(index, guid)
+            index.close()
+            with toolkit.new_file(join(path, 'rebuild')) as f:
+                jsonlib.dump(self._state.value, f)
+        except Exception:
+            _logger.exception('Cannot rebuild %r', path)
+            return 1
+        return 0
+
+    def _record(self, guid):
+        record = self._storage.get(guid)
+        if self.cache.limit > 0:
+            record = _CachedRecord(record, self.cache)
+        return record
+
     def _postdelete(self, guid, event):
         self._storage.delete(guid)
+        for prop in self.metadata.keys():
+            self.cache.pop((guid, prop))
         if event:
             self.broadcast(event)
+        else:
+            self._revision += 1
+
+    @contextmanager
+    def _journaling(self, guid):
+        # Journal changes before writing them to the storage
+        offset = self._journal.append(guid)
+        self._unsent.add(offset)
+        try:
+            yield
+        finally:
+            self._unsent.remove(offset)
+            self._checkpoint()
+
+    def _checkpoint(self):
+        # Changes might be sent to the index not in order of journaling,
+        # do not let to truncate changes that are not sent yet
+        if self._unsent:
+            self._index.checkpoint(min(self._unsent))
+        else:
+            self._index.checkpoint(self._journal.tell())
 
     def _postcommit(self):
+        # Seqno index should not be behind the seqno state on crash
+        self._seqnos.commit()
         self._seqno.commit()
         self._state.commit()
+        if self._index.committed is not None:
+            # Journaled changes sent before the checkpoint are in the index
+            self._journal.truncate(self._index.committed)
         self.broadcast({'event': 'commit', 'mtime': self._state.mtime})
 
     def _save_layout(self):
         path = join(self._root, 'index', self.metadata.name, 'layout')
         with toolkit.new_file(path) as f:
-            f.write(str(_LAYOUT_VERSION))
+            f.write(_layout())
 
     def _is_layout_stale(self):
         path = join(self._root, 'index', self.metadata.name, 'layout')
         if not exists(path):
             return True
         with file(path) as f:
-            version = f.read()
-        return not version.isdigit() or int(version) != _LAYOUT_VERSION
+            return f.read() != _layout()
+
+
+class _Documents(object):
+    """Iterator over `find()` results."""
+
+    def __init__(self, directory, mset):
+        #: Xapian document of the last returned resource
+        self.last = None
+        self._directory = directory
+        self._hits = iter(mset)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        self.last = next(self._hits).document
+        guid = self.last.get_value(0)
+        # Values of `stored_in_index` properties
+        data = self.last.get_data()
+        origs = jsonlib.loads(data) if data else None
+        # pylint: disable-msg=W0212
+        record = self._directory._record(guid)
+        return self._directory.resource(guid, record, origs)
+
+
+class _Journal(object):
+    """Append-only list of GUIDs changed since the last index commit.
+
+    Journal is not replayable until the first full populating, e.g.,
+    for indexes created before introducing journals. Till that moment
+    changes are being written to a temporary file.
+
+    Offsets are counted from the journal opening and are not being
+    shifted by truncating, thus, they might be kept while waiting for
+    the index to commit changes.
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.replayable = exists(path)
+        if self.replayable:
+            flags = os.O_WRONLY | os.O_APPEND
+        else:
+            path += '.new'
+            flags = os.O_WRONLY | os.O_APPEND | os.O_CREAT | os.O_TRUNC
+        if not exists(dirname(path)):
+            os.makedirs(dirname(path))
+        self._fd = os.open(path, flags, 0644)
+        self._base = 0
+        self._size = os.fstat(self._fd).st_size
+
+    def append(self, guid):
+        """Append GUID and return the offset of its entry."""
+        offset = self._size
+        line = toolkit.ascii(guid) + '\n'
+        os.write(self._fd, line)
+        self._size += len(line)
+        return offset
+
+    def tell(self):
+        return self._size
+
+    def tail(self):
+        """Unique GUIDs in order of appending."""
+        result = []
+        seen = set()
+        with file(self._path()) as f:
+            for line in f:
+                if not line.endswith('\n'):
+                    # Broken on crash
+                    break
+                guid = line[:-1]
+                if guid and guid not in seen:
+                    seen.add(guid)
+                    result.append(guid)
+        return result
+
+    def enable(self):
+        if self.replayable:
+            return
+        os.rename(self.path + '.new', self.path)
+        self.replayable = True
+
+    def truncate(self, offset):
+        """Remove entries appended before `offset`."""
+        if offset <= self._base:
+            return
+        path = self._path()
+        with file(path) as f:
+            f.seek(offset - self._base)
+            rest = f.read()
+        with toolkit.new_file(path) as f:
+            f.write(rest)
+        os.close(self._fd)
+        self._fd = os.open(path, os.O_WRONLY | os.O_APPEND)
+        self._base = offset
+
+    def close(self):
+        os.close(self._fd)
+
+    def _path(self):
+        return self.path if self.replayable else self.path + '.new'
+
+
+class _SeqnoIndex(object):
+    """Properties changed at particular seqno values.
+
+    Lines contain seqno, GUID and property name and are only being
+    appended to the file. Seqnos are being appended mostly in ascending
+    order, so, the head of the file is kept sorted to find ranges by
+    binary search, and, the tail starting from the first out of order
+    line is being scanned entirely. One seqno might be used for a long
+    time, e.g., while applying sync pulls, thus, on commits, the tail is
+    being merged into the head when it becomes too large.
+
+    The state file keeps the seqno the index is complete starting from,
+    the size of the sorted head and whether appended lines were synced
+    to the disk. If the index was not synced before the crash, it is
+    being started from scratch to let `Directory.diff()` fall back to
+    the index search.
+
+    """
+
+    def __init__(self, path, since):
+        self._path = path
+        if not exists(dirname(path)):
+            os.makedirs(dirname(path))
+        self._fd = self._open()
+        self._size = os.fstat(self._fd).st_size
+        self._state = toolkit.Bin(path + '.state', {})
+        self._sorted = self._state['sorted']
+        self._last = 0
+        if not self._state['synced'] or self._sorted > self._size:
+            _logger.info('Seqno index %r was not synced, start it over',
+                    path)
+            self.clear(since)
+        elif self._sorted == self._size:
+            self._last = self._last_seqno()
+        else:
+            self._last = None
+
+    @property
+    def since(self):
+        return self._state['since']
+
+    def append(self, seqno, guid, props):
+        data = ''.join([jsonlib.dumps([seqno, guid, i]) + '\n'
+                for i in props])
+        if not data:
+            return
+        if self._state['synced']:
+            # Lines appended after this point might be lost on crash
+            self._commit_state(synced=False)
+        self._write(data)
+        if self._last is not None and seqno >= self._last:
+            self._last = seqno
+            self._sorted = self._size
+        else:
+            self._last = None
+
+    def commit(self):
+        """Sync appended lines to the disk."""
+        if self._state['synced']:
+            return
+        os.fsync(self._fd)
+        if self._size - self._sorted > max(_READ_BUFFER, self._size // 8):
+            _logger.debug('Merge %r', self._path)
+            self._rewrite(lambda *args: True)
+        self._commit_state(synced=True)
+
+    def find(self, start, end):
+        """Iterate (guid, props) tuples changed within the range.
+
+        Documents are ordered by the last seqno they were changed at,
+        every document is being yielded only once.
+
+        """
+        docs = OrderedDict()
+        for (__, guid, prop), __ in self._changes(start, end):
+            props = docs.pop(guid, [])
+            docs[guid] = props
+            if prop not in props:
+                props.append(prop)
+        return docs.iteritems()
+
+    def compact(self, actual_cb):
+        """Remove lines that are not actual anymore."""
+        _logger.debug('Compact %r', self._path)
+        self._rewrite(actual_cb)
+        self._commit_state(synced=True)
+
+    def clear(self, since):
+        """Start the index from scratch."""
+        self._commit_state(synced=False)
+        os.ftruncate(self._fd, 0)
+        self._size = self._sorted = self._last = 0
+        self._commit_state(since=since, synced=True)
+
+    def close(self):
+        self.commit()
+        os.close(self._fd)
+
+    def _open(self):
+        return os.open(self._path, os.O_RDWR | os.O_CREAT | os.O_APPEND,
+                0644)
+
+    def _write(self, data):
+        self._size += len(data)
+        while data:
+            data = data[os.write(self._fd, data):]
+
+    def _rewrite(self, actual_cb):
+        last = 0
+        with toolkit.new_file(self._path) as f:
+            for change, line in self._changes():
+                if actual_cb(*change):
+                    f.write(line)
+                    last = change[0]
+            f.flush()
+            os.fsync(f.fileno())
+        os.close(self._fd)
+        self._fd = self._open()
+        self._size = self._sorted = os.fstat(self._fd).st_size
+        self._last = last
+
+    def _changes(self, start=0, end=None):
+        # Only the unsorted tail is being read at once, the sorted head
+        # is being merged with it while reading
+        with file(self._path) as f:
+            f.seek(self._sorted)
+            tail = []
+            for line in f:
+                change = self._decode(line)
+                if change is not None and change[0] >= start and \
+                        not (end and change[0] > end):
+                    # Keep the order of the same seqno changes
+                    tail.append((change[0], 1, len(tail), change, line))
+            tail.sort()
+            for item in heapq.merge(self._head(f, start, end), tail):
+                yield item[-2:]
+
+    def _head(self, f, start, end):
+        offset = self._bisect(f, start)
+        f.seek(offset)
+        n = 0
+        while offset < self._sorted:
+            line = f.readline()
+            offset += len(line)
+            change = self._decode(line)
+            if change is None:
+                continue
+            if end and change[0] > end:
+                break
+            yield change[0], 0, n, change, line
+            n += 1
+
+    def _commit_state(self, **kwargs):
+        self._state.value.update(kwargs)
+        self._state['sorted'] = self._sorted
+        self._state.commit()
+
+    def _bisect(self, f, seqno):
+        # Offset of the first sorted line with seqno not less than `seqno`
+        lo = 0
+        hi = self._sorted
+        while lo < hi:
+            mid = (lo + hi) // 2
+            # Move to the beginning of the next line
+            f.seek(max(0, mid - 1))
+            if mid:
+                f.readline()
+            if f.tell() >= self._sorted:
+                hi = mid
+                continue
+            if self._seqno(f.readline()) >= seqno:
+                hi = mid
+            else:
+                lo = f.tell()
+        return lo
+
+    def _last_seqno(self):
+        with file(self._path) as f:
+            f.seek(max(0, self._size - _READ_BUFFER))
+            lines = f.read().splitlines()
+        for line in reversed(lines):
+            seqno = self._seqno(line)
+            if seqno is not None:
+                return seqno
+        return 0
+
+    def _seqno(self, line):
+        change = self._decode(line)
+        if change is not None:
+            return change[0]
+
+    def _decode(self, line):
+        try:
+            seqno, guid, prop = jsonlib.loads(line)
+        except ValueError:
+            # Broken on crash
+            return None
+        return seqno, guid, prop
+
+
+class _CachedRecord(object):
+    """Read-through and write-invalidate wrapper for storage records."""
+
+    def __init__(self, record, cache):
+        self._record = record
+        self._cache = cache
+
+    @property
+    def guid(self):
+        return self._record.guid
+
+    @property
+    def exists(self):
+        return self._record.exists
+
+    @property
+    def consistent(self):
+        return self.get('guid') is not None
+
+    def invalidate(self):
+        self._cache.pop((self._record.guid, 'guid'))
+        self._record.invalidate()
+
+    def get(self, prop):
+        key = (self._record.guid, prop)
+        # Files might be changed behind the cache
+        version = self._record.stat(prop)
+        cached = self._cache.get(key)
+        if cached is not None and cached[0] == version:
+            raw = cached[1]
+        else:
+            raw = self._record.read(prop)
+            size = len(key[0]) + len(key[1])
+            if raw is not None:
+                size += len(raw[0])
+            self._cache.put(key, (version, raw), size)
+        # Keep encoded metas, callers might change returned values
+        return decode_meta(raw)
+
+    def set(self, prop, *args, **kwargs):
+        self._cache.pop((self._record.guid, prop))
+        self._record.set(prop, *args, **kwargs)
+
+    def unset(self, prop):
+        self._cache.pop((self._record.guid, prop))
+        self._record.unset(prop)
+
+    def __getattr__(self, name):
+        # `_record` is not set yet while unpickling or copying
+        if name == '_record':
+            raise AttributeError(name)
+        return getattr(self._record, name)
+
+
+def _layout():
+    # Changing the number of shards requires reindexing
+    if index_shards.value > 1:
+        return '%s.%s' % (_LAYOUT_VERSION, index_shards.value)
+    return str(_LAYOUT_VERSION)
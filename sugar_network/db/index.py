@@ -13,17 +13,27 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import os
 import re
 import time
-import bisect
+import zlib
+import errno
+import fcntl
 import shutil
+import base64
+import struct
 import logging
+import cPickle as pickle
+from contextlib import contextmanager
+from collections import deque
+from os.path import exists, join
 
 import xapian
 
 from sugar_network import toolkit
 from sugar_network.db.metadata import IndexableText, GUID_PREFIX
-from sugar_network.toolkit import Option, coroutine, enforce
+from sugar_network.toolkit import Option, coroutine, pylru, http, jsonlib
+from sugar_network.toolkit import enforce
 
 
 index_flush_timeout = Option(
@@ -40,15 +50,41 @@ index_write_queue = Option(
             'the writer\'s queue size',
         default=256, type_cast=int)
 
+index_query_cache = Option(
+        'number of parsed search queries to keep in memory for each index, '
+            '0 disables caching',
+        default=256, type_cast=int)
+
+index_shards = Option(
+        'number of Xapian databases to split every index into by GUID hash; '
+            'changing the value causes reindexing',
+        default=1, type_cast=int)
+
+index_compact_hour = Option(
+        'hour of the day, in local time, to compact indexes in background; '
+            '-1 disables compaction',
+        default=-1, type_cast=int)
+
 # Additional Xapian term prefix for exact search terms
 _EXACT_PREFIX = 'X'
 
 # The regexp to extract exact search terms from a query string
 _EXACT_QUERY_RE = re.compile('([a-zA-Z0-9_]+):=(")?((?(2)[^"]+|\\S+))(?(2)")')
 
+# Supported ways to count `find()` results
+_TOTALS = ('exact', 'estimate', 'none')
+
 # How many times to call Xapian database reopen() before fail
 _REOPEN_LIMIT = 10
 
+# Header of messages between `ProxyIndex` and its writer process
+_HEADER = struct.Struct('!I')
+
+_READ_BUFFER = 65536
+
+# `ProxyIndex` is waiting for the writer to finish compaction
+_PENDING = object()
+
 _logger = logging.getLogger('db.index')
 
 
@@ -57,14 +93,26 @@ class IndexReader(object):
 
     def __init__(self, root, metadata, commit_cb=None):
         self.metadata = metadata
+        #: The last `checkpoint()` value committed before `commit_cb` call
+        self.committed = None
         self._db = None
         self._props = {}
+        self._stored = {}
         self._path = root
+        self._shard_paths = shard_paths(root)
         self._commit_cb = commit_cb
+        self._parser = None
+        self._range_processors = []
+        self._queries = None
+
+        if index_query_cache.value > 0:
+            self._queries = pylru.lrucache(index_query_cache.value)
 
         for name, prop in self.metadata.items():
             if prop.indexed:
                 self._props[name] = prop
+            if prop.stored_in_index:
+                self._stored[name] = prop
 
     def ensure_open(self):
         pass
@@ -113,7 +161,8 @@ class IndexReader(object):
         raise NotImplementedError()
 
     def find(self, offset=0, limit=None, query='', reply=('guid',),
-            order_by=None, group_by=None, **request):
+            order_by=None, group_by=None, after=None, total='exact',
+            facets=None, **request):
         """Search resources within the index.
 
         The result will be an array of dictionaries with found documents'
@@ -135,6 +184,20 @@ class IndexReader(object):
             descending order
         :param group_by:
             property name to group resulting list by; no groupping by default
+        :param after:
+            continuation token, returned by `cursor()`, to start
+            the resulting list right after the document it was created for;
+            `offset` is ignored in this case, and, the `total_count` counts
+            only documents that follow the token
+        :param total:
+            how to count `total_count`, ``exact`` to check all documents
+            to get exact value, ``estimate`` to let Xapian get estimated
+            value without checking extra documents, ``none`` if the value
+            is not needed at all
+        :param facets:
+            dictionary with names of properties to count values for;
+            dictionary values will be set to dictionaries of the number
+            of found documents for every property value
         :param request:
             a dictionary with property values to restrict the search
         :returns:
@@ -146,13 +209,28 @@ class IndexReader(object):
         self.ensure_open()
 
         start_timestamp = time.time()
+        if after is not None:
+            offset = 0
         if limit is None:
             limit = self._db.get_doccount()
-        # This will assure that the results count is exact.
-        check_at_least = offset + limit + 1
-
-        enquire = self._enquire(request, query, order_by, group_by)
+        enforce(total in _TOTALS, http.BadRequest,
+                'Total should be one of %s', ', '.join(_TOTALS))
+        if total == 'exact':
+            # This will assure that the results count is exact.
+            check_at_least = offset + limit + 1
+        else:
+            check_at_least = 0
+
+        enquire = self._enquire(request, query, order_by, group_by, after)
+        spy = None
+        if facets:
+            spy = self._facet_spy(facets)
+            enquire.add_matchspy(spy)
+            # Count values for the whole found set
+            check_at_least = self._db.get_doccount()
         mset = self._call_db(enquire.get_mset, offset, limit, check_at_least)
+        if spy is not None:
+            facets.update(spy.counts)
 
         _logger.trace('Found in %s: query=%r time=%s total=%s parsed=%s',
                 self.metadata.name, query, time.time() - start_timestamp,
@@ -160,12 +238,154 @@ class IndexReader(object):
 
         return mset
 
+    def cursor(self, guid, order_by=None, document=None):
+        """Create continuation token to pass as `after` to `find()`.
+
+        The token is opaque for callers and contains the sorting value
+        of the specified document, so, next search calls will start right
+        after it without ranking all preceding documents.
+
+        :param guid:
+            the last document GUID from the previous `find()` call
+        :param order_by:
+            the same value as for the previous `find()` call
+        :param document:
+            Xapian document of the `guid` from `find()` results to take
+            the sorting value from instead of looking the document up;
+            in that case, document changes made after the search
+            do not affect the token
+        :returns:
+            string with the token
+
+        """
+        self.ensure_open()
+
+        prop, __ = self._order(order_by)
+        value = ''
+        if prop is not None and document is not None:
+            value = document.get_value(prop.slot)
+        elif prop is not None:
+            postlist = self._call_db(self._db.postlist,
+                    _term(GUID_PREFIX, guid))
+            for hit in postlist:
+                doc = self._db.get_document(hit.docid)
+                value = doc.get_value(prop.slot)
+                break
+            else:
+                raise http.NotFound('No such document')
+        return base64.urlsafe_b64encode(jsonlib.dumps(
+            [order_by or '', base64.b64encode(value), guid]))
+
     def commit(self):
         """Flush index changes to the disk."""
         raise NotImplementedError()
 
-    def _enquire(self, request, query, order_by, group_by):
+    def checkpoint(self, value):
+        """Mark all changes made before the call.
+
+        After committing these changes, the `value` will be set to
+        the `committed` attribute before calling `commit_cb`.
+
+        """
+        raise NotImplementedError()
+
+    def _enquire(self, request, query, order_by, group_by, after=None):
         enquire = xapian.Enquire(self._db)
+
+        key = None
+        if self._queries is not None:
+            key = _query_key(query, request)
+        if key is not None and key in self._queries:
+            final = self._queries[key]
+        else:
+            final = self._query(query, request)
+            if key is not None:
+                self._queries[key] = final
+        if after:
+            final = xapian.Query(xapian.Query.OP_FILTER,
+                    [final, self._after(after, order_by)])
+        enquire.set_query(final)
+
+        if hasattr(xapian, 'MultiValueKeyMaker'):
+            sorter = xapian.MultiValueKeyMaker()
+            prop, reverse = self._order(order_by)
+            if prop is not None:
+                sorter.add_value(prop.slot, reverse)
+            # Sort by ascending GUID to make order predictable all time
+            sorter.add_value(0, False)
+            enquire.set_sort_by_key(sorter, reverse=False)
+        else:
+            _logger.warning('In order to support sorting, '
+                    'Xapian should be at least 1.2.0')
+
+        if group_by:
+            prop = self._props.get(group_by)
+            enforce(prop is not None and prop.slot is not None,
+                    'Cannot group by %r property of %r',
+                    group_by, self.metadata.name)
+            enquire.set_collapse_key(prop.slot)
+
+        return enquire
+
+    def _facet_spy(self, facets):
+        prefixes = {}
+        for name in facets:
+            prop = self._props.get(name)
+            enforce(prop is not None and prop.prefix, http.BadRequest,
+                    'Cannot count values of %r property of %r',
+                    name, self.metadata.name)
+            prefixes[name] = prop.prefix
+        return _FacetSpy(prefixes)
+
+    def _order(self, order_by):
+        if not order_by:
+            return None, False
+        if order_by.startswith('+'):
+            reverse = False
+            order_by = order_by[1:]
+        elif order_by.startswith('-'):
+            reverse = True
+            order_by = order_by[1:]
+        else:
+            reverse = False
+        prop = self._props.get(order_by)
+        enforce(prop is not None and prop.slot is not None,
+                'Cannot sort using %r property of %r',
+                order_by, self.metadata.name)
+        return prop, reverse
+
+    def _after(self, after, order_by):
+        try:
+            token_order, value, guid = \
+                    jsonlib.loads(base64.urlsafe_b64decode(str(after)))
+            value = base64.b64decode(value)
+            guid = str(guid)
+        except Exception:
+            raise http.BadRequest('Malformed continuation token')
+        enforce((order_by or '') == token_order, http.BadRequest,
+                'Continuation token was created for another order')
+
+        # Documents with the same sorting value but with bigger GUID
+        query = xapian.Query(xapian.Query.OP_AND_NOT, [
+            xapian.Query(xapian.Query.OP_VALUE_GE, 0, guid),
+            xapian.Query(_term(GUID_PREFIX, guid)),
+            ])
+        prop, reverse = self._order(order_by)
+        if prop is None:
+            return query
+
+        same = xapian.Query(xapian.Query.OP_VALUE_RANGE,
+                prop.slot, value, value)
+        if reverse:
+            beyond = xapian.Query(xapian.Query.OP_VALUE_LE, prop.slot, value)
+        else:
+            beyond = xapian.Query(xapian.Query.OP_VALUE_GE, prop.slot, value)
+        return xapian.Query(xapian.Query.OP_OR, [
+            xapian.Query(xapian.Query.OP_AND_NOT, [beyond, same]),
+            xapian.Query(xapian.Query.OP_AND, [same, query]),
+            ])
+
+    def _query(self, query, request):
         all_queries = []
         and_not_queries = []
         boolean_queries = []
@@ -174,22 +394,7 @@ class IndexReader(object):
             query = self._extract_exact_search_terms(query, request)
 
         if query:
-            parser = xapian.QueryParser()
-            parser.set_database(self._db)
-            for name, prop in self._props.items():
-                if not prop.prefix:
-                    continue
-                if prop.boolean:
-                    parser.add_boolean_prefix(name, prop.prefix)
-                else:
-                    parser.add_prefix(name, prop.prefix)
-                parser.add_prefix('', prop.prefix)
-                if prop.slot is not None:
-                    value_range = xapian.NumberValueRangeProcessor(
-                            prop.slot, name + ':')
-                    parser.add_valuerangeprocessor(value_range)
-            parser.add_prefix('', '')
-            query = parser.parse_query(query,
+            query = self._query_parser().parse_query(query,
                     xapian.QueryParser.FLAG_PHRASE |
                     xapian.QueryParser.FLAG_BOOLEAN |
                     xapian.QueryParser.FLAG_LOVEHATE |
@@ -208,7 +413,8 @@ class IndexReader(object):
             prop = self._props.get(name)
             if prop is None or not prop.prefix:
                 continue
-            bisect.insort(args, (prop.prefix, prop, value, negative))
+            args.append((prop.prefix, prop, value, negative))
+        args.sort(key=lambda x: x[0])
 
         for __, prop, value, negative in args:
             if negative:
@@ -242,39 +448,95 @@ class IndexReader(object):
             final = xapian.Query('')
         for i in and_not_queries:
             final = xapian.Query(xapian.Query.OP_AND_NOT, [final, i])
-        enquire.set_query(final)
+        return final
 
-        if hasattr(xapian, 'MultiValueKeyMaker'):
-            sorter = xapian.MultiValueKeyMaker()
-            if order_by:
-                if order_by.startswith('+'):
-                    reverse = False
-                    order_by = order_by[1:]
-                elif order_by.startswith('-'):
-                    reverse = True
-                    order_by = order_by[1:]
+    def _query_parser(self):
+        if self._parser is None:
+            parser = xapian.QueryParser()
+            for name, prop in self._props.items():
+                if not prop.prefix:
+                    continue
+                if prop.boolean:
+                    parser.add_boolean_prefix(name, prop.prefix)
                 else:
-                    reverse = False
-                prop = self._props.get(order_by)
-                enforce(prop is not None and prop.slot is not None,
-                        'Cannot sort using %r property of %r',
-                        order_by, self.metadata.name)
-                sorter.add_value(prop.slot, reverse)
-            # Sort by ascending GUID to make order predictable all time
-            sorter.add_value(0, False)
-            enquire.set_sort_by_key(sorter, reverse=False)
-        else:
-            _logger.warning('In order to support sorting, '
-                    'Xapian should be at least 1.2.0')
+                    parser.add_prefix(name, prop.prefix)
+                parser.add_prefix('', prop.prefix)
+                if prop.slot is not None:
+                    value_range = xapian.NumberValueRangeProcessor(
+                            prop.slot, name + ':')
+                    parser.add_valuerangeprocessor(value_range)
+                    # Keep processors alive while parser is using them
+                    self._range_processors.append(value_range)
+            parser.add_prefix('', '')
+            self._parser = parser
+        # Wildcards are being expanded using the current database state
+        self._parser.set_database(self._db)
+        return self._parser
+
+    def _drop_queries(self):
+        # Parsed queries depend on database terms, e.g., for partial search
+        if self._queries is not None:
+            self._queries.clear()
+
+    def _values(self, properties):
+        # Plain values of properties `_document()` needs, e.g., to not
+        # pickle the whole `Resource` object for the writer process
+        result = {}
+        for props in (self._props, self._stored):
+            for name, prop in props.items():
+                result[name] = properties.get(name, prop.default)
+        return result
+
+    def _document(self, guid, properties, term_generator):
+        doc = xapian.Document()
+        term_generator.set_document(doc)
 
-        if group_by:
-            prop = self._props.get(group_by)
-            enforce(prop is not None and prop.slot is not None,
-                    'Cannot group by %r property of %r',
-                    group_by, self.metadata.name)
-            enquire.set_collapse_key(prop.slot)
+        for name, prop in self._props.items():
+            value = guid \
+                    if prop.slot == 0 \
+                    else properties.get(name, prop.default)
 
-        return enquire
+            if prop.slot is not None:
+                doc.add_value(prop.slot, prop.slotting(value))
+
+            if prop.prefix or prop.full_text:
+                for value_ in prop.encode(value):
+                    if prop.prefix:
+                        term = _term(prop.prefix, value_)
+                        if prop.boolean:
+                            doc.add_boolean_term(term)
+                            doc.add_boolean_term(_EXACT_PREFIX + term)
+                        else:
+                            doc.add_term(term)
+                            doc.add_term(_EXACT_PREFIX + term)
+                    if prop.full_text or isinstance(value_, IndexableText):
+                        term_generator.index_text(value_, 1, prop.prefix or '')
+                        term_generator.increase_termpos()
+
+        if self._stored:
+            data = {}
+            for name, prop in self._stored.items():
+                data[name] = properties.get(name, prop.default)
+            doc.set_data(jsonlib.dumps(data))
+
+        return doc
+
+    def _shard(self, guid):
+        return (zlib.crc32(toolkit.ascii(guid)) & 0xffffffff) % \
+                len(self._shard_paths)
+
+    def _open_readable(self):
+        return _combine([xapian.Database(i) for i in self._shard_paths])
+
+    def _open_writable(self, path):
+        _recover(path)
+        try:
+            return xapian.WritableDatabase(path, xapian.DB_CREATE_OR_OPEN)
+        except xapian.DatabaseError:
+            _logger.exception('Cannot open Xapian %r index, will rebuild',
+                    self.metadata.name)
+            shutil.rmtree(path, ignore_errors=True)
+            return xapian.WritableDatabase(path, xapian.DB_CREATE_OR_OPEN)
 
     def _call_db(self, op, *args):
         tries = 0
@@ -290,6 +552,7 @@ class IndexReader(object):
                         'time: %s', op, self.metadata.name, tries, error)
                 time.sleep(tries * .1)
                 self._db.reopen()
+                self._drop_queries()
                 tries += 1
 
     def _extract_exact_search_terms(self, query, props):
@@ -311,9 +574,20 @@ class IndexWriter(IndexReader):
     def __init__(self, root, metadata, commit_cb=None):
         IndexReader.__init__(self, root, metadata, commit_cb)
 
+        self._writers = []
         self._pending_updates = 0
+        self._term_generator = xapian.TermGenerator()
+        self._bulk = 0
+        self._bulk_failed = False
+        self._checkpoint = None
+        self._compacting = None
+        self._compacted = coroutine.Event()
+        self._compacted.set()
         self._commit_cond = coroutine.Event()
         self._commit_job = coroutine.spawn(self._commit_handler)
+        self._compact_job = None
+        if index_compact_hour.value >= 0:
+            self._compact_job = coroutine.spawn(_compact_handler, self)
 
         # Let `_commit_handler()` call `wait()` to not miss immediate commit
         coroutine.dispatch()
@@ -323,9 +597,13 @@ class IndexWriter(IndexReader):
         """Flush index write pending queue and close the index."""
         if self._db is None:
             return
+        if self._compact_job is not None:
+            self._compact_job.kill()
+            self._compact_job = None
         self._commit()
         self._commit_job.kill()
         self._commit_job = None
+        self._writers = []
         self._db = None
 
     def store(self, guid, properties, pre_cb=None, post_cb=None, *args):
@@ -338,34 +616,12 @@ class IndexWriter(IndexReader):
 
         _logger.trace('Index %r object: %r', self.metadata.name, properties)
 
-        doc = xapian.Document()
-        term_generator = xapian.TermGenerator()
-        term_generator.set_document(doc)
-
-        for name, prop in self._props.items():
-            value = guid \
-                    if prop.slot == 0 \
-                    else properties.get(name, prop.default)
-
-            if prop.slot is not None:
-                doc.add_value(prop.slot, prop.slotting(value))
-
-            if prop.prefix or prop.full_text:
-                for value_ in prop.encode(value):
-                    if prop.prefix:
-                        term = _term(prop.prefix, value_)
-                        if prop.boolean:
-                            doc.add_boolean_term(term)
-                            doc.add_boolean_term(_EXACT_PREFIX + term)
-                        else:
-                            doc.add_term(term)
-                            doc.add_term(_EXACT_PREFIX + term)
-                    if prop.full_text or isinstance(value_, IndexableText):
-                        term_generator.index_text(value_, 1, prop.prefix or '')
-                        term_generator.increase_termpos()
-
-        self._db.replace_document(_term(GUID_PREFIX, guid), doc)
+        shard = self._shard(guid)
+        self._wait_for_compaction(shard)
+        doc = self._document(guid, properties, self._term_generator)
+        self._writers[shard].replace_document(_term(GUID_PREFIX, guid), doc)
         self._pending_updates += 1
+        self._drop_queries()
 
         if post_cb is not None:
             post_cb(*args)
@@ -378,8 +634,11 @@ class IndexWriter(IndexReader):
         _logger.debug('Delete %r document from %r',
                 guid, self.metadata.name)
 
-        self._db.delete_document(_term(GUID_PREFIX, guid))
+        shard = self._shard(guid)
+        self._wait_for_compaction(shard)
+        self._writers[shard].delete_document(_term(GUID_PREFIX, guid))
         self._pending_updates += 1
+        self._drop_queries()
 
         if post_cb is not None:
             post_cb(*args)
@@ -393,42 +652,136 @@ class IndexWriter(IndexReader):
         # Trigger condition to reset waiting for `index_flush_timeout` timeout
         self._commit_cond.set()
 
+    def checkpoint(self, value):
+        # Changes are being applied immediately
+        self._checkpoint = value
+
+    @contextmanager
+    def bulk(self):
+        """Process all changes made in the context in one transaction.
+
+        Regular commits are postponed until leaving the outer context,
+        `commit_cb` will be called only once for the whole batch.
+        If any of contexts fails, the transaction will be cancelled,
+        except changes already flushed to keep memory usage bounded.
+
+        """
+        self.ensure_open()
+        if self._bulk == 0:
+            self._wait_for_compaction()
+        self._bulk += 1
+        if self._bulk == 1:
+            _logger.debug('Start bulk changes in %r', self.metadata.name)
+            self._bulk_failed = False
+            for db in self._writers:
+                db.begin_transaction(False)
+        try:
+            yield
+        except:
+            self._bulk_failed = True
+            raise
+        finally:
+            self._bulk -= 1
+            if self._bulk == 0:
+                if self._bulk_failed:
+                    _logger.warning('Cancel bulk changes in %r',
+                            self.metadata.name)
+                    for db in self._writers:
+                        db.cancel_transaction()
+                    # Uncommitted changes made before the batch
+                    # might be discarded as well
+                    self._checkpoint = self.committed
+                else:
+                    for db in self._writers:
+                        db.commit_transaction()
+                    _logger.debug('Finish bulk changes in %r',
+                            self.metadata.name)
+                self._commit()
+
+    def compact(self):
+        """Compact index databases.
+
+        Databases are being compacted one by one by a separate process,
+        changes of the database being compacted are postponed until
+        swapping it with its compacted copy.
+
+        :returns:
+            dictionary with ``size`` and ``latency`` of a probe search,
+            both are pairs of values before and after compaction,
+            and ``time`` compaction took; `None` if compaction
+            was postponed
+
+        """
+        self.ensure_open()
+        if self._bulk:
+            _logger.info('Postpone compacting %r, bulk changes are running',
+                    self.metadata.name)
+            return None
+
+        stats = _CompactStats(self.metadata.name, self._shard_paths)
+        for shard, path in enumerate(self._shard_paths):
+            self._compacting = shard
+            self._compacted.clear()
+            try:
+                self._commit()
+                child = coroutine.fork()
+                if child is None:
+                    # pylint: disable-msg=W0212
+                    os._exit(_compact(path))
+                enforce(child.wait() == 0, 'Failed to compact %r', path)
+                _close(self._writers[shard])
+                _swap(path)
+                self._writers[shard] = self._open_writable(path)
+                self._db = _combine(self._writers)
+                self._drop_queries()
+            finally:
+                self._compacting = None
+                self._compacted.set()
+        return stats.finish()
+
     def ensure_open(self):
         if self._db is None:
-            try:
-                self._db = xapian.WritableDatabase(self._path,
-                        xapian.DB_CREATE_OR_OPEN)
-            except xapian.DatabaseError:
-                _logger.exception('Cannot open Xapian %r index, will rebuild',
-                        self.metadata.name)
-                shutil.rmtree(self._path, ignore_errors=True)
-                self._db = xapian.WritableDatabase(self._path,
-                        xapian.DB_CREATE_OR_OPEN)
+            self._writers = [self._open_writable(i)
+                    for i in self._shard_paths]
+            self._db = _combine(self._writers)
         IndexReader.ensure_open(self)
 
     def _commit(self):
-        if self._pending_updates <= 0:
+        if self._pending_updates <= 0 or self._bulk:
             return
 
         _logger.debug('Commiting %s changes of %r index to the disk',
                 self._pending_updates, self.metadata.name)
         ts = time.time()
 
-        if hasattr(self._db, 'commit'):
-            self._db.commit()
-        else:
-            self._db.flush()
+        for db in self._writers:
+            if hasattr(db, 'commit'):
+                db.commit()
+            else:
+                db.flush()
         self._pending_updates = 0
 
         _logger.debug('Commit to %r took %s seconds',
                 self.metadata.name, time.time() - ts)
 
+        self.committed = self._checkpoint
         if self._commit_cb is not None:
             self._commit_cb()
 
     def _check_for_commit(self):
-        if index_flush_threshold.value > 0 and \
-                self._pending_updates >= index_flush_threshold.value:
+        if index_flush_threshold.value <= 0 or \
+                self._pending_updates < index_flush_threshold.value:
+            return
+        if self._bulk:
+            if self._pending_updates % index_flush_threshold.value:
+                return
+            # Flush the transaction to keep memory usage bounded,
+            # but postpone `commit_cb` till the end of the batch
+            for db in self._writers:
+                db.commit_transaction()
+                db.commit()
+                db.begin_transaction(False)
+        else:
             # Avoid processing heavy commits in the same coroutine
             self._commit_cond.set()
 
@@ -443,6 +796,647 @@ class IndexWriter(IndexReader):
             self._commit()
             self._commit_cond.clear()
 
+    def _wait_for_compaction(self, shard=None):
+        while self._compacting is not None and \
+                shard in (None, self._compacting):
+            self._compacted.wait()
+
+
+class ProxyIndex(IndexReader):
+    """Keep Xapian writer in a separate process.
+
+    Changes are being sent to the writer process via a queue that can
+    contain not more than `index_write_queue` unprocessed changes.
+    The current process keeps read-only database that is being reopened
+    on every writer's commit, so, slow commits don't block coroutines.
+
+    """
+
+    def __init__(self, root, metadata, commit_cb=None):
+        IndexReader.__init__(self, root, metadata, commit_cb)
+
+        self._bulk = 0
+        self._bulk_failed = False
+        self._queued = 0
+        self._sent = 0
+        self._checkpoints = deque()
+        self._alive = True
+        self._acked = coroutine.Event()
+        self._exited = coroutine.AsyncResult()
+        self._send_lock = coroutine.Lock()
+        self._compact_stats = None
+        self._compact_job = None
+
+        to_writer, self._input = os.pipe()
+        self._output, from_writer = os.pipe()
+        child = coroutine.fork()
+        if child is None:
+            os.close(self._input)
+            os.close(self._output)
+            status = 0
+            try:
+                _Writer(self, to_writer, from_writer).serve()
+            except EOFError:
+                pass
+            except Exception:
+                _logger.exception('%r index writer failed', metadata.name)
+                status = 1
+            finally:
+                os._exit(status)
+        os.close(to_writer)
+        os.close(from_writer)
+        child.watch(self._exited.set)
+        for fd in (self._input, self._output):
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+        _logger.debug('Started %r index writer, pid=%s',
+                metadata.name, child.pid)
+
+        self._reply_job = coroutine.spawn(self._reply_handler)
+        while self._db is None:
+            enforce(self._alive, 'Cannot start %r index writer', metadata.name)
+            self._acked.wait()
+            self._acked.clear()
+        if index_compact_hour.value >= 0:
+            self._compact_job = coroutine.spawn(_compact_handler, self)
+
+    def close(self):
+        """Flush index write pending queue and stop the writer."""
+        if self._db is None:
+            return
+        if self._compact_job is not None:
+            self._compact_job.kill()
+            self._compact_job = None
+        if self._alive:
+            self._send('close')
+            self._wait(0)
+        self._exited.get()
+        self._reply_job.kill()
+        os.close(self._input)
+        os.close(self._output)
+        self._db = None
+
+    def store(self, guid, properties, pre_cb=None, post_cb=None, *args):
+        if pre_cb is not None:
+            properties = pre_cb(guid, properties, *args)
+            if properties is None:
+                return
+
+        _logger.trace('Queue %r object: %r', self.metadata.name, properties)
+        self._send('store', guid, self._values(properties))
+
+        if post_cb is not None:
+            post_cb(*args)
+
+    def delete(self, guid, post_cb=None, *args):
+        _logger.debug('Delete %r document from %r',
+                guid, self.metadata.name)
+        self._send('delete', guid)
+
+        if post_cb is not None:
+            post_cb(*args)
+
+    def commit(self):
+        if self._db is None:
+            return
+        self._send('commit')
+        # Writer acknowledges changes only after notifying about commits
+        self._wait(0)
+
+    def checkpoint(self, value):
+        self._checkpoints.append((self._sent, value))
+
+    @contextmanager
+    def bulk(self):
+        """Process all changes made in the context in one transaction."""
+        self._bulk += 1
+        if self._bulk == 1:
+            self._bulk_failed = False
+            self._send('begin')
+        try:
+            yield
+        except:
+            self._bulk_failed = True
+            raise
+        finally:
+            self._bulk -= 1
+            if self._bulk == 0:
+                if self._bulk_failed:
+                    # Uncommitted changes made before the batch
+                    # might be discarded as well
+                    self._checkpoints.clear()
+                    self._send('cancel')
+                else:
+                    self._send('end')
+
+    def compact(self):
+        """Compact index databases in the writer process.
+
+        :returns:
+            the same as `IndexWriter.compact()`
+
+        """
+        if self._db is None or self._compact_stats is _PENDING:
+            return None
+        self._compact_stats = _PENDING
+        self._send('compact')
+        # Writer compacts databases without blocking the queue
+        while self._compact_stats is _PENDING:
+            enforce(self._alive, 'The %r index writer is not running',
+                    self.metadata.name)
+            self._acked.clear()
+            self._acked.wait()
+        return self._compact_stats
+
+    def _send(self, *msg):
+        self._wait(index_write_queue.value - 1)
+        data = _pack(msg)
+        with self._send_lock:
+            while data:
+                try:
+                    data = data[os.write(self._input, data):]
+                except OSError, error:
+                    if error.errno != errno.EAGAIN:
+                        raise
+                    coroutine.select([], [self._input], [])
+            self._queued += 1
+            self._sent += 1
+
+    def _wait(self, size):
+        while self._queued > max(0, size):
+            enforce(self._alive, 'The %r index writer is not running',
+                    self.metadata.name)
+            self._acked.clear()
+            self._acked.wait()
+
+    def _reply_handler(self):
+        buf = ''
+        try:
+            while True:
+                coroutine.select([self._output], [], [])
+                try:
+                    chunk = os.read(self._output, _READ_BUFFER)
+                except OSError, error:
+                    if error.errno == errno.EAGAIN:
+                        continue
+                    raise
+                if not chunk:
+                    break
+                buf += chunk
+                while len(buf) >= _HEADER.size:
+                    size = _HEADER.size + _HEADER.unpack_from(buf)[0]
+                    if len(buf) < size:
+                        break
+                    self._process_reply(*pickle.loads(buf[_HEADER.size:size]))
+                    buf = buf[size:]
+                    self._acked.set()
+        finally:
+            _logger.debug('Stopped %r index writer', self.metadata.name)
+            self._alive = False
+            self._acked.set()
+
+    def _process_reply(self, op, *args):
+        if op == 'ack':
+            self._queued -= args[0]
+        elif op == 'ready':
+            self._db = self._open_readable()
+        elif op == 'compacted':
+            # Databases were replaced, reopening is not enough
+            self._db = self._open_readable()
+            self._drop_queries()
+            self._compact_stats = args[0]
+        elif op == 'commit':
+            # Writer reports the number of processed messages
+            while self._checkpoints and self._checkpoints[0][0] <= args[0]:
+                self.committed = self._checkpoints.popleft()[1]
+            self._db.reopen()
+            self._drop_queries()
+            if self._commit_cb is not None:
+                try:
+                    self._commit_cb()
+                except Exception:
+                    _logger.exception('Failed to process %r index commit',
+                            self.metadata.name)
+
+
+class _Writer(object):
+    """The writer process side of `ProxyIndex`."""
+
+    def __init__(self, index, input_fd, output_fd):
+        self._index = index
+        self._input = input_fd
+        self._output = output_fd
+        self._writers = [index._open_writable(i) for i in index._shard_paths]
+        self._term_generator = xapian.TermGenerator()
+        self._pending_updates = 0
+        self._flush_ts = None
+        self._bulk = False
+        self._bulk_changes = 0
+        self._received = 0
+        self._compacting = None
+        self._compact_pid = None
+        self._compact_fd = None
+        self._compact_status = None
+        self._compact_stats = None
+        self._compact_changes = []
+
+    def serve(self):
+        self._reply('ready')
+        while True:
+            if self._compact_status is not None and not self._bulk:
+                self._swap_compacted()
+            timeout = None
+            if self._pending_updates and not self._bulk and \
+                    index_flush_timeout.value > 0:
+                timeout = max(0, self._flush_ts - time.time())
+            ready = self._ready(timeout)
+            if self._compact_fd in ready:
+                self._compact_exited()
+                continue
+            if self._input not in ready:
+                if not ready:
+                    self._commit()
+                continue
+            processed = 0
+            while True:
+                msg = self._recv()
+                processed += 1
+                if msg is None:
+                    pass
+                elif msg[0] == 'close':
+                    if self._compact_fd is not None:
+                        self._compact_exited()
+                        self._swap_compacted()
+                    self._commit()
+                    self._reply('ack', processed)
+                    return
+                else:
+                    try:
+                        getattr(self, '_' + msg[0])(*msg[1:])
+                    except Exception:
+                        _logger.exception('Failed to %s in %r index',
+                                msg[0], self._index.metadata.name)
+                # Acknowledge in batches if parent sends changes faster
+                if self._input not in self._ready(0):
+                    break
+            self._reply('ack', processed)
+
+    def _store(self, guid, properties):
+        shard = self._index._shard(guid)
+        self._apply(self._writers[shard], 'store', guid, properties)
+        if shard == self._compacting:
+            self._compact_changes.append(('store', guid, properties))
+        self._changed()
+
+    def _delete(self, guid):
+        shard = self._index._shard(guid)
+        self._apply(self._writers[shard], 'delete', guid)
+        if shard == self._compacting:
+            self._compact_changes.append(('delete', guid))
+        self._changed()
+
+    def _apply(self, db, op, guid, properties=None):
+        if op == 'store':
+            doc = self._index._document(guid, properties,
+                    self._term_generator)
+            db.replace_document(_term(GUID_PREFIX, guid), doc)
+        else:
+            db.delete_document(_term(GUID_PREFIX, guid))
+
+    def _begin(self):
+        self._bulk = True
+        self._bulk_changes = len(self._compact_changes)
+        for db in self._writers:
+            db.begin_transaction(False)
+
+    def _end(self):
+        for db in self._writers:
+            db.commit_transaction()
+        self._bulk = False
+        self._commit()
+
+    def _cancel(self):
+        _logger.warning('Cancel bulk changes in %r', self._index.metadata.name)
+        for db in self._writers:
+            db.cancel_transaction()
+        del self._compact_changes[self._bulk_changes:]
+        self._bulk = False
+        self._commit()
+
+    def _compact(self):
+        if self._bulk or self._compacting is not None:
+            _logger.info('Postpone compacting %r, bulk changes or another '
+                    'compaction are running', self._index.metadata.name)
+            self._reply('compacted', None)
+            return
+        self._compact_stats = _CompactStats(self._index.metadata.name,
+                self._index._shard_paths)
+        self._compact_shard(0)
+
+    def _compact_shard(self, shard):
+        # Compact the committed revision in a separate process and keep
+        # processing changes, they will be replayed on the compacted copy
+        self._commit()
+        path = self._index._shard_paths[shard]
+        try:
+            status_r, status_w = os.pipe()
+            pid = os.fork()
+        except Exception:
+            _logger.exception('Cannot start compacting %r', path)
+            self._reply('compacted', None)
+            return
+        if not pid:
+            status = 1
+            try:
+                os.close(status_r)
+                status = _compact(path)
+                os.write(status_w, chr(status))
+            finally:
+                # pylint: disable-msg=W0212
+                os._exit(status)
+        os.close(status_w)
+        self._compacting = shard
+        self._compact_pid = pid
+        self._compact_fd = status_r
+        self._compact_changes = []
+
+    def _compact_exited(self):
+        status = os.read(self._compact_fd, 1)
+        os.close(self._compact_fd)
+        os.waitpid(self._compact_pid, 0)
+        self._compact_fd = None
+        self._compact_pid = None
+        self._compact_status = ord(status) if status else 1
+
+    def _swap_compacted(self):
+        shard = self._compacting
+        path = self._index._shard_paths[shard]
+        status = self._compact_status
+        changes = self._compact_changes
+        self._compacting = None
+        self._compact_status = None
+        self._compact_changes = []
+
+        if status != 0:
+            _logger.error('Failed to compact %r', path)
+            self._reply('compacted', None)
+            return
+        self._commit()
+        _close(self._writers[shard])
+        try:
+            _swap(path)
+        except Exception:
+            _logger.exception('Cannot swap %r with its compacted copy', path)
+            status = 1
+        # Will finish or rollback the swapping if it failed
+        db = self._writers[shard] = self._index._open_writable(path)
+        if status != 0:
+            self._reply('compacted', None)
+            return
+        if changes:
+            _logger.debug('Replay %s changes made while compacting %r',
+                    len(changes), path)
+            for change in changes:
+                self._apply(db, *change)
+            db.commit()
+
+        if shard + 1 < len(self._writers):
+            self._compact_shard(shard + 1)
+        else:
+            self._reply('compacted', self._compact_stats.finish())
+
+    def _commit(self):
+        if self._pending_updates <= 0 or self._bulk:
+            return
+
+        _logger.debug('Commiting %s changes of %r index to the disk',
+                self._pending_updates, self._index.metadata.name)
+        ts = time.time()
+
+        for db in self._writers:
+            db.commit()
+        self._pending_updates = 0
+
+        _logger.debug('Commit to %r took %s seconds',
+                self._index.metadata.name, time.time() - ts)
+
+        self._reply('commit', self._received)
+
+    def _changed(self):
+        self._pending_updates += 1
+        if self._pending_updates == 1 and index_flush_timeout.value > 0:
+            self._flush_ts = time.time() + index_flush_timeout.value
+        if index_flush_threshold.value <= 0 or \
+                self._pending_updates < index_flush_threshold.value:
+            return
+        if not self._bulk:
+            self._commit()
+        elif self._pending_updates % index_flush_threshold.value == 0:
+            for db in self._writers:
+                db.commit_transaction()
+                db.commit()
+                db.begin_transaction(False)
+
+    def _ready(self, timeout):
+        fds = [self._input]
+        if self._compact_fd is not None:
+            fds.append(self._compact_fd)
+        # Do not switch to the hub, it contains parent process coroutines
+        return coroutine.blocking_select(fds, [], [], timeout)[0]
+
+    def _recv(self):
+        size = _HEADER.unpack(self._read(_HEADER.size))[0]
+        data = self._read(size)
+        self._received += 1
+        try:
+            return pickle.loads(data)
+        except Exception:
+            _logger.exception('Cannot decode message for %r index',
+                    self._index.metadata.name)
+            return None
+
+    def _read(self, size):
+        result = ''
+        while len(result) < size:
+            chunk = os.read(self._input, size - len(result))
+            if not chunk:
+                raise EOFError()
+            result += chunk
+        return result
+
+    def _reply(self, *msg):
+        data = _pack(msg)
+        while data:
+            data = data[os.write(self._output, data):]
+
+
+class _FacetSpy(xapian.MatchSpy):
+    """Count property values of matched documents in one pass."""
+
+    def __init__(self, prefixes):
+        xapian.MatchSpy.__init__(self)
+        self.counts = {}
+        self._prefixes = []
+        ranges = set()
+        for name, prefix in prefixes.items():
+            self.counts[name] = {}
+            self._prefixes.append((name, prefix, _EXACT_PREFIX + prefix))
+            ranges.update([prefix, _EXACT_PREFIX + prefix])
+        # Sorted term ranges to read, nested ones are covered by outer
+        self._ranges = []
+        for prefix in sorted(ranges):
+            if not self._ranges or not prefix.startswith(self._ranges[-1]):
+                self._ranges.append(prefix)
+
+    def __call__(self, doc, weight):
+        # Terms are sorted, read only property ones in one pass
+        terms = set()
+        termlist = doc.termlist()
+        try:
+            for prefix in self._ranges:
+                term = termlist.skip_to(prefix).term
+                while term.startswith(prefix):
+                    terms.add(term)
+                    term = next(termlist).term
+        except StopIteration:
+            pass
+        for name, prefix, exact_prefix in self._prefixes:
+            counts = self.counts[name]
+            for term in terms:
+                if not term.startswith(exact_prefix):
+                    continue
+                value = term[len(exact_prefix):]
+                # Prefixes of exact and regular terms might intersect,
+                # but only terms of the property exist in both forms
+                if prefix + value in terms:
+                    counts[value] = counts.get(value, 0) + 1
+
+
+class _CompactStats(object):
+    """Measure index sizes and search latency around compaction."""
+
+    def __init__(self, name, paths):
+        self._name = name
+        self._paths = paths
+        self._ts = time.time()
+        self._size = _size(paths)
+        self._latency = _probe(paths)
+
+    def finish(self):
+        stats = {
+            'size': [self._size, _size(self._paths)],
+            'latency': [self._latency, _probe(self._paths)],
+            'time': time.time() - self._ts,
+            }
+        _logger.info('Compacted %r index in %.2f seconds, size %s -> %s '
+                'bytes, probe search %.4f -> %.4f seconds', self._name,
+                stats['time'], stats['size'][0], stats['size'][1],
+                stats['latency'][0], stats['latency'][1])
+        return stats
+
+
+def shard_paths(root):
+    """Paths to Xapian databases the index at `root` consists of."""
+    return [join(root, str(i)) for i in xrange(max(1, index_shards.value))]
+
+
+def _pack(msg):
+    data = pickle.dumps(msg, pickle.HIGHEST_PROTOCOL)
+    return _HEADER.pack(len(data)) + data
+
 
 def _term(prefix, value):
     return prefix + toolkit.ascii(value).split('\n')[0][:243]
+
+
+def _query_key(query, request):
+    key = [query]
+    for name, value in sorted(request.items()):
+        if type(value) in (tuple, list):
+            value = tuple(value)
+        key.append((name, value))
+    key = tuple(key)
+    try:
+        hash(key)
+    except TypeError:
+        return None
+    return key
+
+
+def _combine(dbs):
+    result = xapian.Database()
+    for db in dbs:
+        result.add_database(db)
+    return result
+
+
+def _close(db):
+    if hasattr(db, 'close'):
+        db.close()
+
+
+def _compact(path):
+    # Might be called from the forked process, do not switch coroutines
+    try:
+        shutil.rmtree(path + '.compact', ignore_errors=True)
+        compactor = xapian.Compactor()
+        compactor.set_destdir(path + '.compact')
+        compactor.add_source(path)
+        compactor.compact()
+    except Exception:
+        _logger.exception('Cannot compact %r', path)
+        return 1
+    return 0
+
+
+def _swap(path):
+    os.rename(path, path + '.old')
+    os.rename(path + '.compact', path)
+    shutil.rmtree(path + '.old', ignore_errors=True)
+
+
+def _recover(path):
+    if not exists(path) and exists(path + '.old'):
+        # Finish swapping interrupted after compacting the database
+        if exists(path + '.compact'):
+            os.rename(path + '.compact', path)
+        else:
+            os.rename(path + '.old', path)
+    for suffix in ('.compact', '.old'):
+        shutil.rmtree(path + suffix, ignore_errors=True)
+
+
+def _size(paths):
+    result = 0
+    for path in paths:
+        for root, __, files in os.walk(path):
+            for filename in files:
+                result += os.path.getsize(join(root, filename))
+    return result
+
+
+def _probe(paths):
+    # Time to sort all documents, it is sensitive to the fragmentation
+    db = _combine([xapian.Database(i) for i in paths])
+    ts = time.time()
+    enquire = xapian.Enquire(db)
+    enquire.set_query(xapian.Query(''))
+    enquire.set_sort_by_value(0, False)
+    enquire.get_mset(0, 1, db.get_doccount())
+    return time.time() - ts
+
+
+def _compact_handler(index):
+    while True:
+        now = time.localtime()
+        timeout = (index_compact_hour.value - now.tm_hour) % 24 * 3600 - \
+                now.tm_min * 60 - now.tm_sec
+        if timeout <= 0:
+            timeout += 24 * 3600
+        coroutine.sleep(timeout)
+        try:
+            index.compact()
+        except Exception:
+            _logger.exception('Failed to compact %r index',
+                    index.metadata.name)
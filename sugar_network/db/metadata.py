@@ -138,7 +138,7 @@ class Property(object):
 
     def __init__(self, name=None,
             slot=None, prefix=None, full_text=False, boolean=False,
-            acl=ACL.PUBLIC, default=None):
+            acl=ACL.PUBLIC, default=None, stored_in_index=False):
         """
         :param name:
             property name;
@@ -155,6 +155,9 @@ class Property(object):
             the property takes part in full-text search;
         :param boolean:
             Xapian will use boolean search for this property;
+        :param stored_in_index:
+            keep property value in Xapian document data as well to
+            return it from search results without reading the storage;
 
         """
         enforce(name == 'guid' or slot != 0,
@@ -177,6 +180,7 @@ class Property(object):
         self.prefix = prefix
         self.full_text = full_text
         self.boolean = boolean
+        self.stored_in_index = stored_in_index
 
     def typecast(self, value):
         """Convert input values to types stored in the system."""
@@ -202,6 +206,10 @@ class Property(object):
         """Cleanup property value on resetting."""
         pass
 
+    def blobs(self, value):
+        """Digests of blobs the property value refers to."""
+        return []
+
     def assert_access(self, mode, value=None):
         """Is access to the property permitted.
 
@@ -328,8 +336,10 @@ class Blob(Property):
         if value is None:
             return
         elif isinstance(value, File):
+            this.volume.blobs.ref(value.digest)
             return value.digest
         elif isinstance(value, File.Digest):
+            this.volume.blobs.ref(value)
             return value
         elif isinstance(value, dict):
             mime_type = value.get('content-type')
@@ -344,7 +354,9 @@ class Blob(Property):
         if not mime_type:
             mime_type = self.mime_type
 
-        return this.volume.blobs.post(toolkit.tobytes(value), mime_type).digest
+        blob = this.volume.blobs.post(toolkit.tobytes(value), mime_type)
+        this.volume.blobs.ref(blob.digest)
+        return blob.digest
 
     def reprcast(self, value):
         if not value:
@@ -355,6 +367,9 @@ class Blob(Property):
         if value:
             this.volume.blobs.delete(value)
 
+    def blobs(self, value):
+        return [value] if value else []
+
     def assert_access(self, mode, value=None):
         if mode == ACL.WRITE and not value:
             mode = ACL.CREATE
@@ -418,6 +433,13 @@ class Aggregated(Composite):
     def subteardown(self, value):
         self._subtype.teardown(value)
 
+    def blobs(self, value):
+        result = []
+        for aggvalue in value.values():
+            if 'value' in aggvalue:
+                result.extend(self._subtype.blobs(aggvalue['value']))
+        return result
+
     def typecast(self, value):
         enforce(type(value) is list, http.BadRequest,
                 'Aggregated value should be a list')
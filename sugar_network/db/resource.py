@@ -183,11 +183,13 @@ class Resource(object):
         if self.record is not None:
             return self.record.get(prop)
 
-    def diff(self, r, out_r=None):
+    def diff(self, r, out_r=None, props=None):
         patch = {}
         for name, prop in self.metadata.items():
             if name == 'seqno' or prop.acl & ACL.LOCAL:
                 continue
+            if props is not None and name not in props:
+                continue
             meta = self.meta(name)
             if meta is None:
                 continue
@@ -15,7 +15,9 @@
 
 # pylint: disable-msg=W0611
 
+import json
 import logging
+import hashlib
 from contextlib import contextmanager
 
 import xapian
@@ -83,9 +85,10 @@ class Routes(object):
         doc.routed_updated()
 
     @route('GET', [None],
-            arguments={'offset': int, 'limit': int, 'reply': ('guid',)},
+            arguments={'offset': int, 'limit': int, 'reply': ('guid',),
+                'facets': list},
             mime_type='application/json')
-    def find(self, reply, limit):
+    def find(self, reply, limit, facets):
         self._preget()
         request = this.request
         if not limit:
@@ -94,10 +97,39 @@ class Routes(object):
             _logger.warning('The find limit is restricted to %s',
                     self.find_limit)
             request['limit'] = self.find_limit
-        documents, total = this.volume[request.resource].find(
-                not_state='deleted', **request)
-        result = [self._postget(i, reply) for i in documents]
-        return {'total': total, 'result': result}
+        if facets:
+            # Will be populated by the index
+            request['facets'] = dict.fromkeys(facets)
+        directory = this.volume[request.resource]
+        self._assert_etag(directory, request['reply'])
+        page_size = request.get('limit')
+        paginate = 'after' in request and page_size
+        if paginate:
+            # Fetch one more document to know if the next page exists
+            request['limit'] = page_size + 1
+        documents, total = directory.find(not_state='deleted', **request)
+        if paginate:
+            request['limit'] = page_size
+        result = []
+        more = False
+        last = None
+        for doc in documents:
+            if paginate and len(result) == page_size:
+                more = True
+                break
+            result.append(self._postget(doc, reply))
+            last = doc.guid, documents.last
+        response = {'total': total, 'result': result}
+        if facets:
+            response['facets'] = request['facets']
+        if 'after' in request:
+            # Keyset pagination, the last page doesn't have continuation
+            if more:
+                response['after'] = directory.cursor(last[0],
+                        request.get('order_by'), last[1])
+            else:
+                response['after'] = None
+        return response
 
     @route('GET', [None, None], cmd='exists', mime_type='application/json')
     def exists(self):
@@ -112,7 +144,9 @@ class Routes(object):
                 if prop.acl & ACL.READ and not isinstance(prop, Aggregated):
                     reply.append(prop.name)
         self._preget()
-        doc = this.volume[this.request.resource].get(this.request.guid)
+        directory = this.volume[this.request.resource]
+        self._assert_etag(directory, reply)
+        doc = directory.get(this.request.guid)
         enforce(doc.available, http.NotFound, 'Resource not found')
         return self._postget(doc, reply)
 
@@ -121,6 +155,7 @@ class Routes(object):
         request = this.request
         directory = this.volume[request.resource]
         directory.metadata[request.prop].assert_access(ACL.READ)
+        self._assert_etag(directory, [request.prop])
         return directory[request.guid].repr(request.prop)
 
     @route('HEAD', [None, None, None])
@@ -246,6 +281,30 @@ class Routes(object):
             for prop in reply:
                 directory.metadata[prop].assert_access(ACL.READ)
 
+    def _assert_etag(self, directory, props):
+        # Any change within the directory changes its revision, thus,
+        # all tags of documents and find results are being invalidated
+        request = this.request
+        etag = hashlib.sha1(json.dumps([
+            self._revisions(directory, props),
+            request.host, request.accept_language,
+            ])).hexdigest()
+        etag = '"%s"' % etag
+        this.response['etag'] = etag
+        if etag in request.if_none_match:
+            raise http.NotModified()
+
+    def _revisions(self, directory, props):
+        revisions = [directory.revision]
+        if directory.metadata.name != 'user' and \
+                'user' in this.volume.resources:
+            for prop in props:
+                if isinstance(directory.metadata[prop], (Author, Aggregated)):
+                    # Author names and avatars are being taken from users
+                    revisions.append(this.volume['user'].revision)
+                    break
+        return revisions
+
     def _postget(self, doc, props):
         result = {}
         for name in props:
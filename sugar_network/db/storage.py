@@ -15,11 +15,57 @@
 
 import os
 import time
-import json
 import shutil
-from os.path import exists, join, isdir, basename
+import logging
+from os.path import exists, join, isdir, basename, dirname, getsize
 
 from sugar_network import toolkit
+from sugar_network.toolkit import Option, coroutine, jsonlib
+
+
+storage_backend = Option(
+        'how to store documents on the disk, "files", to keep every '
+        'property in a separate file, or, "packed", to keep all document '
+        'properties in one record of per resource append-only file; '
+        'on switching to "packed", existing documents will be migrated',
+        default='files')
+
+storage_wal = Option(
+        'for "files" storage backend, write property changes to '
+        'the write-ahead log, flushed by one fsync() for all concurrent '
+        'writers, and create property files only on log checkpoints',
+        default=False, type_cast=Option.bool_cast, action='store_true')
+
+_SEGMENT_FILENAME = 'records'
+_INDEX_SUFFIX = '.index'
+
+# Compact the segment file only if obsolete records take more bytes
+_COMPACT_THRESHOLD = 1024 * 1024
+
+_WAL_FILENAME = 'wal'
+
+# Materialize property files when the write-ahead log exceeds this size
+_WAL_CHECKPOINT = 1024 * 1024
+
+_logger = logging.getLogger('db.storage')
+
+
+def open_storage(root):
+    """Open documents storage according to `storage_backend` option."""
+    if storage_backend.value == 'packed':
+        return PackedStorage(root)
+    return Storage(root)
+
+
+def decode_meta(raw):
+    """Decode property meta read by `Record.read()`."""
+    if raw is None:
+        return None
+    encoded, mtime = raw
+    meta = jsonlib.loads(encoded)
+    if mtime is not None:
+        meta['mtime'] = mtime
+    return meta
 
 
 class Storage(object):
@@ -27,6 +73,9 @@ class Storage(object):
 
     def __init__(self, root):
         self._root = root
+        self._wal = None
+        if storage_wal.value:
+            self._wal = _WriteAheadLog(join(root, _WAL_FILENAME), self._apply)
 
     def get(self, guid):
         """Get access to particular document's properties.
@@ -37,7 +86,7 @@ class Storage(object):
             `Record` object
 
         """
-        return Record(self._path(guid))
+        return Record(self._path(guid), self._wal)
 
     def delete(self, guid):
         """Remove document properties from the storage.
@@ -46,6 +95,10 @@ class Storage(object):
             document to remove
 
         """
+        if self._wal is not None:
+            self._wal.delete(guid)
+            # Make sure pending changes will not be replayed
+            self._wal.sync()
         path = self._path(guid)
         if not exists(path):
             return
@@ -61,6 +114,12 @@ class Storage(object):
             documents
 
         """
+        if self._wal is not None:
+            # Not yet materialized documents
+            for guid, guid_mtime in self._wal.walk():
+                if guid_mtime > mtime:
+                    yield guid
+
         if not exists(self._root):
             return
 
@@ -70,6 +129,9 @@ class Storage(object):
                     mtime and os.stat(guids_dir).st_mtime < mtime:
                 continue
             for guid in os.listdir(guids_dir):
+                if self._wal is not None and \
+                        'guid' in (self._wal.get(guid) or {}):
+                    continue
                 path = join(guids_dir, guid, 'guid')
                 if exists(path) and os.stat(path).st_mtime > mtime:
                     yield guid
@@ -77,6 +139,30 @@ class Storage(object):
     def migrate(self, guid):
         pass
 
+    def sync(self):
+        """Wait until all changes are on the disk."""
+        if self._wal is not None:
+            self._wal.sync()
+
+    def reopen(self):
+        """Reopen files after forking."""
+        pass
+
+    def close(self):
+        if self._wal is not None:
+            self._wal.close()
+            self._wal = None
+
+    def _apply(self, op, guid, *args):
+        if op == 'delete':
+            shutil.rmtree(self._path(guid), ignore_errors=True)
+            return
+        record = Record(self._path(guid))
+        if op == 'set':
+            record.write(*args)
+        else:
+            record.remove(*args)
+
     def _path(self, guid, *args):
         return join(self._root, guid[:2], guid, *args)
 
@@ -84,8 +170,9 @@ class Storage(object):
 class Record(object):
     """Interface to document data."""
 
-    def __init__(self, root):
+    def __init__(self, root, wal=None):
         self._root = root
+        self._wal = wal
 
     @property
     def guid(self):
@@ -93,36 +180,81 @@ class Record(object):
 
     @property
     def exists(self):
+        if self._wal is not None and self._wal.get(self.guid):
+            return True
         return exists(self._root)
 
     @property
     def consistent(self):
+        if self._wal is not None:
+            return self.get('guid') is not None
         return exists(join(self._root, 'guid'))
 
     def path(self, *args):
         return join(self._root, *args)
 
     def invalidate(self):
-        guid_path = join(self._root, 'guid')
-        if exists(guid_path):
-            os.unlink(guid_path)
+        self.unset('guid')
 
     def get(self, prop):
+        return decode_meta(self.read(prop))
+
+    def read(self, prop):
+        """Read encoded property meta.
+
+        :param prop:
+            property name
+        :returns:
+            (`encoded`, `mtime`) tuple, or, `None` if property does not
+            exist; `decode_meta()` restores the meta from it
+
+        """
+        if self._wal is not None:
+            changes = self._wal.get(self.guid)
+            if changes and prop in changes:
+                return changes[prop]
         path = join(self._root, prop)
         if not exists(path):
             return None
         with file(path) as f:
-            meta = json.load(f)
-        meta['mtime'] = int(os.stat(path).st_mtime)
-        return meta
+            encoded = f.read()
+        return encoded, int(os.stat(path).st_mtime)
+
+    def stat(self, prop):
+        """Cheap value that changes whenever property meta is changed."""
+        if self._wal is not None:
+            changes = self._wal.get(self.guid)
+            if changes and prop in changes:
+                return changes[prop]
+        try:
+            stat = os.stat(join(self._root, prop))
+        except OSError:
+            return None
+        # Files are being replaced on writing, thus, inode is changed too
+        return stat.st_ino, stat.st_mtime, stat.st_size
 
     def set(self, prop, mtime=None, **meta):
+        if self._wal is not None:
+            self._wal.set(self.guid, prop, meta, int(mtime or time.time()))
+        else:
+            self.write(prop, meta, mtime)
+
+    def unset(self, prop):
+        if self._wal is not None:
+            self._wal.unset(self.guid, prop)
+        else:
+            self.remove(prop)
+
+    def write(self, prop, meta, mtime=None, fsync=False):
         if not exists(self._root):
             os.makedirs(self._root)
         meta_path = join(self._root, prop)
 
         with toolkit.new_file(meta_path) as f:
-            json.dump(meta, f)
+            jsonlib.dump(meta, f)
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
         if mtime:
             os.utime(meta_path, (mtime, mtime))
 
@@ -133,7 +265,430 @@ class Record(object):
             # when index was not previously closed properly
             os.utime(join(self._root, '..'), (mtime, mtime))
 
-    def unset(self, prop):
+    def remove(self, prop):
         meta_path = join(self._root, prop)
         if exists(meta_path):
             os.unlink(meta_path)
+
+
+class PackedStorage(object):
+    """Keep all documents in one append-only segment file.
+
+    All properties of a document are packed into one record, thus, reading
+    document properties costs one seek and one read. Records are never
+    rewritten in place, the segment is being compacted on opening when
+    obsolete records take more space than actual ones.
+
+    """
+
+    def __init__(self, root):
+        self._root = root
+        self._path = join(root, _SEGMENT_FILENAME)
+        self._offsets = {}
+        self._garbage = 0
+        self._size = 0
+        self._reader = None
+        self._writer = None
+
+        if not exists(root):
+            os.makedirs(root)
+        self._load()
+        if [i for i in os.listdir(root) if isdir(join(root, i))]:
+            self._migrate()
+        if self._garbage > _COMPACT_THRESHOLD and \
+                self._garbage > self._size - self._garbage:
+            self.compact()
+
+    def get(self, guid):
+        """Get access to particular document's properties.
+
+        :param guid:
+            document GUID to get access to
+        :returns:
+            `PackedRecord` object
+
+        """
+        return PackedRecord(self, guid)
+
+    def delete(self, guid):
+        """Remove document properties from the storage.
+
+        :param guid:
+            document to remove
+
+        """
+        if guid in self._offsets:
+            self.write(guid, None, -1)
+
+    def walk(self, mtime):
+        """Generator function to enumerate all existing documents.
+
+        :param mtime:
+            return entities that were modified after `mtime`
+        :returns:
+            generator returns GUIDs of all found documents
+
+        """
+        # Iterate over a copy, the storage might be changed meanwhile
+        for guid, (__, __, guid_mtime) in self._offsets.items():
+            if guid_mtime > mtime:
+                yield guid
+
+    def migrate(self, guid):
+        pass
+
+    def sync(self):
+        """Wait until all changes are on the disk."""
+        pass
+
+    def reopen(self):
+        """Reopen files after forking.
+
+        Forked processes share file offsets with the parent, thus,
+        concurrent seeking and reading corrupts results.
+
+        """
+        self._reader.close()
+        self._reader = file(self._path, 'rb')
+
+    def position(self, guid):
+        return self._offsets.get(guid)
+
+    def read(self, pos):
+        """Read and decode packed record from the specified position."""
+        offset, length, __ = pos
+        self._reader.seek(offset)
+        return jsonlib.loads(self._reader.read(length))
+
+    def write(self, guid, props, guid_mtime):
+        """Append new packed record for the document.
+
+        :param props:
+            dictionary of JSON encoded property metas;
+            `None` to remove the document
+        :param guid_mtime:
+            mtime of the `guid` property, or, `-1` if the document
+            is not consistent yet
+
+        """
+        payload = '' if props is None else jsonlib.dumps(props)
+        header = '%s %s %s\n' % (guid, len(payload), guid_mtime)
+        self._writer.write(header + payload + '\n')
+        self._writer.flush()
+
+        pos = self._offsets.get(guid)
+        if pos is not None:
+            self._garbage += pos[1]
+        if props is None:
+            self._offsets.pop(guid, None)
+        else:
+            self._offsets[guid] = \
+                    (self._size + len(header), len(payload), guid_mtime)
+        self._size += len(header) + len(payload) + 1
+
+    def compact(self):
+        """Rewrite the segment file to leave only actual records."""
+        _logger.info('Compact %r, %s bytes of %s are obsolete',
+                self._path, self._garbage, self._size)
+
+        offsets = {}
+        size = 0
+        with toolkit.new_file(self._path) as f:
+            for guid, pos in self._offsets.items():
+                header = '%s %s %s\n' % (guid, pos[1], pos[2])
+                self._reader.seek(pos[0])
+                f.write(header + self._reader.read(pos[1]) + '\n')
+                offsets[guid] = (size + len(header), pos[1], pos[2])
+                size += len(header) + pos[1] + 1
+            f.flush()
+            os.fsync(f.fileno())
+
+        self._close_files()
+        self._offsets = offsets
+        self._size = size
+        self._garbage = 0
+        self._open_files()
+        self._save_index()
+
+    def close(self):
+        if self._writer is None:
+            return
+        self._save_index()
+        self._close_files()
+
+    def _load(self):
+        index_path = self._path + _INDEX_SUFFIX
+        if exists(index_path) and exists(self._path):
+            try:
+                with file(index_path) as f:
+                    index = jsonlib.load(f)
+                # Index written before the segment was replaced by
+                # `compact()` refers to another file, ignore it
+                if index.get('segment') == os.stat(self._path).st_ino and \
+                        index['size'] <= getsize(self._path):
+                    self._size = index['size']
+                    self._garbage = index['garbage']
+                    for guid, pos in index['offsets'].items():
+                        self._offsets[str(guid)] = tuple(pos)
+            except Exception:
+                _logger.exception('Cannot load %r index, will rescan',
+                        self._path)
+                self._offsets = {}
+                self._size = 0
+                self._garbage = 0
+
+        if exists(self._path):
+            # Pickup records appended after saving the index
+            with file(self._path, 'rb') as f:
+                f.seek(self._size)
+                self._scan(f)
+            if self._size < getsize(self._path):
+                _logger.warning('Truncate broken tail of %r', self._path)
+                with file(self._path, 'r+b') as f:
+                    f.truncate(self._size)
+
+        self._open_files()
+
+    def _scan(self, f):
+        while True:
+            header = f.readline()
+            if not header.endswith('\n'):
+                break
+            try:
+                guid, length, guid_mtime = header.split()
+                length = int(length)
+                guid_mtime = int(guid_mtime)
+            except ValueError:
+                break
+            f.seek(length, 1)
+            if f.read(1) != '\n':
+                break
+            pos = self._offsets.get(guid)
+            if pos is not None:
+                self._garbage += pos[1]
+            if length:
+                self._offsets[guid] = \
+                        (self._size + len(header), length, guid_mtime)
+            else:
+                self._offsets.pop(guid, None)
+            self._size += len(header) + length + 1
+
+    def _migrate(self):
+        _logger.info('Migrate %r documents to packed storage', self._root)
+
+        files = Storage(self._root)
+        for shard in os.listdir(self._root):
+            shard_path = join(self._root, shard)
+            if not isdir(shard_path):
+                continue
+            for guid in os.listdir(shard_path):
+                record = files.get(guid)
+                props = {}
+                for prop in os.listdir(record.path()):
+                    meta = record.get(prop)
+                    if meta is not None:
+                        props[prop] = jsonlib.dumps(meta)
+                guid_mtime = jsonlib.loads(props['guid'])['mtime'] \
+                        if 'guid' in props else -1
+                self.write(guid, props, guid_mtime)
+            os.fsync(self._writer.fileno())
+            shutil.rmtree(shard_path)
+
+        self._save_index()
+
+    def _save_index(self):
+        with toolkit.new_file(self._path + _INDEX_SUFFIX) as f:
+            jsonlib.dump({
+                'segment': os.fstat(self._writer.fileno()).st_ino,
+                'size': self._size,
+                'garbage': self._garbage,
+                'offsets': self._offsets,
+                }, f)
+
+    def _open_files(self):
+        self._writer = file(self._path, 'ab')
+        self._reader = file(self._path, 'rb')
+
+    def _close_files(self):
+        self._writer.close()
+        self._reader.close()
+        self._writer = None
+        self._reader = None
+
+
+class PackedRecord(object):
+    """Interface to document data packed into one record."""
+
+    def __init__(self, storage, guid):
+        self._storage = storage
+        self._guid = guid
+        self._pos = None
+        self._props = None
+
+    @property
+    def guid(self):
+        return self._guid
+
+    @property
+    def exists(self):
+        return self._storage.position(self._guid) is not None
+
+    @property
+    def consistent(self):
+        pos = self._storage.position(self._guid)
+        return pos is not None and pos[2] >= 0
+
+    def invalidate(self):
+        self.unset('guid')
+
+    def get(self, prop):
+        # Decode on demand to return new object all time
+        return decode_meta(self.read(prop))
+
+    def read(self, prop):
+        meta = self._snapshot().get(prop)
+        if meta is None:
+            return None
+        return meta, None
+
+    def stat(self, prop):
+        # Any change rewrites the whole record
+        return self._storage.position(self._guid)
+
+    def set(self, prop, mtime=None, **meta):
+        props = self._snapshot()
+        meta['mtime'] = int(mtime or time.time())
+        props[prop] = jsonlib.dumps(meta)
+        self._write(props)
+
+    def unset(self, prop):
+        props = self._snapshot()
+        if prop in props:
+            del props[prop]
+            self._write(props)
+
+    def _snapshot(self):
+        pos = self._storage.position(self._guid)
+        if pos is None:
+            self._props = {}
+        elif self._props is None or pos != self._pos:
+            self._props = self._storage.read(pos)
+        self._pos = pos
+        return self._props
+
+    def _write(self, props):
+        if 'guid' in props:
+            guid_mtime = jsonlib.loads(props['guid'])['mtime']
+        else:
+            guid_mtime = -1
+        self._storage.write(self._guid, props, guid_mtime)
+        self._pos = self._storage.position(self._guid)
+
+
+class _WriteAheadLog(object):
+    """Log property changes before creating property files.
+
+    Changes are being queued and appended to the log by a separate
+    coroutine, i.e., changes from all concurrent coroutines are being
+    flushed by one `fsync()` call. Property files are created only on
+    checkpoints, till that moment changes are being served from memory.
+    Not processed changes are replayed from the log on opening.
+
+    """
+
+    def __init__(self, path, apply_cb):
+        self._path = path
+        self._apply_cb = apply_cb
+        self._changes = {}
+        self._queue = []
+        self._flush_job = None
+        self._size = 0
+
+        if not exists(dirname(path)):
+            os.makedirs(dirname(path))
+        if exists(path):
+            self._replay()
+        self._fd = os.open(path,
+                os.O_WRONLY | os.O_APPEND | os.O_CREAT | os.O_TRUNC, 0644)
+
+    def get(self, guid):
+        return self._changes.get(guid)
+
+    def walk(self):
+        for guid, changes in self._changes.items():
+            if changes.get('guid'):
+                yield guid, changes['guid'][1]
+
+    def set(self, guid, prop, meta, mtime):
+        meta = jsonlib.dumps(meta)
+        self._changes.setdefault(guid, {})[prop] = (meta, mtime)
+        self._append(['set', guid, prop, meta, mtime])
+
+    def unset(self, guid, prop):
+        self._changes.setdefault(guid, {})[prop] = None
+        self._append(['unset', guid, prop])
+
+    def delete(self, guid):
+        self._changes.pop(guid, None)
+        self._append(['delete', guid])
+
+    def sync(self):
+        while self._flush_job is not None:
+            self._flush_job.join()
+
+    def checkpoint(self):
+        """Create property files for all pending changes."""
+        self.sync()
+        _logger.debug('Checkpoint %s documents from %r',
+                len(self._changes), self._path)
+        for guid, changes in self._changes.items():
+            for prop, change in changes.items():
+                if change is None:
+                    self._apply_cb('unset', guid, prop)
+                else:
+                    meta, mtime = change
+                    self._apply_cb('set', guid, prop, jsonlib.loads(meta),
+                            mtime, True)
+        self._changes.clear()
+        os.ftruncate(self._fd, 0)
+        self._size = 0
+
+    def close(self):
+        self.checkpoint()
+        os.close(self._fd)
+
+    def _append(self, entry):
+        self._queue.append(jsonlib.dumps(entry) + '\n')
+        if self._flush_job is None:
+            self._flush_job = coroutine.spawn(self._flush)
+
+    def _flush(self):
+        try:
+            # Let other coroutines queue their changes to write them at once
+            coroutine.dispatch()
+            while self._queue:
+                data = ''.join(self._queue)
+                del self._queue[:]
+                while data:
+                    written = os.write(self._fd, data)
+                    self._size += written
+                    data = data[written:]
+                os.fsync(self._fd)
+        finally:
+            self._flush_job = None
+        if self._size > _WAL_CHECKPOINT:
+            self.checkpoint()
+
+    def _replay(self):
+        _logger.info('Replay %r write-ahead log', self._path)
+        with file(self._path) as f:
+            for line in f:
+                try:
+                    entry = jsonlib.loads(line)
+                except ValueError:
+                    # Broken on crash
+                    break
+                if entry[0] == 'set':
+                    op, guid, prop, meta, mtime = entry
+                    entry = [op, guid, prop, jsonlib.loads(meta), mtime, True]
+                self._apply_cb(*entry)
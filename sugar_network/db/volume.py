@@ -87,6 +87,7 @@ class Volume(dict):
         while self:
             __, cls = self.popitem()
             cls.close()
+        self.blobs.close()
 
     def populate(self):
         for resource in self.resources:
@@ -95,6 +96,45 @@ class Volume(dict):
         for __ in self.blobs.populate():
             coroutine.dispatch()
 
+    def rebuild(self, jobs=1):
+        """Rebuild all indexes from scratch using several processes."""
+        # Open all directories in advance to not open them,
+        # and, their index writers, from child processes
+        for resource in self.resources:
+            self[resource]
+        for resource in self.resources:
+            self[resource].rebuild(jobs)
+
+    def compact(self):
+        """Compact all indexes."""
+        result = {}
+        for resource in self.resources:
+            result[resource] = self[resource].compact()
+        return result
+
+    def gc(self):
+        """Remove blobs that are not referenced from resources.
+
+        Reference counters of all blobs are being recalculated, should be
+        called only when there are no other writers.
+
+        :returns:
+            the number of freed bytes
+
+        """
+        refs = {}
+        for resource in self.resources:
+            directory = self[resource]
+            for doc in directory:
+                for prop in directory.metadata.values():
+                    meta = doc.meta(prop.name)
+                    if meta is None:
+                        continue
+                    for digest in prop.blobs(meta['value']):
+                        refs[digest] = refs.get(digest, 0) + 1
+            coroutine.dispatch()
+        return self.blobs.gc(refs)
+
     def broadcast(self, event):
         if not self.mute:
             if event['event'] == 'commit':
@@ -37,11 +37,13 @@ class Context(db.Resource):
                 ', '.join(model.TOP_CONTEXT_TYPES))
         return value
 
-    @db.indexed_property(db.Localized, slot=1, prefix='B', full_text=True)
+    @db.indexed_property(db.Localized, slot=1, prefix='B', full_text=True,
+            stored_in_index=True)
     def title(self, value):
         return value
 
-    @db.indexed_property(db.Localized, prefix='C', full_text=True)
+    @db.indexed_property(db.Localized, prefix='C', full_text=True,
+            stored_in_index=True)
     def summary(self, value):
         return value
 
@@ -115,8 +117,7 @@ class Context(db.Resource):
                     svg = f.read()
                 from sugar_network.toolkit.sugar import color_svg
                 svg = color_svg(svg, self['guid'])
-                self.post('artefact_icon',
-                        blobs.post(svg, 'image/svg+xml').digest)
+                self._post_icon('artefact_icon', svg, 'image/svg+xml')
                 break
         else:
             return
@@ -126,5 +127,9 @@ class Context(db.Resource):
                 ):
             if self[prop] != self.metadata[prop].default:
                 continue
-            png = blobs.post(svg_to_png(svg, size), 'image/png').digest
-            self.post(prop, png)
+            self._post_icon(prop, svg_to_png(svg, size), 'image/png')
+
+    def _post_icon(self, prop, content, mime_type):
+        digest = this.volume.blobs.post(content, mime_type).digest
+        # Typecasting counts the reference to the blob
+        self.post(prop, self.metadata[prop].typecast(digest))
@@ -41,7 +41,7 @@ class Post(db.Resource):
         return value
 
     @db.indexed_property(db.Localized, slot=1, prefix='D', full_text=True,
-            acl=ACL.CREATE | ACL.READ)
+            acl=ACL.CREATE | ACL.READ, stored_in_index=True)
     def title(self, value):
         return value
 
@@ -41,11 +41,13 @@ class MasterRoutes(NodeRoutes):
     def sync(self, accept_length):
         return packets.encode(self._push() + (self._pull() or []),
                 limit=accept_length, header={'from': self.guid},
+                compresslevel=this.cookie.get('compresslevel'),
                 on_complete=this.cookie.clear)
 
     @route('POST', cmd='push')
     def push(self):
-        return packets.encode(self._push(), header={'from': self.guid})
+        return packets.encode(self._push(), header={'from': self.guid},
+                compresslevel=this.cookie.get('compresslevel'))
 
     @route('GET', cmd='pull', arguments={'accept_length': int})
     def pull(self, accept_length):
@@ -53,7 +55,9 @@ class MasterRoutes(NodeRoutes):
         if reply is None:
             return None
         return packets.encode(reply, limit=accept_length,
-                header={'from': self.guid}, on_complete=this.cookie.clear)
+                header={'from': self.guid},
+                compresslevel=this.cookie.get('compresslevel'),
+                on_complete=this.cookie.clear)
 
     def status(self):
         result = NodeRoutes.status(self)
@@ -69,6 +73,13 @@ class MasterRoutes(NodeRoutes):
             sender = packet['from']
             enforce(packet['to'] == self.guid, http.BadRequest,
                     'Misaddressed packet')
+            compresslevel = packet['compresslevel']
+            if compresslevel is not None:
+                # Let senders choose how to compress replies, e.g.,
+                # to not compress over fast links or on weak clients
+                enforce(compresslevel in range(1, 10), http.BadRequest,
+                        'Compression level should be in [1, 9] range')
+                cookie['compresslevel'] = compresslevel
             if packet.name == 'push':
                 seqno, push_r = model.patch_volume(packet)
                 ack_r = [] if seqno is None else [[seqno, seqno]]
@@ -55,10 +55,11 @@ class _Release(object):
     _subcast = db.Dict()
 
     def typecast(self, value):
-        if isinstance(value, _ReleaseValue):
-            return value.guid, value
-        bundle = this.volume.blobs.post(value, this.request.content_type)
-        __, value = load_bundle(bundle, context=this.request.guid)
+        if not isinstance(value, _ReleaseValue):
+            bundle = this.volume.blobs.post(value, this.request.content_type)
+            __, value = load_bundle(bundle, context=this.request.guid)
+        for digest in self.blobs(value):
+            this.volume.blobs.ref(digest)
         return value.guid, value
 
     def reprcast(self, value):
@@ -73,6 +74,9 @@ class _Release(object):
                 this.volume.blobs.delete(bundle['blob'])
         # TODO Delete presolved files
 
+    def blobs(self, value):
+        return [i['blob'] for i in value.get('bundles', {}).values()]
+
 
 class Context(_context.Context):
 
@@ -125,8 +129,8 @@ def diff_volume(r, exclude=None, files=None, blobs=True, one_way=False):
             if one_way and directory.resource.one_way:
                 continue
             yield {'resource': resource}
-            for doc in directory.diff(r):
-                patch = doc.diff(include)
+            for doc, props in directory.diff(r):
+                patch = doc.diff(include, props=props)
                 if patch:
                     yield {'guid': doc.guid, 'patch': patch}
                     found = True
@@ -154,30 +158,22 @@ def diff_volume(r, exclude=None, files=None, blobs=True, one_way=False):
 
 
 def patch_volume(records, shift_seqno=True):
-    volume = this.volume
-    directory = None
     committed = []
     seqno = None if shift_seqno else False
+    records = iter(records)
 
-    for record in records:
-        if isinstance(record, File):
-            if seqno is None:
-                seqno = volume.seqno.next()
-            volume.blobs.patch(record, seqno or 0)
-            continue
-        resource = record.get('resource')
-        if resource:
-            directory = volume[resource]
-            continue
-        guid = record.get('guid')
-        if guid is not None:
-            seqno = directory.patch(guid, record['patch'], seqno)
-            continue
-        commit = record.get('commit')
-        if commit is not None:
-            ranges.include(committed, commit)
-            continue
-        raise http.BadRequest('Malformed patch')
+    directory = None
+    while True:
+        if directory is None:
+            seqno, resource = _patch_records(None, records, seqno, committed)
+        else:
+            # Index all resource patches in one transaction
+            with directory.bulk():
+                seqno, resource = \
+                        _patch_records(directory, records, seqno, committed)
+        if resource is None:
+            break
+        directory = this.volume[resource]
 
     return seqno, committed
 
@@ -402,6 +398,32 @@ def load_bundle(blob, context=None, initial=False, extra_deps=None,
     return context, release
 
 
+
+def _patch_records(directory, records, seqno, committed):
+    # Process records till the next resource header
+    volume = this.volume
+    for record in records:
+        if isinstance(record, File):
+            if seqno is None:
+                seqno = volume.seqno.next()
+            volume.blobs.patch(record, seqno or 0)
+            continue
+        resource = record.get('resource')
+        if resource:
+            return seqno, resource
+        guid = record.get('guid')
+        if guid is not None:
+            enforce(directory is not None, http.BadRequest,
+                    'Malformed patch')
+            seqno = directory.patch(guid, record['patch'], seqno)
+            continue
+        commit = record.get('commit')
+        if commit is not None:
+            ranges.include(committed, commit)
+            continue
+        raise http.BadRequest('Malformed patch')
+    return seqno, None
+
 def _load_context_metadata(bundle, spc):
     result = {}
     for prop in ('homepage', 'mime_types'):
@@ -25,11 +25,11 @@ from os.path import join, exists
 from sugar_network import db, toolkit
 from sugar_network.model import FrontRoutes
 from sugar_network.node import model, solver
-from sugar_network.toolkit.router import ACL, File, route
+from sugar_network.toolkit.router import ACL, File, RawJson, route
 from sugar_network.toolkit.router import fallbackroute, preroute, postroute
 from sugar_network.toolkit.spec import parse_version
 from sugar_network.toolkit.coroutine import this
-from sugar_network.toolkit import http, coroutine, ranges, enforce
+from sugar_network.toolkit import http, coroutine, ranges, jsonlib, enforce
 
 
 _GROUPED_DIFF_LIMIT = 1024
@@ -40,12 +40,14 @@ _logger = logging.getLogger('node.routes')
 
 class NodeRoutes(db.Routes, FrontRoutes):
 
-    def __init__(self, guid, auth=None, stats=None, **kwargs):
+    def __init__(self, guid, auth=None, stats=None, find_cache_size=0,
+            **kwargs):
         db.Routes.__init__(self, **kwargs)
         FrontRoutes.__init__(self)
         self._guid = guid
         self._auth = auth
         self._stats = stats
+        self._find_cache = toolkit.SizedCache(find_cache_size)
         self._batch_dir = join(this.volume.root, 'batch')
         self._repos = []
 
@@ -101,6 +103,32 @@ class NodeRoutes(db.Routes, FrontRoutes):
         this.response.headers['seqno'] = this.volume.seqno.value
         return result
 
+    def find(self, reply, limit, facets):
+        if this.principal is not None or not self._find_cache.limit:
+            return db.Routes.find(self, reply, limit, facets)
+
+        request = this.request
+        directory = this.volume[request.resource]
+        # `find()` populates the request with defaults, thus calculate
+        # the key in advance; revisions make keys of stale replies
+        # unreachable even before the commit event will purge them
+        revisions = self._revisions(directory, reply)
+        key = json.dumps([request.resource, revisions,
+            request.host, request.accept_language, self.find_limit,
+            sorted(request.items())])
+
+        cached = self._find_cache.get(key)
+        if cached is not None:
+            self._assert_etag(directory, reply)
+            return RawJson(cached[1])
+
+        body = jsonlib.dumps(db.Routes.find(self, reply, limit, facets))
+        resources = [request.resource]
+        if len(revisions) > 1:
+            resources.append('user')
+        self._find_cache.put(key, (resources, body), len(key) + len(body))
+        return RawJson(body)
+
     @route('GET', cmd='logon', acl=ACL.AUTH)
     def logon(self):
         pass
@@ -125,6 +153,9 @@ class NodeRoutes(db.Routes, FrontRoutes):
                     'releases': this.volume.release_seqno.value,
                     },
                 'os': self._repos,
+                'find_cache': self._find_cache.stats(),
+                'document_cache': dict([(name, directory.cache.stats())
+                    for name, directory in this.volume.items()]),
                 # TODO
                 'sugar': [
                     '0.82',
@@ -174,13 +205,15 @@ class NodeRoutes(db.Routes, FrontRoutes):
     def submit_release(self, initial):
         blob = this.volume.blobs.post(
                 this.request.content, this.request.content_type)
+        # Keep the bundle while loading it, the release counts its own
+        # reference to the blob
+        this.volume.blobs.ref(blob.digest)
         try:
             context, release = model.load_bundle(blob, initial=initial)
-        except Exception:
+            this.call(method='POST', path=['context', context, 'releases'],
+                    content_type='application/json', content=release)
+        finally:
             this.volume.blobs.delete(blob.digest)
-            raise
-        this.call(method='POST', path=['context', context, 'releases'],
-                content_type='application/json', content=release)
         return blob.digest
 
     @route('GET', ['context', None], cmd='solve',
@@ -229,14 +262,14 @@ class NodeRoutes(db.Routes, FrontRoutes):
         in_r = request.headers['ranges'] or [[1, None]]
         diff = {}
 
-        for doc in this.volume[request.resource].diff(in_r):
+        for doc, props in this.volume[request.resource].diff(in_r):
             out_r = diff.get(doc[key])
             if out_r is None:
                 if len(diff) >= _GROUPED_DIFF_LIMIT:
                     break
                 out_r = diff[doc[key]] = []
             ranges.include(out_r, doc['seqno'], doc['seqno'])
-            doc.diff(in_r, out_r)
+            doc.diff(in_r, out_r, props)
 
         return diff
 
@@ -280,5 +313,11 @@ class NodeRoutes(db.Routes, FrontRoutes):
                 self._repos = sugars['resolves']['value'].keys()
                 self._repos.sort()
 
+    def _broadcast(self, event):
+        if event.get('event') == 'commit' and 'resource' in event:
+            resource = event['resource']
+            self._find_cache.purge(lambda value: resource in value[0])
+        FrontRoutes._broadcast(self, event)
+
 
 this.principal = None
@@ -15,7 +15,6 @@
 
 import os
 import sys
-import json
 import errno
 import shutil
 import logging
@@ -25,6 +24,7 @@ from cStringIO import StringIO
 from os.path import exists, join, islink, isdir, dirname, basename, abspath
 from os.path import lexists, isfile
 
+from sugar_network.toolkit import jsonlib
 from sugar_network.toolkit.options import Option
 
 
@@ -522,7 +522,7 @@ class Bin(object):
     def commit(self):
         """Store current value in a file."""
         with new_file(self._path) as f:
-            json.dump(self.value, f)
+            jsonlib.dump(self.value, f)
             f.flush()
             os.fsync(f.fileno())
 
@@ -530,7 +530,7 @@ class Bin(object):
         if not exists(self._path):
             return False
         with file(self._path) as f:
-            self.value = json.load(f)
+            self.value = jsonlib.load(f)
         return True
 
     def __enter__(self):
@@ -648,6 +648,64 @@ class Pool(object):
         return str([i[1] for i in self._queue])
 
 
+class SizedCache(object):
+    """LRU cache limited by the size of its values in bytes."""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._items = collections.OrderedDict()
+
+    def get(self, key, default=None):
+        item = self._items.pop(key, None)
+        if item is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self._items[key] = item
+        return item[0]
+
+    def put(self, key, value, size):
+        self.pop(key)
+        if size > self.limit:
+            return
+        self._items[key] = (value, size)
+        self.size += size
+        while self.size > self.limit:
+            __, (__, size) = self._items.popitem(last=False)
+            self.size -= size
+
+    def pop(self, key):
+        item = self._items.pop(key, None)
+        if item is not None:
+            self.size -= item[1]
+
+    def clear(self):
+        self._items.clear()
+        self.size = 0
+
+    def purge(self, match):
+        """Drop all entries which values satisfy `match` callable."""
+        for key, (value, __) in self._items.items():
+            if match(value):
+                self.pop(key)
+
+    def stats(self):
+        requests = self.hits + self.misses
+        return {'size': self.size,
+                'limit': self.limit,
+                'entries': len(self._items),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': float(self.hits) / requests if requests else 0.,
+                }
+
+    def __len__(self):
+        return len(self._items)
+
+
 class _NullHandler(logging.Handler):
 
     def emit(self, record):
@@ -26,7 +26,8 @@ from os.path import join, abspath, exists, basename
 from gettext import gettext as _
 
 from sugar_network.toolkit import Option
-from sugar_network.toolkit import coroutine, printf, init_logging, enforce
+from sugar_network.toolkit import coroutine, jsonlib, printf, init_logging
+from sugar_network.toolkit import enforce
 
 
 INDENT_SIZE = 22
@@ -171,6 +172,8 @@ class Application(object):
             exit(0)
 
         init_logging(debug.value)
+        if jsonlib.json_codec.value:
+            jsonlib.use(jsonlib.json_codec.value)
 
     def prolog(self):
         pass
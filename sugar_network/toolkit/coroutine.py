@@ -126,11 +126,26 @@ def select(rlist, wlist, xlist, timeout=None):
     return gevent.select.select(rlist, wlist, xlist, timeout)
 
 
+def blocking_select(rlist, wlist, xlist, timeout=None):
+    """Original `select()` that blocks without switching to the hub.
+
+    Useful for forked processes that should not resume coroutines
+    inherited from the parent process.
+
+    """
+    from gevent import monkey
+    select_ = monkey.get_original('select', 'select')
+    return select_(rlist, wlist, xlist, timeout)
+
+
 def signal(*args, **kwargs):
     return gevent.signal(*args, **kwargs)
 
 
 def fork():
+    # Catch SIGCHLD before forking to not miss children that exit
+    # before starting watching them
+    gevent.get_hub().loop.install_sigchld()
     pid = os.fork()
     if pid:
         return _Child(pid)
@@ -184,6 +199,11 @@ def Queue(*args, **kwargs):
     return gevent.queue.Queue(*args, **kwargs)
 
 
+def ThreadPool(*args, **kwargs):
+    import gevent.threadpool
+    return gevent.threadpool.ThreadPool(*args, **kwargs)
+
+
 def Lock(*args, **kwargs):
     import gevent.lock
     return gevent.lock.Semaphore(*args, **kwargs)
@@ -82,6 +82,16 @@ class NotFound(Status):
     status_code = 404
 
 
+class RangeNotSatisfiable(StatusPass):
+
+    status = '416 Requested Range Not Satisfiable'
+    status_code = 416
+
+    def __init__(self, size):
+        StatusPass.__init__(self, 'Range is out of %s bytes' % size)
+        self.headers = {'content-range': 'bytes */%s' % size}
+
+
 class BadGateway(Status):
 
     status = '502 Bad Gateway'
@@ -0,0 +1,128 @@
+# Copyright (C) 2014 Aleksey Lim
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""JSON codec that uses the fastest available implementation.
+
+Encoders are accepted only if their output is identical to what the
+standard `json` module produces, since encoded values are being stored
+on disk and being sent in sync packets. Decoders should return the same
+objects as `json.loads()` does.
+
+"""
+
+import json
+import logging
+
+from sugar_network.toolkit.options import Option
+
+
+#: Supported implementations in order of preference
+IMPLEMENTATIONS = ['ujson', 'simplejson', 'json']
+
+json_codec = Option(
+        'JSON implementation to encode and decode stored and sent values, '
+        'one of "ujson", "simplejson" or "json"; if omitted, the fastest '
+        'compatible one will be used')
+
+#: Name of the implementation `dumps()` uses
+encoder = 'json'
+
+#: Name of the implementation `loads()` uses
+decoder = 'json'
+
+#: Encode value to JSON string
+dumps = json.dumps
+
+#: Decode JSON string
+loads = json.loads
+
+_PROBE = [u'\u0444', 'a"\\\n\t/', 1, -2, 0.1, 1e100, True, False, None,
+        [], {}, {'key': [{'value': 1}]}]
+
+_logger = logging.getLogger('jsonlib')
+
+
+def dump(value, f):
+    f.write(dumps(value))
+
+
+def load(f):
+    return loads(f.read())
+
+
+def use(name=None):
+    """Switch to particular JSON implementation.
+
+    :param name:
+        implementation name from `IMPLEMENTATIONS`; if omitted,
+        the fastest compatible one will be used
+
+    """
+    global encoder, decoder, dumps, loads
+
+    names = IMPLEMENTATIONS if name is None else [name, 'json']
+    encoder = decoder = None
+    for i in names:
+        codecs = _import(i)
+        if codecs is None:
+            continue
+        dumps_, loads_ = codecs
+        if encoder is None and _probe_dumps(dumps_):
+            encoder = i
+            dumps = dumps_
+        if decoder is None and _probe_loads(loads_):
+            decoder = i
+            loads = loads_
+
+    _logger.debug('Use %r JSON encoder and %r decoder', encoder, decoder)
+
+
+def _import(name):
+    try:
+        if name == 'ujson':
+            import ujson
+
+            def loads_(value):
+                return ujson.loads(value, precise_float=True)
+
+            return ujson.dumps, loads_
+        elif name == 'simplejson':
+            import simplejson
+            # Pure Python implementation is slower than `json` one
+            from simplejson import _speedups
+            return simplejson.dumps, simplejson.loads
+        elif name == 'json':
+            return json.dumps, json.loads
+    except ImportError:
+        return None
+    _logger.warning('Unknown %r JSON implementation', name)
+
+
+def _probe_dumps(dumps_):
+    try:
+        return dumps_(_PROBE) == json.dumps(_PROBE)
+    except Exception:
+        return False
+
+
+def _probe_loads(loads_):
+    value = json.dumps(_PROBE)
+    try:
+        return repr(loads_(value)) == repr(json.loads(value))
+    except Exception:
+        return False
+
+
+use()
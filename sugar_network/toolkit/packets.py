@@ -19,16 +19,18 @@ import os
 import sys
 import zlib
 import time
-import json
 import struct
 import hashlib
 import logging
+import multiprocessing
+from collections import deque
 from types import GeneratorType
 from os.path import dirname, exists, join
 
 from sugar_network import toolkit
 from sugar_network.toolkit.router import File
-from sugar_network.toolkit import http, coroutine, BUFFER_SIZE, enforce
+from sugar_network.toolkit import http, coroutine, jsonlib, BUFFER_SIZE
+from sugar_network.toolkit import enforce
 
 
 DEFAULT_COMPRESSLEVEL = 6
@@ -39,6 +41,28 @@ _RESERVED_DISK_SPACE = 1024 * 1024
 _ZLIB_WBITS = 15
 _ZLIB_WBITS_SIZE = 32768    # 2 ** 15
 
+#: Size of independently compressed pieces of zipped packets
+_ZIP_CHUNK_SIZE = 1024 * 256
+_ZIP_THREADS = multiprocessing.cpu_count()
+# Empty deflate block with BFINAL bit set
+_ZIP_FINAL_BLOCK = '\003\000'
+
+#: Content types that are not worth compressing
+_INCOMPRESSIBLE_TYPES = frozenset([
+    'application/vnd.olpc-sugar',
+    'application/zip',
+    'application/gzip',
+    'application/x-gzip',
+    'application/x-bzip2',
+    'application/x-xz',
+    'application/x-7z-compressed',
+    'image/png',
+    'image/jpeg',
+    'image/gif',
+    ])
+
+_zip_threads = None
+
 _logger = logging.getLogger('packets')
 
 
@@ -109,9 +133,12 @@ def encode(items, limit=None, header=None, compresslevel=None,
                         record = next(content)
                         continue
                     blob_len = 0
+                    compress = True
                     if isinstance(record, File):
                         blob_len = record.size
                         chunk = record.meta
+                        compress = \
+                                _compressible(chunk.get('content-type'))
                         if not record.path:
                             chunk['digest'] = record.digest
                     else:
@@ -139,7 +166,7 @@ def encode(items, limit=None, header=None, compresslevel=None,
                             blob_len -= len(chunk)
                             if not blob_len:
                                 chunk += '\n'
-                            chunk = ostream.write(chunk)
+                            chunk = ostream.write(chunk, compress)
                             if chunk:
                                 yield chunk
                         enforce(blob_len == 0, EOFError, 'Blob size mismatch')
@@ -292,12 +319,12 @@ class _Encoder(object):
         self._offset = 0
 
     def write_record(self, record, limit=None):
-        chunk = json.dumps(record) + '\n'
+        chunk = jsonlib.dumps(record) + '\n'
         if limit is not None and self._offset + len(chunk) > limit:
             return None
         return self.write(chunk)
 
-    def write(self, chunk):
+    def write(self, chunk, compress=True):
         chunk = self._encode(chunk)
         if chunk:
             self._offset += len(chunk)
@@ -316,64 +343,114 @@ class _Encoder(object):
 
 
 class _ZippedEncoder(_Encoder):
+    """Gzip encoder that compresses data in native threads.
+
+    Data is being compressed by independent pieces that end with
+    `Z_SYNC_FLUSH`, and incompressible data is being written as deflate
+    stored blocks in between. Such a stream is still a regular gzip
+    stream with one member.
+
+    """
 
     def __init__(self, compresslevel=None):
         _Encoder.__init__(self)
         if compresslevel is None:
             compresslevel = DEFAULT_COMPRESSLEVEL
-        self._zipper = zlib.compressobj(compresslevel,
-                zlib.DEFLATED, -_ZLIB_WBITS, zlib.DEF_MEM_LEVEL, 0)
+        self._compresslevel = compresslevel
         self._size = 0
         self._crc = zlib.crc32('') & 0xffffffffL
-
-    def _encode(self, chunk):
+        self._pending = []
+        self._pending_size = 0
+        # (uncompressed size, compressed data or async result) tuples
+        self._jobs = deque()
+        self._header = '\037\213' + '\010' + chr(0) + \
+                struct.pack('<L', long(time.time())) + \
+                '\002' + '\377'
+        # Reserve space for not yet flushed compressed data
+        self._offset = _ZLIB_WBITS_SIZE
+
+    def write(self, chunk, compress=True):
         self._size += len(chunk)
         self._crc = zlib.crc32(chunk, self._crc) & 0xffffffffL
-        chunk = self._zipper.compress(chunk)
-        if self._offset == 0:
-            chunk = '\037\213' + '\010' + chr(0) + \
-                    struct.pack('<L', long(time.time())) + \
-                    '\002' + '\377' + \
-                    chunk
-            self._offset = _ZLIB_WBITS_SIZE
-        return chunk
+        # Until compressed, data is being counted by its original size
+        self._offset += len(chunk)
+        if compress:
+            self._pending.append(chunk)
+            self._pending_size += len(chunk)
+            if self._pending_size >= _ZIP_CHUNK_SIZE:
+                self._deflate()
+        else:
+            self._deflate()
+            self._jobs.append((len(chunk), _store(chunk)))
+        return self._collect(_ZIP_THREADS)
 
-    def _flush(self):
-        return self._zipper.flush() + \
+    def flush(self):
+        self._deflate()
+        return self._collect(0) + _ZIP_FINAL_BLOCK + \
                 struct.pack('<L', self._crc) + \
                 struct.pack('<L', self._size & 0xffffffffL)
 
+    def _deflate(self):
+        if not self._pending:
+            return
+        data = ''.join(self._pending)
+        self._jobs.append((len(data),
+                _threads().spawn(_deflate, data, self._compresslevel)))
+        self._pending = []
+        self._pending_size = 0
+
+    def _collect(self, max_jobs):
+        result = []
+        if self._header:
+            result.append(self._header)
+            self._header = None
+        while self._jobs:
+            size, chunk = self._jobs[0]
+            if type(chunk) is not str:
+                if not chunk.ready() and len(self._jobs) <= max_jobs:
+                    break
+                chunk = chunk.get()
+            self._jobs.popleft()
+            self._offset += len(chunk) - size
+            result.append(chunk)
+        return ''.join(result)
+
 
 class _Decoder(object):
 
     def __init__(self, prefix, stream, limit):
-        self._buffer = prefix
+        # Data before `_pos` is already processed, the buffer is being
+        # compacted only on consuming to not copy pending data all time
+        self._buffer = bytearray(prefix)
+        self._pos = 0
         self._stream = stream
         self._limit = limit
         self._eof = False
 
     def read_record(self):
+        scanned = self._pos
         while True:
-            parts = self._buffer.split('\n', 1)
-            if len(parts) == 1:
+            end = self._buffer.find('\n', scanned)
+            if end == -1:
+                scanned = len(self._buffer)
                 if self._read(BUFFER_SIZE) and not self._eof:
                     continue
-                result = parts[0]
-                self._buffer = ''
-            else:
-                result, self._buffer = parts
+                end = len(self._buffer)
+            result = str(self._buffer[self._pos:end])
+            self._consume(end + 1)
+            scanned = self._pos
             if not result:
                 if self._eof:
                     return None
                 continue
-            return json.loads(result)
+            return jsonlib.loads(result)
 
     def read(self, size):
-        while len(self._buffer) == 0 and self._read(size):
+        while len(self._buffer) == self._pos and self._read(size):
             pass
-        size = min(size, len(self._buffer))
-        result = self._buffer[:size]
-        self._buffer = self._buffer[size:]
+        end = min(self._pos + size, len(self._buffer))
+        result = str(self._buffer[self._pos:end])
+        self._consume(end)
         return result
 
     def _read(self, size):
@@ -388,7 +465,19 @@ class _Decoder(object):
 
     def _decode(self, chunk):
         self._buffer += chunk
-        return bool(self._buffer)
+        return len(self._buffer) > self._pos
+
+    def _consume(self, pos):
+        size = len(self._buffer)
+        if pos >= size:
+            self._buffer = bytearray()
+            self._pos = 0
+        elif pos >= size - pos:
+            # Compacting costs not more than consumed data processing
+            del self._buffer[:pos]
+            self._pos = 0
+        else:
+            self._pos = pos
 
 
 class _ZippedDecoder(_Decoder):
@@ -426,3 +515,32 @@ class _ZippedDecoder(_Decoder):
         self._crc = zlib.crc32(chunk, self._crc) & 0xffffffffL
         self._size += len(chunk)
         return True
+
+
+def _compressible(mime_type):
+    if not mime_type:
+        return True
+    return mime_type not in _INCOMPRESSIBLE_TYPES and \
+            mime_type.split('/')[0] not in ('audio', 'video')
+
+
+def _deflate(data, compresslevel):
+    zipper = zlib.compressobj(compresslevel,
+            zlib.DEFLATED, -_ZLIB_WBITS, zlib.DEF_MEM_LEVEL, 0)
+    return zipper.compress(data) + zipper.flush(zlib.Z_SYNC_FLUSH)
+
+
+def _store(data):
+    blocks = []
+    for offset in xrange(0, len(data), 0xffff):
+        block = data[offset:offset + 0xffff]
+        blocks.append(struct.pack('<BHH', 0, len(block), len(block) ^ 0xffff))
+        blocks.append(block)
+    return ''.join(blocks)
+
+
+def _threads():
+    global _zip_threads
+    if _zip_threads is None:
+        _zip_threads = coroutine.ThreadPool(_ZIP_THREADS)
+    return _zip_threads
@@ -19,6 +19,7 @@ import json
 import types
 import logging
 import calendar
+import itertools
 from base64 import b64decode, b64encode
 from bisect import bisect_left
 from urllib import urlencode
@@ -29,10 +30,11 @@ from os.path import isfile, basename, exists
 
 from sugar_network import toolkit
 from sugar_network.toolkit.coroutine import this
-from sugar_network.toolkit import i18n, http, coroutine, enforce
+from sugar_network.toolkit import i18n, http, coroutine, jsonlib, enforce
 
 
 _NOT_SET = object()
+_ANY_CMD = object()
 
 _logger = logging.getLogger('router')
 
@@ -278,6 +280,19 @@ class Request(dict):
                 self._if_modified_since = 0
         return self._if_modified_since
 
+    @property
+    def if_none_match(self):
+        value = self.environ.get('HTTP_IF_NONE_MATCH')
+        if not value:
+            return []
+        result = []
+        for tag in value.split(','):
+            tag = tag.strip()
+            if tag.startswith('W/'):
+                tag = tag[2:]
+            result.append(tag)
+        return result
+
     @property
     def accept_language(self):
         if self._accept_language is _NOT_SET:
@@ -438,6 +453,14 @@ class File(str):
                 yield chunk
 
 
+class RawJson(str):
+    """Reply that is already encoded to JSON.
+
+    HTTP clients get it as is, internal `call()` users get it decoded.
+
+    """
+
+
 class Router(object):
 
     def __init__(self, routes_model, allow_spawn=False, default_api=None):
@@ -457,6 +480,12 @@ class Router(object):
         this.call = self.call
 
     def call(self, request=None, response=None, environ=None, **kwargs):
+        result = self._call(request, response, environ, **kwargs)
+        if isinstance(result, RawJson):
+            result = jsonlib.loads(result)
+        return result
+
+    def _call(self, request=None, response=None, environ=None, **kwargs):
         if request is None:
             if this.request is not None:
                 if not environ:
@@ -490,14 +519,12 @@ class Router(object):
                 _logger.exception('Failed to typecast content')
                 raise http.BadRequest('Malformed content')
 
-        for arg, cast in route_.arguments.items():
+        for arg, cast, default in route_.casters:
             value = request.get(arg)
             if value is None:
-                if not hasattr(cast, '__call__'):
-                    request[arg] = cast
+                if default is not _NOT_SET:
+                    request[arg] = default
                 continue
-            if not hasattr(cast, '__call__'):
-                cast = type(cast)
             try:
                 request[arg] = _typecast(cast, value)
             except Exception, error:
@@ -541,6 +568,7 @@ class Router(object):
             js_callback = request.pop('callback')
 
         content = None
+        file_stream = None
         try:
             if 'HTTP_ORIGIN' in request.environ:
                 enforce(self._assert_origin(request.environ), http.Forbidden,
@@ -549,7 +577,7 @@ class Router(object):
                 response['Access-Control-Allow-Origin'] = \
                         request.environ['HTTP_ORIGIN']
 
-            result = self.call(request, response)
+            result = self._call(request, response)
 
             if isinstance(result, File):
                 enforce(result is not File.AWAY, http.NotFound, 'No such file')
@@ -560,9 +588,30 @@ class Router(object):
                 if request.if_modified_since and \
                         result.mtime <= request.if_modified_since:
                     raise http.NotModified()
-                result = file(result.path, 'rb')
-
-            if not hasattr(result, 'read'):
+                size = os.stat(result.path).st_size
+                response['accept-ranges'] = 'bytes'
+                r = None
+                if _if_range(request.environ.get('HTTP_IF_RANGE'),
+                        response.get('etag'), result.mtime):
+                    r = _parse_range(request.environ.get('HTTP_RANGE'), size)
+                if r is None:
+                    response.content_length = size
+                else:
+                    start, end = r
+                    response.status = '206 Partial Content'
+                    response['content-range'] = \
+                            'bytes %s-%s/%s' % (start, end, size)
+                    response.content_length = end - start + 1
+                if request.method != 'HEAD':
+                    stream = file(result.path, 'rb')
+                    if r is None:
+                        content = _stream_reader(stream)
+                        file_stream = stream
+                    else:
+                        stream.seek(start)
+                        content = _stream_reader(stream,
+                                response.content_length)
+            elif not hasattr(result, 'read'):
                 content = result
             else:
                 if hasattr(result, 'fileno'):
@@ -591,14 +640,31 @@ class Router(object):
                 response.content_type = 'application/json'
 
         streamed_content = isinstance(content, types.GeneratorType)
-        if js_callback or response.content_type == 'application/json':
+        if request.method == 'HEAD':
+            pass
+        elif js_callback or response.content_type == 'application/json':
             if streamed_content:
                 content = ''.join(content)
                 streamed_content = False
+            elif isinstance(content, RawJson):
+                content = str(content)
             else:
-                content = json.dumps(content)
+                content = _json_stream(content)
+                # Small replies go at once, the rest is being streamed
+                # with chunked transfer encoding
+                chunk = next(content, '')
+                tail = next(content, None)
+                if tail is None:
+                    content = chunk
+                else:
+                    streamed_content = True
+                    content = itertools.chain([chunk, tail], content)
             if js_callback:
-                content = '%s(%s);' % (js_callback, content)
+                if streamed_content:
+                    content = itertools.chain(['%s(' % js_callback],
+                            content, [');'])
+                else:
+                    content = '%s(%s);' % (js_callback, content)
         if request.method == 'HEAD':
             streamed_content = False
             content = None
@@ -609,6 +675,15 @@ class Router(object):
                 self, request.environ, response)
         start_response(response.status, response.items())
 
+        if streamed_content and file_stream is not None and \
+                'wsgi.file_wrapper' in request.environ and \
+                response.content_type != 'text/event-stream':
+            # Let the server send the file on its own, e.g., via sendfile()
+            return request.environ['wsgi.file_wrapper'](
+                    file_stream, toolkit.BUFFER_SIZE)
+        return self._reply(request, response, content, streamed_content)
+
+    def _reply(self, request, response, content, streamed_content):
         if streamed_content:
             if response.content_type == 'text/event-stream':
                 for event in _event_stream(request, content):
@@ -684,10 +759,14 @@ class _ContentStream(object):
         return result
 
 
-def _stream_reader(stream):
+def _stream_reader(stream, length=None):
     try:
-        while True:
-            chunk = stream.read(toolkit.BUFFER_SIZE)
+        while length is None or length > 0:
+            size = toolkit.BUFFER_SIZE
+            if length is not None:
+                size = min(size, length)
+                length -= size
+            chunk = stream.read(size)
             if not chunk:
                 break
             yield chunk
@@ -696,6 +775,56 @@ def _stream_reader(stream):
             stream.close()
 
 
+def _parse_range(value, size):
+    """Parse `Range` header value for a file of `size` bytes.
+
+    Only single byte ranges are supported, requests for multiple ranges
+    are being served as regular ones.
+
+    :returns:
+        a tuple of the first and the last bytes positions,
+        or `None` if the whole file should be served
+
+    """
+    if not value:
+        return None
+    unit, __, spec = value.partition('=')
+    if unit.strip() != 'bytes' or ',' in spec:
+        return None
+    start, __, end = spec.strip().partition('-')
+    try:
+        if not start:
+            # Suffix range, i.e., the last bytes
+            start = max(0, size - int(end))
+            end = size - 1
+        else:
+            start = int(start)
+            end = min(int(end), size - 1) if end else size - 1
+    except ValueError:
+        return None
+    if start > end or start >= size:
+        raise http.RangeNotSatisfiable(size)
+    return start, end
+
+
+def _if_range(value, etag, mtime):
+    """Check if `If-Range` header value lets serve partial content.
+
+    :returns:
+        `True` if the header is absent or if the validator matches
+        the current file, otherwise the whole file should be served
+
+    """
+    if not value:
+        return True
+    value = value.strip()
+    if value.startswith('"') or value.startswith('W/'):
+        # Weak tags never match
+        return value == etag
+    value = parsedate(value)
+    return value is not None and mtime <= calendar.timegm(value)
+
+
 def _event_stream(request, stream):
     try:
         for event in stream:
@@ -714,6 +843,59 @@ def _event_stream(request, stream):
         _logger.debug('Event stream %r exited', request)
 
 
+def _json_stream(value):
+    """Encode JSON value by chunks of `BUFFER_SIZE` bytes.
+
+    Values of top-level dictionaries and lists are encoded one by one
+    to not keep the whole encoded reply in memory. The output is the same
+    as `json.dumps()` returns.
+
+    """
+    chunks = []
+    size = 0
+    for chunk in _json_iterencode(value, True):
+        chunks.append(chunk)
+        size += len(chunk)
+        if size >= toolkit.BUFFER_SIZE:
+            yield ''.join(chunks)
+            chunks = []
+            size = 0
+    if chunks:
+        yield ''.join(chunks)
+
+
+def _json_iterencode(value, toplevel=False):
+    if isinstance(value, dict):
+        yield '{'
+        delimiter = ''
+        for key, item in value.iteritems():
+            if isinstance(key, basestring):
+                key = json.dumps(key)
+            else:
+                # Let `json` coerce non-string keys on its own
+                key = json.dumps({key: None})[1:-7]
+            yield delimiter
+            yield key
+            yield ': '
+            if toplevel:
+                for chunk in _json_iterencode(item):
+                    yield chunk
+            else:
+                yield jsonlib.dumps(item)
+            delimiter = ', '
+        yield '}'
+    elif isinstance(value, (list, tuple, types.GeneratorType)):
+        yield '['
+        delimiter = ''
+        for item in value:
+            yield delimiter
+            yield jsonlib.dumps(item)
+            delimiter = ', '
+        yield ']'
+    else:
+        yield jsonlib.dumps(value)
+
+
 def _typecast(cast, value):
     if cast is list or cast is tuple:
         if isinstance(value, basestring):
@@ -825,8 +1007,16 @@ class _Route(object):
         self.acl = acl
         self.typecast = typecast
         self.arguments = arguments or {}
+        self.casters = []
         self.kwarg_names = []
 
+        for arg, cast in self.arguments.items():
+            if hasattr(cast, '__call__'):
+                self.casters.append((arg, cast, _NOT_SET))
+            else:
+                # Not callable value is a default for missed argument
+                self.casters.append((arg, type(cast), cast))
+
         if hasattr(callback, 'im_func'):
             callback = callback.im_func
         if hasattr(callback, 'func_code'):
@@ -924,38 +1114,91 @@ class _Api(object):
                 processed.add(name)
             cls = cls.__base__
 
+        self._compile()
+
     def resolve_route(self, request):
-        found_path = [False]
-
-        def resolve_path(routes, path):
-            if not path:
-                if routes.ops:
-                    found_path[0] = True
-                return routes.ops.get((request.method, request.cmd)) or \
-                       routes.fallback_ops.get((request.method, None)) or \
-                       routes.fallback_ops.get((None, None))
-            subroutes = routes.get(path[0])
-            if subroutes is None:
-                route_ = routes.fallback_ops.get((request.method, None)) or \
-                        routes.fallback_ops.get((None, None))
-                if route_ is not None:
-                    return route_
-            for subroutes in (subroutes, routes.wildcards):
-                if subroutes is None:
-                    continue
-                route_ = resolve_path(subroutes, path[1:])
-                if route_ is not None:
+        path = request.path
+        size = min(len(path), self._max_size)
+        candidates = self._table.get((request.method, size, request.cmd))
+        if candidates is None:
+            candidates = self._table.get((request.method, size, _ANY_CMD))
+            if candidates is None:
+                candidates = self._table[None, size, _ANY_CMD]
+
+        for checks, depth, children, route_ in candidates:
+            for i, part in checks:
+                if path[i] != part:
+                    break
+            else:
+                if children is None or path[depth] not in children:
                     return route_
 
-        route_ = resolve_path(self._routes, request.path) or \
-                self._routes.fallback_ops.get((request.method, None)) or \
-                self._routes.fallback_ops.get((None, None))
-        if route_ is None:
-            if found_path[0]:
-                raise http.BadRequest('No such operation')
+        for checks in self._op_paths.get(len(path), ()):
+            for i, part in checks:
+                if path[i] != part:
+                    break
             else:
-                raise http.NotFound('Path not found')
-        return route_
+                raise http.BadRequest('No such operation')
+        raise http.NotFound('Path not found')
+
+    def _compile(self):
+        # Flatten the routes tree to per (method, path size, cmd) lists of
+        # candidates in the order of the tree walking, i.e., routes of a
+        # node, its fallbacks, literal subroutes, and wildcard subroutes;
+        # the first matched candidate is the resolved route
+        entries = []
+        self._op_paths = {}
+        self._max_size = 0
+
+        def walk(routes, pattern):
+            depth = len(pattern)
+            checks = tuple([(i, part) for i, part in enumerate(pattern)
+                    if part is not None])
+            self._max_size = max(self._max_size, depth + 1)
+            if routes.ops:
+                self._op_paths.setdefault(depth, []).append(checks)
+            for op, route_ in routes.ops.items():
+                entries.append((op, False, checks, depth, None, route_))
+            fallbacks = sorted(routes.fallback_ops.items(),
+                    key=lambda x: x[0][0] is None)
+            for op, route_ in fallbacks:
+                entries.append((op, True, checks, depth, None, route_))
+            for op, route_ in fallbacks:
+                entries.append((op, True, checks, depth,
+                        frozenset(routes.keys()), route_))
+            for part, subroutes in routes.items():
+                walk(subroutes, pattern + [part])
+            if routes.wildcards is not None:
+                walk(routes.wildcards, pattern + [None])
+
+        walk(self._routes, [])
+
+        keys = set([(None, _ANY_CMD)])
+        for (method, cmd), __, __, __, __, __ in entries:
+            keys.add((method, _ANY_CMD))
+            if method is not None:
+                keys.add((method, cmd))
+
+        self._table = {}
+        for method, cmd in keys:
+            for size in range(self._max_size + 1):
+                candidates = self._table[method, size, cmd] = []
+                for op, fallback, checks, depth, children, route_ in entries:
+                    if fallback:
+                        if op[0] not in (method, None):
+                            continue
+                    elif op != (method, cmd):
+                        continue
+                    if children is None:
+                        if depth != size:
+                            continue
+                    elif depth >= size:
+                        continue
+                    candidates.append((checks, depth, children, route_))
+                for op in [(method, None), (None, None)]:
+                    route_ = self._routes.fallback_ops.get(op)
+                    if route_ is not None:
+                        candidates.append(((), 0, None, route_))
 
 
 File.AWAY = File(None)
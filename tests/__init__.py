@@ -94,8 +94,14 @@ class Test(unittest.TestCase):
         Option._config_to_save = None
         db.index_flush_timeout.value = 0
         db.index_flush_threshold.value = 1
+        db.storage_backend.value = 'files'
+        db.storage_wal.value = False
+        db.document_cache_size.value = db.document_cache_size.default
         self.master_url = 'http://127.0.0.1:7777'
         db.index_write_queue.value = 10
+        db.index_query_cache.value = 256
+        db.index_shards.value = 1
+        db.index_compact_hour.value = -1
         client.local_root.value = tmpdir
         client.api.value = 'http://127.0.0.1:7777'
         client.mounts_root.value = None
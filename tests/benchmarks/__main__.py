@@ -0,0 +1,10 @@
+# sugar-lint: disable
+
+from __init__ import tests
+
+from router import *
+from jsonlib import *
+from packets import *
+
+if __name__ == '__main__':
+    tests.main()
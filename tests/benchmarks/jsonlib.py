@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# sugar-lint: disable
+
+import time
+import random
+
+from __init__ import tests
+
+from sugar_network.toolkit import jsonlib
+
+
+ROUNDS = 5
+
+
+class JsonlibBenchmark(tests.Test):
+
+    def tearDown(self):
+        jsonlib.use()
+        tests.Test.tearDown(self)
+
+    def test_SyncRecords(self):
+        records = _sync_records(5000)
+        encoded = [jsonlib.dumps(i) for i in records]
+
+        print
+        for name in jsonlib.IMPLEMENTATIONS:
+            jsonlib.use(name)
+            if name not in (jsonlib.encoder, jsonlib.decoder):
+                print '%s: not available or not compatible' % name
+                continue
+
+            ts = time.time()
+            for __ in xrange(ROUNDS):
+                for i in records:
+                    jsonlib.dumps(i)
+            dumps_time = (time.time() - ts) / ROUNDS
+
+            ts = time.time()
+            for __ in xrange(ROUNDS):
+                for i in encoded:
+                    jsonlib.loads(i)
+            loads_time = (time.time() - ts) / ROUNDS
+
+            print '%s: encoder=%s %.3fs, decoder=%s %.3fs' % (name,
+                    jsonlib.encoder, dumps_time, jsonlib.decoder, loads_time)
+
+
+def _sync_records(count):
+    # Records the way they are written to sync packets by `diff()`
+    rnd = random.Random(0)
+    records = [{'resource': 'context'}]
+    for seqno in xrange(1, count + 1):
+        guid = '%032x' % rnd.getrandbits(128)
+        mtime = 1400000000 + seqno
+        records.append({'guid': guid, 'patch': {
+            'guid': {'value': guid, 'mtime': mtime},
+            'type': {'value': ['activity'], 'mtime': mtime},
+            'title': {'value': {'en': 'Title %s' % seqno, 'es': u'T\xedtulo'},
+                'mtime': mtime},
+            'summary': {'value': {'en': 'summary ' * 16}, 'mtime': mtime},
+            'author': {'value': {guid: {'name': 'user', 'role': 3,
+                'order': 0}}, 'mtime': mtime},
+            'tags': {'value': ['tag1', 'tag2'], 'mtime': mtime},
+            'rating': {'value': [seqno % 5, seqno], 'mtime': mtime},
+            'ctime': {'value': mtime, 'mtime': mtime},
+            }})
+    records.append({'commit': [[1, count]]})
+    return records
+
+
+if __name__ == '__main__':
+    tests.main()
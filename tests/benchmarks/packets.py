@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# sugar-lint: disable
+
+import os
+import time
+
+from __init__ import tests
+
+from sugar_network.toolkit.router import File
+from sugar_network.toolkit import packets
+
+
+#: Size of the packet to decode in megabytes
+PACKET_SIZE = int(os.environ.get('BENCHMARK_PACKET_SIZE', 500))
+
+BLOBS = 4
+
+
+class PacketsBenchmark(tests.Test):
+
+    def test_decode_SneakernetPacket(self):
+        blob_size = (PACKET_SIZE << 20) / 2 / BLOBS
+        with file('blob', 'wb') as f:
+            chunk = os.urandom(1 << 16)
+            for __ in xrange(blob_size / len(chunk)):
+                f.write(chunk)
+        blob_size = os.stat('blob').st_size
+        record = {'guid': '0' * 32, 'patch': {
+            'title': {'value': {'en': 'title'}, 'mtime': 1},
+            'summary': {'value': {'en': 'summary ' * 16}, 'mtime': 1},
+            }}
+
+        def content():
+            records_size = (PACKET_SIZE << 20) / 2
+            records_number = records_size / len(str(record))
+            for i in xrange(records_number):
+                yield record
+                if i % (records_number / BLOBS) == 0:
+                    yield File('blob', 'digest',
+                            {'content-length': str(blob_size)})
+
+        for compresslevel in (0, None):
+            with file('packet', 'wb') as f:
+                for chunk in packets.encode(content(),
+                        compresslevel=compresslevel):
+                    f.write(chunk)
+            packet_size = os.stat('packet').st_size
+
+            records = 0
+            blobs = 0
+            ts = time.time()
+            with file('packet', 'rb') as f:
+                for i in packets.decode(f):
+                    if isinstance(i, File):
+                        blobs += 1
+                    else:
+                        records += 1
+            duration = time.time() - ts
+
+            print '\n%s packet of %sMB with %s records and %s blobs ' \
+                    'decoded in %.2fs (%.2fMB/s)' % \
+                    ('Plain' if compresslevel is 0 else 'Zipped',
+                    packet_size >> 20, records, blobs, duration,
+                    (packet_size >> 20) / duration)
+
+
+if __name__ == '__main__':
+    tests.main()
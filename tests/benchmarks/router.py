@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# sugar-lint: disable
+
+import time
+
+from __init__ import tests
+
+from sugar_network import db
+from sugar_network.model.routes import FrontRoutes
+from sugar_network.toolkit.router import Request, _Api
+from sugar_network.toolkit import http
+
+
+ROUNDS = 20000
+
+REQUESTS = [
+    ('GET', [], 'status'),
+    ('GET', ['context'], None),
+    ('GET', ['context', 'guid'], None),
+    ('GET', ['context', 'guid', 'title'], None),
+    ('PUT', ['context', 'guid'], 'useradd'),
+    ('GET', ['context', 'guid', 'releases', 'key'], None),
+    ('GET', ['blobs', 'digest'], None),
+    ('GET', ['assets', 'images', 'icon.png'], None),
+    ('POST', ['context', 'guid', 'title', 'key'], None),
+    ]
+
+
+class RouterBenchmark(tests.Test):
+
+    def test_resolve_route(self):
+
+        class Routes(db.Routes, FrontRoutes):
+
+            def __init__(self):
+                db.Routes.__init__(self)
+                FrontRoutes.__init__(self)
+
+        api = _Api(Routes())
+        requests = []
+        for method, path, cmd in REQUESTS:
+            request = Request(method=method, path=path, cmd=cmd)
+            requests.append(request)
+            self.assertEqual(
+                    repr(_walk_routes_tree(api, request)),
+                    repr(_resolve(api.resolve_route, request)))
+
+        tree_walk = _measure(lambda x: _walk_routes_tree(api, x), requests)
+        table = _measure(api.resolve_route, requests)
+        print '\nRoute dispatch per request: tree walk %.2fus, ' \
+                'compiled table %.2fus (x%.1f)' % \
+                (tree_walk, table, tree_walk / table)
+
+
+def _measure(resolve, requests):
+    ts = time.time()
+    for __ in xrange(ROUNDS):
+        for request in requests:
+            _resolve(resolve, request)
+    return (time.time() - ts) * 1000000 / ROUNDS / len(requests)
+
+
+def _resolve(resolve, request):
+    try:
+        return resolve(request)
+    except http.Status, error:
+        return type(error)
+
+
+def _walk_routes_tree(api, request):
+    # The recursive resolving that was used before compiling routes
+
+    found_path = [False]
+
+    def resolve_path(routes, path):
+        if not path:
+            if routes.ops:
+                found_path[0] = True
+            return routes.ops.get((request.method, request.cmd)) or \
+                   routes.fallback_ops.get((request.method, None)) or \
+                   routes.fallback_ops.get((None, None))
+        subroutes = routes.get(path[0])
+        if subroutes is None:
+            route_ = routes.fallback_ops.get((request.method, None)) or \
+                    routes.fallback_ops.get((None, None))
+            if route_ is not None:
+                return route_
+        for subroutes in (subroutes, routes.wildcards):
+            if subroutes is None:
+                continue
+            route_ = resolve_path(subroutes, path[1:])
+            if route_ is not None:
+                return route_
+
+    route_ = resolve_path(api._routes, request.path) or \
+            api._routes.fallback_ops.get((request.method, None)) or \
+            api._routes.fallback_ops.get((None, None))
+    if route_ is None:
+        if found_path[0]:
+            raise http.BadRequest('No such operation')
+        else:
+            raise http.NotFound('Path not found')
+    return route_
+
+
+if __name__ == '__main__':
+    tests.main()
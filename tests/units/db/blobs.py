@@ -42,12 +42,8 @@ class BlobsTest(tests.Test):
                 content,
                 file(blob.path).read())
         self.assertEqual(
-                sorted([
-                    'content-type: application/octet-stream',
-                    'content-length: %s' % len(content),
-                    'x-seqno: 1',
-                    ]),
-                sorted(file(blob.path + '.meta').read().strip().split('\n')))
+                blob.meta,
+                Blobs('.', Seqno()).get(blob.digest).meta)
 
         the_same_blob = blobs.get(blob.digest)
         assert the_same_blob is not blob
@@ -78,12 +74,8 @@ class BlobsTest(tests.Test):
                 content,
                 file(blob.path).read())
         self.assertEqual(
-                sorted([
-                    'content-type: application/octet-stream',
-                    'content-length: %s' % len(content),
-                    'x-seqno: 1',
-                    ]),
-                sorted(file(blob.path + '.meta').read().strip().split('\n')))
+                blob.meta,
+                Blobs('.', Seqno()).get(blob.digest).meta)
 
         the_same_blob = blobs.get(blob.digest)
         assert the_same_blob is not blob
@@ -116,14 +108,8 @@ class BlobsTest(tests.Test):
             },
             blob.meta)
         self.assertEqual(
-                sorted([
-                    'status: 301 Moved Permanently',
-                    'location: location',
-                    'content-type: application/octet-stream',
-                    'content-length: 101',
-                    'x-seqno: 1',
-                    ]),
-                sorted(file('blobs/%s/%s.meta' % (blob.digest[:2], blob.digest)).read().strip().split('\n')))
+                blob.meta,
+                Blobs('.', Seqno()).get(blob.digest).meta)
 
         the_same_blob = blobs.get(blob.digest)
         assert the_same_blob is not blob
@@ -156,7 +142,6 @@ class BlobsTest(tests.Test):
 
         blob = blobs.post('probe')
         assert exists(blob.path)
-        assert exists(blob.path + '.meta')
         self.assertEqual({
             'content-length': '5',
             'content-type': 'application/octet-stream',
@@ -166,7 +151,6 @@ class BlobsTest(tests.Test):
 
         blobs.delete(blob.digest)
         assert not exists(blob.path)
-        assert exists(blob.path + '.meta')
         self.assertEqual({
             'content-length': '5',
             'content-type': 'application/octet-stream',
@@ -175,59 +159,161 @@ class BlobsTest(tests.Test):
             },
             blobs.get(blob.digest).meta)
 
+    def test_post_Dedup(self):
+        blobs = Blobs('.', Seqno())
+
+        blob = blobs.post('probe')
+        self.utime(blob.path, 1)
+        dup = blobs.post('probe')
+        self.assertEqual(blob.digest, dup.digest)
+        self.assertEqual(blob.meta, dup.meta)
+        self.assertEqual(1, os.stat(blob.path).st_mtime)
+        self.assertEqual([blob.digest[:2]], os.listdir('blobs'))
+        self.assertEqual([blob.digest], os.listdir('blobs/%s' % blob.digest[:2]))
+        self.assertEqual('1', blobs.get(blob.digest).meta['x-seqno'])
+
+        dup = blobs.post('probe', 'foo/bar')
+        self.assertEqual(blob.digest, dup.digest)
+        self.assertEqual('foo/bar', dup.meta['content-type'])
+        self.assertEqual('2', dup.meta['x-seqno'])
+        self.assertEqual('foo/bar', blobs.get(blob.digest).meta['content-type'])
+
+    def test_delete_RefCounting(self):
+        blobs = Blobs('.', Seqno())
+
+        blob = blobs.post('probe')
+        blobs.post('probe')
+        blobs.ref(blob.digest)
+        blobs.ref(blob.digest)
+
+        blobs.delete(blob.digest)
+        assert exists(blob.path)
+        self.assertEqual('1', blobs.get(blob.digest).meta['x-seqno'])
+
+        blobs.close()
+        blobs = Blobs('.', Seqno())
+        blobs.delete(blob.digest)
+        assert not exists(blob.path)
+        self.assertEqual('410 Gone', blobs.get(blob.digest).meta['status'])
+
+    def test_gc(self):
+        blobs = Blobs('.', Seqno())
+
+        blob1 = blobs.post('1', thumbs=100)
+        blob2 = blobs.post('2', thumbs=100)
+        blob3 = blobs.post('3')
+        blobs.delete(blob3.digest)
+        self.touch(('thumbs/100/%s/%s' % (blob1.digest[:2], blob1.digest), '11'))
+        self.touch(('thumbs/100/%s/%s' % (blob2.digest[:2], blob2.digest), '22'))
+
+        freed = blobs.gc({blob1.digest: 2})
+        self.assertEqual(3, freed)
+        assert exists(blob1.path)
+        assert exists('thumbs/100/%s/%s' % (blob1.digest[:2], blob1.digest))
+        assert not exists(blob2.path)
+        assert blobs.get(blob2.digest) is None
+        assert not exists('thumbs/100/%s/%s' % (blob2.digest[:2], blob2.digest))
+        self.assertEqual('410 Gone', blobs.get(blob3.digest).meta['status'])
+
+        blobs.delete(blob1.digest)
+        assert exists(blob1.path)
+        blobs.delete(blob1.digest)
+        assert not exists(blob1.path)
+
     def test_diff_Blobs(self):
         blobs = Blobs('.', Seqno())
         this.request = Request()
 
-        self.touch('blobs/10/1000000000000000000000000000000000000001',
-                  ('blobs/10/1000000000000000000000000000000000000001.meta', 'n: 1\nx-seqno: 1'))
-        self.utime('blobs/10/1000000000000000000000000000000000000001', 1)
-        self.utime('blobs/10/1000000000000000000000000000000000000001.meta', 1)
-        self.touch('blobs/10/1000000000000000000000000000000000000002',
-                  ('blobs/10/1000000000000000000000000000000000000002.meta', 'n: 2\nx-seqno: 2'))
-        self.utime('blobs/10/1000000000000000000000000000000000000002', 2)
-        self.utime('blobs/10/1000000000000000000000000000000000000002.meta', 2)
-        self.touch('blobs/20/2000000000000000000000000000000000000003',
-                  ('blobs/20/2000000000000000000000000000000000000003.meta', 'n: 3\nx-seqno: 3'))
-        self.utime('blobs/20/2000000000000000000000000000000000000003', 3)
-        self.utime('blobs/20/2000000000000000000000000000000000000003.meta', 3)
+        self.touch(('blob', '1'))
+        blobs.patch(File('./blob', '2000000000000000000000000000000000000003', {'n': 3}), 3)
+        self.touch(('blob', '2'))
+        blobs.patch(File('./blob', '1000000000000000000000000000000000000001', {'n': 1}), 1)
+        self.touch(('blob', '3'))
+        blobs.patch(File('./blob', '1000000000000000000000000000000000000002', {'n': 2}), 2)
 
         self.assertEqual([
-            ('2000000000000000000000000000000000000003', {'n': '3', 'x-seqno': '3'}),
-            ('1000000000000000000000000000000000000002', {'n': '2', 'x-seqno': '2'}),
             ('1000000000000000000000000000000000000001', {'n': '1', 'x-seqno': '1'}),
+            ('1000000000000000000000000000000000000002', {'n': '2', 'x-seqno': '2'}),
+            ('2000000000000000000000000000000000000003', {'n': '3', 'x-seqno': '3'}),
             ],
             [(i.digest, i.meta) for i in  blobs.diff([[1, None]])])
         self.assertEqual([
             ],
             [(i.digest, i.meta) for i in  blobs.diff([[4, None]])])
 
-        self.touch('blobs/20/2000000000000000000000000000000000000004',
-                  ('blobs/20/2000000000000000000000000000000000000004.meta', 'n: 4\nx-seqno: 4'))
-        self.utime('blobs/20/2000000000000000000000000000000000000004', 4)
-        self.utime('blobs/20/2000000000000000000000000000000000000004.meta', 4)
-        self.touch('blobs/30/3000000000000000000000000000000000000005',
-                  ('blobs/30/3000000000000000000000000000000000000005.meta', 'n: 5\nx-seqno: 5'))
-        self.utime('blobs/30/3000000000000000000000000000000000000005', 5)
-        self.utime('blobs/30/3000000000000000000000000000000000000005.meta', 5)
+        self.touch(('blob', '4'))
+        blobs.patch(File('./blob', '2000000000000000000000000000000000000004', {'n': 4}), 4)
+        self.touch(('blob', '5'))
+        blobs.patch(File('./blob', '3000000000000000000000000000000000000005', {'n': 5}), 5)
 
         self.assertEqual([
-            ('3000000000000000000000000000000000000005', {'n': '5', 'x-seqno': '5'}),
             ('2000000000000000000000000000000000000004', {'n': '4', 'x-seqno': '4'}),
+            ('3000000000000000000000000000000000000005', {'n': '5', 'x-seqno': '5'}),
             ],
             [(i.digest, i.meta) for i in  blobs.diff([[4, None]])])
         self.assertEqual([
             ],
             [i for i in  blobs.diff([[6, None]])])
-
         self.assertEqual([
+            ('1000000000000000000000000000000000000002', {'n': '2', 'x-seqno': '2'}),
             ('3000000000000000000000000000000000000005', {'n': '5', 'x-seqno': '5'}),
-            ('2000000000000000000000000000000000000004', {'n': '4', 'x-seqno': '4'}),
-            ('2000000000000000000000000000000000000003', {'n': '3', 'x-seqno': '3'}),
+            ],
+            [(i.digest, i.meta) for i in  blobs.diff([[2, 2], [5, 5]])])
+
+        self.touch(('blob', '6'))
+        blobs.patch(File('./blob', '1000000000000000000000000000000000000001', {'n': 6}), 6)
+
+        self.assertEqual([
             ('1000000000000000000000000000000000000002', {'n': '2', 'x-seqno': '2'}),
-            ('1000000000000000000000000000000000000001', {'n': '1', 'x-seqno': '1'}),
+            ('2000000000000000000000000000000000000003', {'n': '3', 'x-seqno': '3'}),
+            ('2000000000000000000000000000000000000004', {'n': '4', 'x-seqno': '4'}),
+            ('3000000000000000000000000000000000000005', {'n': '5', 'x-seqno': '5'}),
+            ('1000000000000000000000000000000000000001', {'n': '6', 'x-seqno': '6'}),
             ],
             [(i.digest, i.meta) for i in  blobs.diff([[1, None]])])
+        self.assertEqual(
+                [(i.digest, i.meta) for i in  blobs.diff([[1, None]])],
+                [(i.digest, i.meta) for i in  Blobs('.', Seqno()).diff([[1, None]])])
+
+    def test_MetaIndex(self):
+        blobs = Blobs('.', Seqno())
+        blob1 = blobs.post('1')
+        blob2 = blobs.post('2')
+        blobs.update(blob1.digest, {'foo': 'bar'})
+        blobs.wipe(blob2.digest)
+        blobs.close()
+
+        blobs = Blobs('.', Seqno())
+        self.assertEqual(
+                [(blob1.digest, {'content-type': 'application/octet-stream', 'content-length': '1', 'x-seqno': '1', 'foo': 'bar'})],
+                [(i.digest, i.meta) for i in blobs.walk()])
+        assert blobs.get(blob2.digest) is None
+        blobs.close()
+
+        with file('var/blobs.index', 'a') as f:
+            f.write('broken')
+        blobs = Blobs('.', Seqno())
+        self.assertEqual([blob1.digest], [i.digest for i in blobs.walk()])
+        blob3 = blobs.post('3')
+        blobs.close()
+
+        blobs = Blobs('.', Seqno())
+        self.assertEqual([blob1.digest, blob3.digest], [i.digest for i in blobs.walk()])
+
+    def test_MetaIndex_ImportMetaFiles(self):
+        self.touch(
+            ('blobs/00/0000000000000000000000000000000000000001', '1'),
+            ('blobs/00/0000000000000000000000000000000000000001.meta', 'n: 1\nx-seqno: 2'),
+            ('blobs/00/0000000000000000000000000000000000000002.meta', 'n: 2\nx-seqno: 1\nstatus: 410 Gone'),
+            )
+
+        blobs = Blobs('.', Seqno())
+        self.assertEqual([
+            ('0000000000000000000000000000000000000002', {'n': '2', 'x-seqno': '1', 'status': '410 Gone'}),
+            ('0000000000000000000000000000000000000001', {'n': '1', 'x-seqno': '2'}),
+            ],
+            [(i.digest, i.meta) for i in blobs.walk()])
+        assert exists('var/blobs.index')
 
     def test_diff_Files(self):
         blobs = Blobs('.', Seqno())
@@ -324,37 +410,21 @@ class BlobsTest(tests.Test):
         blobs = Blobs('.', Seqno())
         this.request = Request()
 
-        self.touch('blobs/00/0000000000000000000000000000000000000001',
-                  ('blobs/00/0000000000000000000000000000000000000001.meta', 'n: 1\nx-seqno: 1'))
-        self.utime('blobs/00/0000000000000000000000000000000000000001', 100)
-        self.utime('blobs/00/0000000000000000000000000000000000000001.meta', 1)
-
         self.touch('files/2', ('files/2.meta', 'n: 2\nx-seqno: 2'))
         self.utime('files/2', 200)
         self.utime('files/2.meta', 2)
 
         blobs._seqno.value = 10
-        self.assertEqual([
-            ('0000000000000000000000000000000000000001', {'n': '1', 'content-length': '49', 'x-seqno': '11'}),
-            ],
-            [(i.digest, i.meta) for i in  blobs.diff([[1, None]])])
-        self.assertEqual(11, blobs._seqno.value)
-        self.assertEqual([
-            ('0000000000000000000000000000000000000001', {'n': '1', 'content-length': '49', 'x-seqno': '11'}),
-            ],
-            [(i.digest, i.meta) for i in  blobs.diff([[1, None]])])
-        self.assertEqual(11, blobs._seqno.value)
-
         self.assertEqual(sorted([
-            ('2', {'n': '2', 'path': '2', 'content-length': '7', 'x-seqno': '12'}),
+            ('2', {'n': '2', 'path': '2', 'content-length': '7', 'x-seqno': '11'}),
             ]),
             sorted([(i.digest, i.meta) for i in  blobs.diff([[1, None]], '')]))
-        self.assertEqual(12, blobs._seqno.value)
+        self.assertEqual(11, blobs._seqno.value)
         self.assertEqual(sorted([
-            ('2', {'n': '2', 'path': '2', 'content-length': '7', 'x-seqno': '12'}),
+            ('2', {'n': '2', 'path': '2', 'content-length': '7', 'x-seqno': '11'}),
             ]),
             sorted([(i.digest, i.meta) for i in  blobs.diff([[1, None]], '')]))
-        self.assertEqual(12, blobs._seqno.value)
+        self.assertEqual(11, blobs._seqno.value)
 
     def test_patch_Blob(self):
         blobs = Blobs('.', Seqno())
@@ -1476,6 +1476,144 @@ class DbRoutesTest(tests.Test):
             ],
             this.call(method='GET', path=['document'])['result'])
 
+    def test_find_After(self):
+
+        class Document(db.Resource):
+            pass
+
+        this.volume = volume = db.Volume(tests.tmpdir, [Document])
+        router = Router(db.Routes())
+
+        volume['document'].create({'guid': '1', 'ctime': 2})
+        volume['document'].create({'guid': '2', 'ctime': 3})
+        volume['document'].create({'guid': '3', 'ctime': 1})
+
+        page = this.call(method='GET', path=['document'], order_by='ctime', limit=2, after='')
+        self.assertEqual([{'guid': '3'}, {'guid': '1'}], page['result'])
+        self.assertEqual(3, page['total'])
+        assert page['after']
+
+        page = this.call(method='GET', path=['document'], order_by='ctime', limit=2, after=page['after'])
+        self.assertEqual({'total': 1, 'result': [{'guid': '2'}], 'after': None}, page)
+
+        self.assertEqual(
+                {'total': 3, 'result': [{'guid': '3'}, {'guid': '1'}]},
+                this.call(method='GET', path=['document'], order_by='ctime', limit=2))
+
+    def test_find_Total(self):
+
+        class Document(db.Resource):
+            pass
+
+        this.volume = volume = db.Volume(tests.tmpdir, [Document])
+        router = Router(db.Routes())
+
+        volume['document'].create({'guid': '1'})
+        volume['document'].create({'guid': '2'})
+        volume['document'].create({'guid': '3'})
+
+        self.assertEqual(
+                {'total': 3, 'result': [{'guid': '1'}]},
+                this.call(method='GET', path=['document'], limit=1, total='exact'))
+        self.assertEqual(
+                {'total': None, 'result': [{'guid': '1'}]},
+                this.call(method='GET', path=['document'], limit=1, total='none'))
+        self.assertEqual(
+                {'total': None, 'result': [{'guid': '1'}], 'after': volume['document'].cursor('1')},
+                this.call(method='GET', path=['document'], limit=1, total='none', after=''))
+        self.assertEqual(
+                {'total': None, 'result': [{'guid': '1'}, {'guid': '2'}, {'guid': '3'}], 'after': None},
+                this.call(method='GET', path=['document'], limit=3, total='none', after=''))
+        self.assertRaises(http.BadRequest, this.call, method='GET', path=['document'], total='foo')
+
+    def test_find_Facets(self):
+
+        class Document(db.Resource):
+            pass
+
+        this.volume = volume = db.Volume(tests.tmpdir, [Document])
+        router = Router(db.Routes())
+
+        volume['document'].create({'guid': '1', 'tags': ['a', 'b']})
+        volume['document'].create({'guid': '2', 'tags': ['b']})
+        volume['document'].create({'guid': '3', 'tags': ['c'], 'state': 'deleted'})
+
+        self.assertEqual({
+            'total': 2,
+            'result': [{'guid': '1'}],
+            'facets': {'tags': {'a': 1, 'b': 2}},
+            },
+            this.call(method='GET', path=['document'], limit=1, facets='tags'))
+
+    def test_ETags(self):
+
+        class Document(db.Resource):
+
+            @db.stored_property(default='')
+            def prop(self, value):
+                return value
+
+        this.volume = volume = db.Volume(tests.tmpdir, [Document])
+        router = Router(db.Routes())
+        guid = this.call(method='POST', path=['document'], content={'prop': '1'})
+
+        response = Response()
+        self.assertEqual({'prop': '1'}, this.call(method='GET', path=['document', guid], reply=['prop'], response=response))
+        etag = response['etag']
+        assert etag
+        self.assertRaises(http.NotModified, this.call, method='GET', path=['document', guid], reply=['prop'],
+                environ={'HTTP_IF_NONE_MATCH': etag})
+        self.assertRaises(http.NotModified, this.call, method='GET', path=['document', guid, 'prop'],
+                environ={'HTTP_IF_NONE_MATCH': 'W/"foo", %s' % etag})
+        self.assertRaises(http.NotModified, this.call, method='GET', path=['document'], reply=['prop'],
+                environ={'HTTP_IF_NONE_MATCH': etag})
+        self.assertEqual({'prop': '1'}, this.call(method='GET', path=['document', guid], reply=['prop'],
+                environ={'HTTP_IF_NONE_MATCH': etag, 'HTTP_ACCEPT_LANGUAGE': 'es'}))
+        self.assertEqual({'prop': '1'}, this.call(method='GET', path=['document', guid], reply=['prop'],
+                environ={'HTTP_IF_NONE_MATCH': '"foo"'}))
+
+        this.call(method='PUT', path=['document', guid], content={'prop': '2'})
+        response = Response()
+        self.assertEqual({'prop': '2'}, this.call(method='GET', path=['document', guid], reply=['prop'], response=response,
+                environ={'HTTP_IF_NONE_MATCH': etag}))
+        assert response['etag'] != etag
+        self.assertEqual(
+                {'total': 1, 'result': [{'prop': '2'}]},
+                this.call(method='GET', path=['document'], reply=['prop'], environ={'HTTP_IF_NONE_MATCH': etag}))
+
+        etag = response['etag']
+        volume['document'].patch(guid, {'prop': {'value': '3', 'mtime': int(time.time()) + 1}})
+        self.assertEqual('3', this.call(method='GET', path=['document', guid, 'prop'],
+                environ={'HTTP_IF_NONE_MATCH': etag}))
+
+    def test_ETags_Authors(self):
+
+        class Document(db.Resource):
+
+            @db.stored_property(default='')
+            def prop(self, value):
+                return value
+
+        this.volume = volume = db.Volume(tests.tmpdir, [User, Document])
+        router = Router(db.Routes())
+        this.principal = Principal('user')
+        guid = this.call(method='POST', path=['document'], content={})
+
+        response = Response()
+        this.call(method='GET', path=['document', guid, 'author'], response=response)
+        author_etag = response['etag']
+        response = Response()
+        this.call(method='GET', path=['document', guid, 'prop'], response=response)
+        prop_etag = response['etag']
+
+        volume['user'].create({'guid': 'user', 'pubkey': '', 'name': 'User'})
+        self.assertEqual('User', this.call(method='GET', path=['document', guid, 'author'],
+                environ={'HTTP_IF_NONE_MATCH': author_etag})['user']['name'])
+        self.assertEqual('User', this.call(method='GET', path=['document'], reply=['author'],
+                environ={'HTTP_IF_NONE_MATCH': author_etag})['result'][0]['author']['user']['name'])
+        self.assertRaises(http.NotModified, this.call, method='GET', path=['document', guid, 'prop'],
+                environ={'HTTP_IF_NONE_MATCH': prop_etag})
+
     def test_DefaultsOnNonePostValues(self):
 
         class Document(db.Resource):
@@ -1859,6 +1997,28 @@ class DbRoutesTest(tests.Test):
         assert not volume.blobs.get(digest2).exists
         assert volume.blobs.get(digest3)
 
+    def test_BlobsRefCounting(self):
+
+        class Document(db.Resource):
+
+            @db.stored_property(db.Blob)
+            def blob(self, value):
+                return value
+
+        this.volume = volume = db.Volume(tests.tmpdir, [Document])
+        router = Router(db.Routes())
+        digest = hashlib.sha1('probe').hexdigest()
+
+        guid1 = this.call(method='POST', path=['document'], content={'blob': 'probe'})
+        guid2 = this.call(method='POST', path=['document'], content={'blob': 'probe'})
+        self.assertEqual(digest, volume['document'].get(guid1)['blob'])
+        self.assertEqual(digest, volume['document'].get(guid2)['blob'])
+
+        this.call(method='PUT', path=['document', guid1], content={'blob': 'other'})
+        assert volume.blobs.get(digest).exists
+        this.call(method='PUT', path=['document', guid2], content={'blob': 'other'})
+        assert not volume.blobs.get(digest).exists
+
     def test_AggregatedSearch(self):
 
         class Document(db.Resource):
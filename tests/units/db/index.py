@@ -3,18 +3,21 @@
 # sugar-lint: disable
 
 import os
+import json
 import time
 import shutil
 import locale
 from os.path import exists
 
+import xapian
+
 from __init__ import tests
 
 from sugar_network import toolkit
 from sugar_network.db import index
 from sugar_network.db.metadata import Metadata, Property, GUID_PREFIX, Boolean, Enum, List, Localized, Numeric
 from sugar_network.toolkit.router import ACL
-from sugar_network.toolkit import coroutine, i18n
+from sugar_network.toolkit import coroutine, http, i18n
 
 
 class IndexTest(tests.Test):
@@ -722,21 +725,365 @@ class IndexTest(tests.Test):
         self.assertEqual([{'guid': '11'}], db._find(trait='11')[0])
         self.assertEqual([{'guid': '11'}], db._find(trait=11)[0])
 
+    def test_bulk(self):
+        index.index_flush_threshold.value = 2
+        commits = []
 
-class Index(index.IndexWriter):
+        db = Index({'key': Property('key', 1, 'K')}, lambda: commits.append(True))
+        coroutine.dispatch()
 
-    def __init__(self, props, *args):
+        with db.bulk():
+            db.store('1', {'key': '1'})
+            db.store('2', {'key': '2'})
+            with db.bulk():
+                db.store('3', {'key': '3'})
+            coroutine.dispatch()
+            self.assertEqual(0, len(commits))
+            db.store('4', {'key': '4'})
+            db.delete('1')
+        coroutine.dispatch()
+        self.assertEqual(1, len(commits))
 
-        class Document(object):
+        self.assertEqual(
+                ([{'guid': '2'}, {'guid': '3'}, {'guid': '4'}], 3),
+                db._find())
+        db.close()
+
+    def test_bulk_CancelOnError(self):
+        db = Index({'key': Property('key', 1, 'K')})
+        db.store('1', {'key': '1'})
+
+        try:
+            with db.bulk():
+                db.store('2', {'key': '2'})
+                with db.bulk():
+                    db.delete('1')
+                raise RuntimeError()
+        except RuntimeError:
             pass
+        self.assertEqual(([{'guid': '1'}], 1), db._find())
+
+        with db.bulk():
+            db.store('3', {'key': '3'})
+        self.assertEqual(([{'guid': '1'}, {'guid': '3'}], 2), db._find())
+        db.close()
+
+    def test_StoredInIndex(self):
+        db = Index({
+            'prop1': Property('prop1', 1, 'A', stored_in_index=True),
+            'prop2': Property('prop2', 2, 'B'),
+            })
+
+        db.store('1', {'prop1': 'a', 'prop2': 'b'})
+        self.assertEqual(
+                [{'prop1': 'a'}],
+                [json.loads(i.document.get_data()) for i in db.find()])
+        db.close()
+
+        db = Index({'prop': Property('prop', 1, 'A')})
+        db.store('1', {'prop': 'a'})
+        self.assertEqual(
+                [''],
+                [i.document.get_data() for i in db.find()])
+        db.close()
+
+    def test_find_After(self):
+        db = Index({'key': Property('key', 1, 'K')})
+        db.store('1', {'key': 'b'})
+        db.store('2', {'key': 'a'})
+        db.store('3', {'key': 'b'})
+        db.store('4', {'key': 'c'})
+
+        def walk(**kwargs):
+            pages = []
+            after = ''
+            while True:
+                result, total = db._find(after=after, limit=2, **kwargs)
+                pages.append(([i['guid'] for i in result], total))
+                if len(result) == total:
+                    break
+                after = db.cursor(result[-1]['guid'], kwargs.get('order_by'))
+            return pages
+
+        self.assertEqual(
+                [(['1', '2'], 4), (['3', '4'], 2)],
+                walk())
+        self.assertEqual(
+                [(['2', '1'], 4), (['3', '4'], 2)],
+                walk(order_by='key'))
+        self.assertEqual(
+                [(['4', '1'], 4), (['3', '2'], 2)],
+                walk(order_by='-key'))
+        self.assertEqual(
+                [(['1', '3'], 2)],
+                walk(key='b'))
+
+        self.assertEqual(
+                ([{'guid': '2'}, {'guid': '3'}, {'guid': '4'}], 3),
+                db._find(after=db.cursor('1'), offset=10))
+        self.assertRaises(http.BadRequest, db._find, after='foo')
+        self.assertRaises(http.BadRequest, db._find, after=db.cursor('1'), order_by='key')
+        db.close()
+
+    def test_find_Total(self):
+        db = Index({'key': Property('key', 1, 'K')})
+        for i in range(10):
+            db.store(str(i), {'key': 'a'})
+
+        self.assertEqual(
+                ([{'guid': '0'}, {'guid': '1'}], 10),
+                db._find(limit=2, total='exact'))
+        result, total = db._find(limit=2, total='estimate')
+        self.assertEqual([{'guid': '0'}, {'guid': '1'}], result)
+        assert total >= 2
+        self.assertEqual(
+                [{'guid': '0'}, {'guid': '1'}],
+                db._find(limit=2, total='none')[0])
+        self.assertRaises(http.BadRequest, db._find, total='foo')
+        db.close()
+
+    def test_find_Facets(self):
+        db = Index({
+            'kind': Property('kind', prefix='A'),
+            'tags': List(name='tags', prefix='XA'),
+            'title': Property('title', prefix='B', full_text=True),
+            })
+        db.store('1', {'kind': 'a', 'tags': ['x', 'y'], 'title': 'a'})
+        db.store('2', {'kind': 'b', 'tags': ['y'], 'title': 'x'})
+        db.store('3', {'kind': 'a', 'tags': [], 'title': 'z'})
 
-        metadata = Metadata(Index)
-        metadata.update(props)
-        metadata['guid'] = Property('guid',
-                acl=ACL.CREATE | ACL.READ, slot=0,
-                prefix=GUID_PREFIX)
+        facets = dict.fromkeys(['kind', 'tags'])
+        self.assertEqual(
+                ([{'guid': '1'}], 3),
+                db._find(limit=1, facets=facets))
+        self.assertEqual({
+            'kind': {'a': 2, 'b': 1},
+            'tags': {'x': 1, 'y': 2},
+            },
+            facets)
+
+        facets = {'tags': None}
+        self.assertEqual(
+                ([{'guid': '1'}, {'guid': '3'}], 2),
+                db._find(kind='a', facets=facets))
+        self.assertEqual({'tags': {'x': 1, 'y': 1}}, facets)
+
+        self.assertRaises(http.BadRequest, db._find, facets={'absent': None})
+        db.close()
+
+    def test_QueryCache(self):
+        db = Index({'key': Property('key', 1, 'K')})
+
+        db.store('1', {'key': 'foo'})
+        self.assertEqual(([{'guid': '1'}], 1), db._find(query='fo'))
+        self.assertEqual(1, len(db._queries))
+        self.assertEqual(([{'guid': '1'}], 1), db._find(query='fo'))
+        self.assertEqual(1, len(db._queries))
+        self.assertEqual(([], 0), db._find(query='fo', key='bar'))
+        self.assertEqual(2, len(db._queries))
+
+        db.store('2', {'key': 'food'})
+        self.assertEqual(0, len(db._queries))
+        self.assertEqual(([{'guid': '1'}, {'guid': '2'}], 2), db._find(query='fo'))
+        db.close()
+
+        index.index_query_cache.value = 0
+        db = Index({'key': Property('key', 1, 'K')})
+        self.assertEqual(([{'guid': '1'}, {'guid': '2'}], 2), db._find(query='fo'))
+        self.assertEqual(None, db._queries)
+        db.close()
 
-        index.IndexWriter.__init__(self, tests.tmpdir + '/index', metadata, *args)
+    def test_ProxyIndex(self):
+        commits = []
+        db = ProxyIndex({'key': Property('key', 1, 'K')}, lambda: commits.append(True))
+
+        db.store('1', {'key': 'a'})
+        db.store('2', {'key': 'b'})
+        db.commit()
+        self.assertEqual(2, len(commits))
+        self.assertEqual(
+                ['1', '2'],
+                [i.document.get_value(0) for i in db.find()])
+
+        with db.bulk():
+            db.store('3', {'key': 'c'})
+            db.delete('1')
+        db.commit()
+        self.assertEqual(3, len(commits))
+        self.assertEqual(
+                ['2', '3'],
+                [i.document.get_value(0) for i in db.find()])
+        self.assertEqual(
+                ['3'],
+                [i.document.get_value(0) for i in db.find(key='c')])
+        db.close()
+
+        db = ProxyIndex({'key': Property('key', 1, 'K')})
+        self.assertEqual(
+                ['2', '3'],
+                [i.document.get_value(0) for i in db.find()])
+        db.close()
+
+    def test_ProxyIndex_checkpoint(self):
+        committed = []
+        db = ProxyIndex({'key': Property('key', 1, 'K')}, lambda: committed.append(db.committed))
+
+        db.store('1', {'key': 'a'})
+        db.checkpoint(1)
+        db.store('2', {'key': 'b'})
+        db.checkpoint(2)
+        db.commit()
+        self.assertEqual([1, 2], committed)
+
+        with db.bulk():
+            db.store('3', {'key': 'c'})
+            db.checkpoint(3)
+            db.store('4', {'key': 'd'})
+        db.commit()
+        self.assertEqual([1, 2, 3], committed)
+
+        try:
+            with db.bulk():
+                db.store('5', {'key': 'e'})
+                db.checkpoint(5)
+                raise RuntimeError()
+        except RuntimeError:
+            pass
+        db.commit()
+        self.assertEqual([1, 2, 3, 3], committed)
+        db.close()
+
+    def test_ProxyIndex_CancelBulkOnError(self):
+        db = ProxyIndex({'key': Property('key', 1, 'K')})
+        db.store('1', {'key': 'a'})
+        db.commit()
+
+        try:
+            with db.bulk():
+                db.store('2', {'key': 'b'})
+                db.delete('1')
+                raise RuntimeError()
+        except RuntimeError:
+            pass
+        db.commit()
+        self.assertEqual(
+                ['1'],
+                [i.document.get_value(0) for i in db.find()])
+        db.close()
+
+    def test_Shards(self):
+        index.index_shards.value = 3
+        db = Index({'key': Property('key', 1, 'K')})
+        for i in range(10):
+            db.store(str(i), {'key': 'a' if i % 2 else 'b'})
+        db.commit()
+        self.assertEqual(
+                [str(i) for i in range(10)],
+                [i['guid'] for i in db._find(limit=100)[0]])
+        self.assertEqual(
+                ['1', '3', '5', '7', '9'],
+                [i['guid'] for i in db._find(limit=100, key='a')[0]])
+        db.delete('5')
+        db.close()
+
+        db = Index({'key': Property('key', 1, 'K')})
+        self.assertEqual(
+                ['1', '3', '7', '9'],
+                [i['guid'] for i in db._find(limit=100, key='a')[0]])
+        self.assertEqual(
+                ['0', '1', '2'],
+                sorted([i for i in os.listdir('index') if i.isdigit()]))
+        shards = [xapian.Database('index/%s' % i).get_doccount()
+                for i in range(3)]
+        self.assertEqual(9, sum(shards))
+        assert min(shards) > 0
+        db.close()
+
+    def test_compact(self):
+        index.index_shards.value = 2
+        db = Index({'key': Property('key', 1, 'K')})
+        for i in range(100):
+            db.store(str(i), {'key': str(i)})
+        for i in range(90):
+            db.delete(str(i))
+        db.commit()
+
+        stats = db.compact()
+        assert stats['size'][0] > stats['size'][1]
+        self.assertEqual(2, len(stats['latency']))
+        assert stats['time'] > 0
+        assert not [i for i in os.listdir('index') if '.' in i]
+
+        self.assertEqual(
+                [str(i) for i in range(90, 100)],
+                [i['guid'] for i in db._find(limit=100)[0]])
+        db.store('100', {'key': '100'})
+        db.close()
+
+        db = ProxyIndex({'key': Property('key', 1, 'K')})
+        stats = db.compact()
+        self.assertEqual(2, len(stats['size']))
+        self.assertEqual(
+                [str(i) for i in range(90, 101)],
+                [i.document.get_value(0) for i in db.find(limit=100)])
+        db.store('101', {'key': '101'})
+        db.commit()
+        self.assertEqual(
+                ['101'],
+                [i.document.get_value(0) for i in db.find(key='101')])
+        db.close()
+
+    def test_ProxyIndex_ChangesWhileCompacting(self):
+        compact = index._compact
+
+        def slow_compact(path):
+            time.sleep(1)
+            return compact(path)
+
+        self.override(index, '_compact', slow_compact)
+        db = ProxyIndex({'key': Property('key', 1, 'K')})
+        db.store('1', {'key': 'a'})
+        db.commit()
+
+        job = coroutine.spawn(db.compact)
+        coroutine.sleep(.1)
+        ts = time.time()
+        db.store('2', {'key': 'b'})
+        db.delete('1')
+        db.commit()
+        assert time.time() - ts < 1
+        assert job.get() is not None
+        self.assertEqual(
+                ['2'],
+                [i.document.get_value(0) for i in db.find()])
+        db.close()
+
+        db = ProxyIndex({'key': Property('key', 1, 'K')})
+        self.assertEqual(
+                ['2'],
+                [i.document.get_value(0) for i in db.find()])
+        db.close()
+
+    def test_RecoverInterruptedCompaction(self):
+        db = Index({'key': Property('key', 1, 'K')})
+        db.store('1', {'key': 'a'})
+        db.close()
+        shutil.copytree('index/0', 'index/0.compact')
+        os.rename('index/0', 'index/0.old')
+
+        db = Index({'key': Property('key', 1, 'K')})
+        self.assertEqual(
+                [{'guid': '1'}],
+                db._find()[0])
+        assert not exists('index/0.old')
+        assert not exists('index/0.compact')
+        db.close()
+
+
+class Index(index.IndexWriter):
+
+    def __init__(self, props, *args):
+        index.IndexWriter.__init__(self, tests.tmpdir + '/index', _metadata(props), *args)
 
     def _find(self, reply=None, **kwargs):
         mset = self.find(**kwargs)
@@ -754,5 +1101,24 @@ class Index(index.IndexWriter):
         return result, mset.get_matches_estimated()
 
 
+class ProxyIndex(index.ProxyIndex):
+
+    def __init__(self, props, *args):
+        index.ProxyIndex.__init__(self, tests.tmpdir + '/index', _metadata(props), *args)
+
+
+def _metadata(props):
+
+    class Document(object):
+        pass
+
+    metadata = Metadata(Index)
+    metadata.update(props)
+    metadata['guid'] = Property('guid',
+            acl=ACL.CREATE | ACL.READ, slot=0,
+            prefix=GUID_PREFIX)
+    return metadata
+
+
 if __name__ == '__main__':
     tests.main()
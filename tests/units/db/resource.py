@@ -4,6 +4,7 @@
 
 import os
 import json
+import shutil
 import sys
 import stat
 import time
@@ -21,7 +22,7 @@ from sugar_network import db, toolkit
 from sugar_network.db import storage, index
 from sugar_network.db import directory as directory_
 from sugar_network.db.directory import Directory
-from sugar_network.db.index import IndexWriter
+from sugar_network.db.index import IndexWriter, ProxyIndex
 from sugar_network.toolkit.router import ACL
 from sugar_network.toolkit.coroutine import this
 from sugar_network.toolkit import http
@@ -264,6 +265,120 @@ class ResourceTest(tests.Test):
         assert directory.has_seqno
         assert not directory.has_noseqno
 
+    def test_populate_Journal(self):
+
+        class Document(db.Resource):
+
+            @db.indexed_property(slot=1)
+            def prop(self, value):
+                return value
+
+        directory = Directory(tests.tmpdir, Document, IndexWriter, _SessionSeqno(), this.broadcast)
+        for __ in directory.populate():
+            pass
+        assert exists('index/document/journal')
+        directory.create({'guid': '1', 'prop': '1'})
+        directory.create({'guid': '2', 'prop': '2'})
+        directory.close()
+        self.assertEqual('', file('index/document/journal').read())
+
+        shutil.rmtree('db/document/1/1')
+        self.touch(
+                ('db/document/3/3/guid', '{"value": "3"}'),
+                ('db/document/3/3/ctime', '{"value": 3}'),
+                ('db/document/3/3/mtime', '{"value": 3}'),
+                ('db/document/3/3/prop', '{"value": "prop-3"}'),
+                ('db/document/3/3/seqno', '{"value": 3}'),
+
+                ('db/document/4/4/guid', '{"value": "4"}'),
+                ('db/document/4/4/ctime', '{"value": 4}'),
+                ('db/document/4/4/mtime', '{"value": 4}'),
+                ('db/document/4/4/prop', '{"value": "prop-4"}'),
+                ('db/document/4/4/seqno', '{"value": 4}'),
+
+                ('index/document/journal', '1\n3\n1\n4'),
+                )
+
+        directory = Directory(tests.tmpdir, Document, IndexWriter, _SessionSeqno(), this.broadcast)
+        self.assertEqual(2, len([i for i in directory.populate()]))
+        self.assertEqual(
+                ['2', '3'],
+                sorted([i.guid for i in directory.find()[0]]))
+        self.assertEqual('', file('index/document/journal').read())
+
+    def test_bulk_ResyncOnError(self):
+
+        class Document(db.Resource):
+
+            @db.indexed_property(slot=1)
+            def prop(self, value):
+                return value
+
+        directory = Directory(tests.tmpdir, Document, IndexWriter, _SessionSeqno(), this.broadcast)
+        directory.create({'guid': '1', 'prop': '1'})
+
+        try:
+            with directory.bulk():
+                directory.create({'guid': '2', 'prop': '2'})
+                directory.update('1', {'prop': '3'})
+                raise RuntimeError()
+        except RuntimeError:
+            pass
+        self.assertEqual(
+                ['2', '1'],
+                [i.guid for i in directory.find(order_by='prop')[0]])
+
+    def test_ProxyIndex(self):
+
+        class Document(db.Resource):
+
+            @db.indexed_property(slot=1, prefix='P')
+            def prop(self, value):
+                return value
+
+            @db.indexed_property(slot=2, stored_in_index=True)
+            def stored(self, value):
+                return value
+
+        for backend, wal in [('files', False), ('files', True), ('packed', False)]:
+            shutil.rmtree('db', ignore_errors=True)
+            shutil.rmtree('index', ignore_errors=True)
+            db.storage_backend.value = backend
+            db.storage_wal.value = wal
+            directory = Directory(tests.tmpdir, Document, ProxyIndex, _SessionSeqno(), this.broadcast)
+
+            directory.create({'guid': '1', 'prop': 'a', 'stored': 'b'})
+            directory.update('1', {'prop': 'c'})
+            directory.create({'guid': '2', 'prop': 'd', 'stored': 'e'})
+            directory.commit()
+
+            self.assertEqual(
+                    [('1', 'c', 'b')],
+                    [(i.guid, i['prop'], i['stored']) for i in directory.find(prop='c')[0]])
+            self.assertEqual(
+                    ['1', '2'],
+                    [i.guid for i in directory.find(order_by='prop')[0]])
+            directory.close()
+
+    def test_cursor_FromFoundDocument(self):
+
+        class Document(db.Resource):
+
+            @db.indexed_property(slot=1)
+            def prop(self, value):
+                return value
+
+        directory = Directory(tests.tmpdir, Document, IndexWriter, _SessionSeqno(), this.broadcast)
+        directory.create({'guid': '1', 'prop': 'a'})
+        directory.create({'guid': '2', 'prop': 'b'})
+
+        documents, __ = directory.find(order_by='prop', limit=1)
+        self.assertEqual(['1'], [i.guid for i in documents])
+        cursor = directory.cursor('1', 'prop')
+        directory.update('1', {'prop': 'c'})
+        self.assertEqual(cursor, directory.cursor('1', 'prop', documents.last))
+        self.assertNotEqual(cursor, directory.cursor('1', 'prop'))
+
     def test_populate_NoSeqnoSatus(self):
 
         class Document(db.Resource):
@@ -578,6 +693,133 @@ class ResourceTest(tests.Test):
             directory[guid].diff([[1, None]], out_r))
         self.assertEqual([[1, 3]], out_r)
 
+    def test_diff_Chunks(self):
+
+        class Document(db.Resource):
+
+            @db.stored_property()
+            def prop(self, value):
+                return value
+
+        self.override(directory_, '_DIFF_CHUNK', 2)
+        directory = Directory(tests.tmpdir, Document, IndexWriter, _SessionSeqno(), this.broadcast)
+        for i in range(7):
+            directory.create({'guid': str(i), 'prop': str(i)})
+        # Seqno index does not cover these ranges
+        directory._seqnos.clear(100)
+
+        self.assertEqual(
+                [(str(i), None) for i in range(7)],
+                [(i.guid, props) for i, props in directory.diff([[1, None]])])
+        self.assertEqual(
+                ['1', '2', '4', '5'],
+                [i.guid for i, __ in directory.diff([[2, 3], [5, 6]])])
+
+        diff = directory.diff([[1, None]])
+        self.assertEqual('0', next(diff)[0].guid)
+        self.assertEqual('1', next(diff)[0].guid)
+        # Changes after fetching the chunk do not shift the next one
+        directory.update('1', {'prop': '-'})
+        self.assertEqual(
+                ['2', '3', '4', '5', '6', '1'],
+                [i.guid for i, __ in diff])
+
+    def test_diff_SeqnoIndex(self):
+
+        class Document(db.Resource):
+
+            @db.stored_property()
+            def prop1(self, value):
+                return value
+
+            @db.stored_property()
+            def prop2(self, value):
+                return value
+
+            @db.stored_property(acl=ACL.PUBLIC | ACL.LOCAL)
+            def local(self, value):
+                return value
+
+        seqno = _SessionSeqno()
+        directory = Directory(tests.tmpdir, Document, IndexWriter, seqno, this.broadcast)
+        directory.create({'guid': '1', 'prop1': 'a', 'prop2': 'a', 'local': 'a'})
+        directory.create({'guid': '2', 'prop1': 'b', 'prop2': 'b', 'local': 'b'})
+        directory.update('1', {'prop2': 'c'})
+        directory.update('2', {'local': 'c'})
+        self.assertEqual(1, directory._seqnos.since)
+
+        self.utime('db', 0)
+
+        def diff(r):
+            return [(doc.guid, sorted(props), doc.diff(r, props=props))
+                    for doc, props in directory.diff(r)]
+
+        self.assertEqual([
+            ('2', ['guid', 'prop1', 'prop2'], {
+                'guid': {'mtime': 0, 'value': '2'},
+                'prop1': {'mtime': 0, 'value': 'b'},
+                'prop2': {'mtime': 0, 'value': 'b'},
+                }),
+            ('1', ['prop2'], {
+                'prop2': {'mtime': 0, 'value': 'c'},
+                }),
+            ],
+            diff([[2, None]]))
+        self.assertEqual(
+                [('1', ['guid', 'prop1', 'prop2'])],
+                [(guid, props) for guid, props, __ in diff([[1, 1]])])
+
+        # Seqno allocated before recently appended ones
+        directory.patch('1', {'prop1': {'mtime': 1, 'value': 'd'}}, 2)
+        self.assertEqual(
+                [('2', ['guid', 'prop1', 'prop2']), ('1', ['prop1'])],
+                [(guid, props) for guid, props, __ in diff([[2, 2]])])
+        self.assertEqual(
+                [('1', ['prop2'])],
+                [(guid, props) for guid, props, __ in diff([[3, 3]])])
+
+        directory.close()
+        directory = Directory(tests.tmpdir, Document, IndexWriter, seqno, this.broadcast)
+        self.assertEqual(1, directory._seqnos.since)
+        self.assertEqual(
+                [('1', ['prop2'])],
+                [(i.guid, props) for i, props in directory.diff([[3, 3]])])
+
+        directory.compact()
+        self.assertEqual(
+                [('2', ['guid', 'prop1', 'prop2']), ('1', ['guid', 'prop1', 'prop2'])],
+                [(i.guid, sorted(props)) for i, props in directory.diff([[1, None]])])
+        self.assertEqual(
+                [('1', ['guid'])],
+                [(i.guid, props) for i, props in directory.diff([[1, 1]])])
+
+    def test_diff_SeqnoIndexNotSynced(self):
+
+        class Document(db.Resource):
+
+            @db.stored_property()
+            def prop(self, value):
+                return value
+
+        seqno = _SessionSeqno()
+        directory = Directory(tests.tmpdir, Document, IndexWriter, seqno, this.broadcast)
+        directory.create({'guid': '1', 'prop': 'a'})
+        directory.update('1', {'prop': 'b'})
+        self.assertEqual(
+                [('1', ['prop'])],
+                [(i.guid, props) for i, props in directory.diff([[2, None]])])
+        directory.close()
+        # Crash before syncing the seqno index
+        self.touch(('db/document/seqnos.state', json.dumps({
+            'since': 1, 'sorted': 0, 'synced': False,
+            })))
+
+        directory = Directory(tests.tmpdir, Document, IndexWriter, seqno, this.broadcast)
+        self.assertEqual(3, directory._seqnos.since)
+        self.assertEqual(
+                [('1', None)],
+                [(i.guid, props) for i, props in directory.diff([[2, None]])])
+
     def test_CommitLastSeqno(self):
 
         class Document(db.Resource):
@@ -675,6 +917,113 @@ class ResourceTest(tests.Test):
         self.assertEqual('probe', Document(guid, None, {'prop': 'probe'}).get('prop'))
         self.assertEqual('probe', Document(guid, None, None, {'prop': 'probe'}).get('prop'))
 
+    def test_rebuild(self):
+
+        class Document(db.Resource):
+
+            @db.indexed_property(slot=1)
+            def prop(self, value):
+                return value
+
+        directory = Directory(tests.tmpdir, Document, IndexWriter, _SessionSeqno(), this.broadcast)
+        guids = [directory.create({'prop': str(i)}) for i in range(10)]
+        directory.commit()
+
+        shutil.rmtree('index/document')
+        directory.rebuild(3)
+
+        self.assertEqual(
+                sorted(guids),
+                sorted([i.guid for i in directory.find()[0]]))
+        self.assertEqual(
+                [str(i) for i in range(10)],
+                [i['prop'] for i in directory.find(order_by='prop')[0]])
+        assert directory.has_seqno
+        assert not exists('index/document.rebuild')
+
+        directory.close()
+        directory = Directory(tests.tmpdir, Document, IndexWriter, _SessionSeqno(), this.broadcast)
+        self.assertEqual(10, directory.find()[1])
+
+    def test_find_StoredInIndex(self):
+
+        class Document(db.Resource):
+
+            @db.indexed_property(slot=1, stored_in_index=True)
+            def prop1(self, value):
+                return value
+
+            @db.stored_property()
+            def prop2(self, value):
+                return value
+
+        directory = Directory(tests.tmpdir, Document, IndexWriter, _SessionSeqno(), this.broadcast)
+        guid = directory.create({'prop1': '1', 'prop2': '2'})
+
+        os.unlink('db/document/%s/%s/prop1' % (guid[:2], guid))
+        os.unlink('db/document/%s/%s/prop2' % (guid[:2], guid))
+        self.assertEqual(
+                [('1', None)],
+                [(i['prop1'], i['prop2']) for i in directory.find()[0]])
+
+        directory.update(guid, {'prop1': '3'})
+        self.assertEqual(
+                [('3', None)],
+                [(i['prop1'], i['prop2']) for i in directory.find()[0]])
+
+    def test_DocumentCache(self):
+
+        class Document(db.Resource):
+
+            @db.indexed_property(slot=1)
+            def prop(self, value):
+                return value
+
+        db.document_cache_size.value = 1024 * 1024
+        directory = Directory(tests.tmpdir, Document, IndexWriter, _SessionSeqno(), this.broadcast)
+
+        guid = directory.create({'prop': '1'})
+        hits = directory.cache.hits
+        self.assertEqual('1', directory[guid]['prop'])
+        self.assertEqual('1', directory[guid]['prop'])
+        assert directory.cache.hits > hits
+
+        directory.update(guid, {'prop': '2'})
+        self.assertEqual('2', directory[guid]['prop'])
+        self.assertEqual(['2'], [i['prop'] for i in directory.find()[0]])
+
+        directory.patch(guid, {'prop': {'mtime': time.time() + 1, 'value': '3'}})
+        self.assertEqual('3', directory[guid]['prop'])
+
+        directory[guid].meta('prop')['value'] = 'changed'
+        self.assertEqual('3', directory[guid].meta('prop')['value'])
+
+        with file(directory[guid].record.path('prop'), 'w') as f:
+            json.dump({'value': '4'}, f)
+        self.assertEqual('4', directory[guid].meta('prop')['value'])
+
+        directory.delete(guid)
+        assert not directory[guid].exists
+        self.assertEqual(None, directory[guid].meta('prop'))
+
+    def test_DocumentCacheLimit(self):
+
+        class Document(db.Resource):
+
+            @db.stored_property()
+            def prop(self, value):
+                return value
+
+        db.document_cache_size.value = 1024
+        directory = Directory(tests.tmpdir, Document, IndexWriter, _SessionSeqno(), this.broadcast)
+
+        for i in range(10):
+            directory.create({'prop': 'x' * 100})
+        for doc in directory:
+            doc['prop']
+        assert directory.cache.size <= 1024
+        assert len(directory.cache) > 0
+
 
 class _SessionSeqno(object):
 
@@ -12,8 +12,9 @@ from os.path import exists
 from __init__ import tests
 
 from sugar_network.db.metadata import Property
-from sugar_network.db.storage import Storage
-from sugar_network.toolkit import BUFFER_SIZE
+from sugar_network.db import storage as storage_
+from sugar_network.db.storage import Storage, PackedStorage
+from sugar_network.toolkit import BUFFER_SIZE, coroutine
 
 
 class StorageTest(tests.Test):
@@ -123,5 +124,257 @@ class StorageTest(tests.Test):
                 sorted([i for i in storage.walk(0)]))
 
 
+class WriteAheadLogTest(tests.Test):
+
+    def setUp(self):
+        tests.Test.setUp(self)
+        storage_.storage_wal.value = True
+
+    def test_Record_get_set(self):
+        storage = Storage(tests.tmpdir)
+        record = storage.get('guid')
+
+        record.set('guid', value='guid', mtime=1)
+        record.set('prop', value='value', mtime=2)
+        assert record.exists
+        assert record.consistent
+        assert not exists('gu/guid')
+        self.assertEqual({'value': 'value', 'mtime': 2}, record.get('prop'))
+
+        record.unset('prop')
+        self.assertEqual(None, record.get('prop'))
+        storage.sync()
+        self.assertEqual(3, len(file('wal').readlines()))
+
+        storage.close()
+        self.assertEqual('', file('wal').read())
+        assert exists('gu/guid/guid')
+        assert not exists('gu/guid/prop')
+        self.assertEqual(1, os.stat('gu/guid/guid').st_mtime)
+
+    def test_GroupCommit(self):
+        fsyncs = []
+        self.override(os, 'fsync', lambda fd: fsyncs.append(fd))
+        storage = Storage(tests.tmpdir)
+
+        def write(guid):
+            storage.get(guid).set('prop', value=guid)
+            storage.sync()
+
+        jobs = [coroutine.spawn(write, str(i)) for i in range(5)]
+        for job in jobs:
+            job.join()
+        self.assertEqual(1, len(fsyncs))
+        self.assertEqual(5, len(file('wal').readlines()))
+
+    def test_Replay(self):
+        storage = Storage(tests.tmpdir)
+        storage.get('1').set('guid', value='1')
+        storage.get('2').set('guid', value='2')
+        storage.get('2').set('prop', value='2')
+        storage.sync()
+        storage.delete('1')
+        with file('wal', 'a') as f:
+            f.write('["set", "3", "guid", ')
+
+        storage = Storage(tests.tmpdir)
+        self.assertEqual('', file('wal').read())
+        assert not exists('1/1')
+        self.assertEqual('2', json.load(file('2/2/prop'))['value'])
+        self.assertEqual(['2'], [i for i in storage.walk(0)])
+
+    def test_walk(self):
+        storage = Storage(tests.tmpdir)
+        storage.get('1').set('guid', value='1', mtime=1)
+        storage.close()
+
+        storage = Storage(tests.tmpdir)
+        storage.get('2').set('guid', value='2', mtime=2)
+        storage.get('1').set('prop', value='1', mtime=3)
+        self.assertEqual(['1', '2'], sorted([i for i in storage.walk(0)]))
+        self.assertEqual(['2'], sorted([i for i in storage.walk(1)]))
+
+        storage.get('1').invalidate()
+        self.assertEqual(['2'], sorted([i for i in storage.walk(0)]))
+
+
+class PackedStorageTest(tests.Test):
+
+    def test_Record_get_set(self):
+        storage = PackedStorage('db')
+
+        self.assertEqual(None, storage.get('guid').get('prop'))
+        storage.get('guid').set('prop', value='value', foo='bar', mtime=1)
+        self.assertEqual({
+            'value': 'value',
+            'foo': 'bar',
+            'mtime': 1,
+            },
+            storage.get('guid').get('prop'))
+
+        record = storage.get('guid')
+        record.get('prop')['value'] = 'changed'
+        self.assertEqual('value', record.get('prop')['value'])
+
+        storage.get('guid').set('prop', value='value2')
+        self.assertEqual('value2', record.get('prop')['value'])
+        assert record.get('prop')['mtime'] > 1
+
+    def test_Record_consistent(self):
+        storage = PackedStorage('db')
+        record = storage.get('guid')
+
+        self.assertEqual(False, record.exists)
+        self.assertEqual(False, record.consistent)
+
+        record.set('prop', value='value')
+        self.assertEqual(True, record.exists)
+        self.assertEqual(False, record.consistent)
+
+        record.set('guid', value='value')
+        self.assertEqual(True, record.consistent)
+
+        record.invalidate()
+        self.assertEqual(False, record.consistent)
+        self.assertEqual('value', record.get('prop')['value'])
+
+    def test_delete(self):
+        storage = PackedStorage('db')
+
+        storage.delete('absent')
+        storage.get('guid').set('guid', value='guid')
+        assert storage.get('guid').exists
+        storage.delete('guid')
+        assert not storage.get('guid').exists
+        storage.close()
+
+        storage = PackedStorage('db')
+        assert not storage.get('guid').exists
+
+    def test_walk(self):
+        storage = PackedStorage('db')
+
+        storage.get('guid1').set('guid', value=1, mtime=1)
+        storage.get('guid2').set('guid', value=2, mtime=2)
+        storage.get('guid3').set('guid', value=3, mtime=3)
+        storage.get('guid4').set('prop', value=4, mtime=4)
+
+        self.assertEqual(
+                sorted(['guid1', 'guid2', 'guid3']),
+                sorted([i for i in storage.walk(0)]))
+        self.assertEqual(
+                sorted(['guid2', 'guid3']),
+                sorted([i for i in storage.walk(1)]))
+        self.assertEqual(
+                sorted([]),
+                sorted([i for i in storage.walk(3)]))
+
+    def test_Reopen(self):
+        storage = PackedStorage('db')
+        storage.get('guid1').set('guid', value=1, mtime=1)
+        storage.get('guid1').set('prop', value=1, mtime=1)
+        storage.close()
+
+        storage = PackedStorage('db')
+        storage.get('guid1').set('prop', value=2, mtime=2)
+        storage.get('guid2').set('guid', value=2, mtime=2)
+        # Do not close the storage to not save the index
+        storage._writer.close()
+
+        storage = PackedStorage('db')
+        self.assertEqual(
+                sorted(['guid1', 'guid2']),
+                sorted([i for i in storage.walk(0)]))
+        self.assertEqual(
+                {'value': 2, 'mtime': 2},
+                storage.get('guid1').get('prop'))
+
+    def test_reopen(self):
+        storage = PackedStorage('db')
+        storage.get('guid1').set('guid', value=1, mtime=1)
+        reader = storage._reader
+
+        storage.reopen()
+        assert reader.closed
+        assert storage._reader is not reader
+        self.assertEqual(
+                {'value': 1, 'mtime': 1},
+                storage.get('guid1').get('guid'))
+
+    def test_TruncateBrokenTail(self):
+        storage = PackedStorage('db')
+        storage.get('guid1').set('guid', value=1, mtime=1)
+        storage.close()
+        size = os.stat('db/records').st_size
+        with file('db/records', 'ab') as f:
+            f.write('guid2 100 1\n{"gu')
+
+        storage = PackedStorage('db')
+        self.assertEqual(['guid1'], [i for i in storage.walk(0)])
+        self.assertEqual(size, os.stat('db/records').st_size)
+
+    def test_compact(self):
+        storage = PackedStorage('db')
+        for i in range(10):
+            storage.get('guid').set('prop', value=i, mtime=i + 1)
+        storage.get('guid').set('guid', value='guid', mtime=1)
+        storage.get('guid2').set('guid', value='guid2', mtime=1)
+        storage.delete('guid2')
+        size = os.stat('db/records').st_size
+
+        storage.compact()
+        assert os.stat('db/records').st_size < size
+        self.assertEqual(
+                {'value': 9, 'mtime': 10},
+                storage.get('guid').get('prop'))
+        self.assertEqual(['guid'], [i for i in storage.walk(0)])
+        storage.close()
+
+        storage = PackedStorage('db')
+        self.assertEqual(
+                {'value': 9, 'mtime': 10},
+                storage.get('guid').get('prop'))
+
+    def test_compact_IgnoreStaleIndex(self):
+        save_index = PackedStorage._save_index.im_func
+        storage = PackedStorage('db')
+        for i in range(10):
+            storage.get('guid').set('prop', value=i, mtime=i + 1)
+        storage.get('guid').set('guid', value='guid', mtime=1)
+        storage.close()
+        self.override(PackedStorage, '_save_index', lambda self: None)
+        storage = PackedStorage('db')
+        storage.compact()
+        for i in range(10):
+            storage.get('guid2').set('guid', value=i, mtime=i + 1)
+        storage._writer.close()
+
+        self.override(PackedStorage, '_save_index', save_index)
+        storage = PackedStorage('db')
+        self.assertEqual(
+                sorted(['guid', 'guid2']),
+                sorted([i for i in storage.walk(0)]))
+        self.assertEqual(
+                {'value': 9, 'mtime': 10},
+                storage.get('guid').get('prop'))
+
+    def test_MigrateFromFiles(self):
+        files = Storage('db')
+        files.get('guid1').set('guid', value='guid1', mtime=1)
+        files.get('guid1').set('prop', value='1', seqno=1, mtime=2)
+        files.get('guid2').set('prop', value='2', mtime=3)
+
+        storage = PackedStorage('db')
+        assert not exists('db/gu')
+        self.assertEqual(['guid1'], [i for i in storage.walk(0)])
+        self.assertEqual(
+                {'value': '1', 'seqno': 1, 'mtime': 2},
+                storage.get('guid1').get('prop'))
+        assert not storage.get('guid2').consistent
+        self.assertEqual(
+                {'value': '2', 'mtime': 3},
+                storage.get('guid2').get('prop'))
+
+
 if __name__ == '__main__':
     tests.main()
@@ -134,6 +134,48 @@ class MasterTest(tests.Test):
             ], header={'to': '127.0.0.1:7777', 'from': 'slave'}))
         conn.request('POST', [], patch, params={'cmd': 'push'})
 
+    def test_push_CompressLevel(self):
+
+        class Document(db.Resource):
+            pass
+
+        volume = self.start_master([Document])
+        conn = Connection()
+
+        levels = []
+        deflate = packets._deflate
+
+        def _deflate(data, compresslevel):
+            levels.append(compresslevel)
+            return deflate(data, compresslevel)
+
+        self.override(packets, '_deflate', _deflate)
+
+        patch = ''.join(packets.encode([
+            ('push', None, [
+                {'resource': 'document'},
+                {'guid': '1', 'patch': {
+                    'guid': {'value': '1', 'mtime': 1},
+                    'ctime': {'value': 1, 'mtime': 1},
+                    'mtime': {'value': 1, 'mtime': 1},
+                    }},
+                {'commit': [[1, 1]]},
+                ]),
+            ], header={'to': self.node_routes.guid, 'from': 'slave', 'compresslevel': 1}))
+        self.assertEqual([packets.DEFAULT_COMPRESSLEVEL], levels)
+        del levels[:]
+
+        response = conn.request('POST', [], patch, params={'cmd': 'push'})
+        reply = iter(packets.decode(response.raw))
+        self.assertEqual('ack', next(reply).name)
+        self.assertRaises(StopIteration, next, reply)
+        self.assertEqual([1], levels)
+
+        patch = ''.join(packets.encode([
+            ('push', None, []),
+            ], header={'to': self.node_routes.guid, 'from': 'slave', 'compresslevel': 10}))
+        self.assertRaises(http.BadRequest, conn.request, 'POST', [], patch, params={'cmd': 'push'})
+
     def test_push_WithCookies(self):
 
         class Document(db.Resource):
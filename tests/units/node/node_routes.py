@@ -313,6 +313,55 @@ class NodeRoutesTest(tests.Test):
         self.node_routes.find_limit = 1
         self.assertEqual(1, len(this.call(method='GET', path=['context'], limit=1024)['result']))
 
+    def test_find_Cache(self):
+        volume = self.start_master()
+        self.node_routes._find_cache.limit = 1024 * 1024
+        volume['user'].create({'guid': tests.UID, 'name': 'user', 'pubkey': tests.PUBKEY})
+
+        guid1 = this.call(method='POST', path=['context'], environ=auth_env(tests.UID), content={
+            'type': 'activity',
+            'title': 'title1',
+            'summary': 'summary',
+            'description': 'description',
+            })
+
+        self.assertEqual([{'guid': guid1}], this.call(method='GET', path=['context'])['result'])
+        self.assertEqual([{'guid': guid1}], this.call(method='GET', path=['context'])['result'])
+        self.assertEqual([{'guid': guid1, 'title': 'title1'}], this.call(method='GET', path=['context'], reply=['guid', 'title'])['result'])
+        self.assertEqual([{'guid': guid1}], this.call(method='GET', path=['context'], environ=auth_env(tests.UID))['result'])
+        status = this.call(method='GET', cmd='status')['find_cache']
+        self.assertEqual(1, status['hits'])
+        self.assertEqual(2, status['misses'])
+        self.assertEqual(2, status['entries'])
+        assert 'hits' in this.call(method='GET', cmd='status')['document_cache']['context']
+
+        guid2 = this.call(method='POST', path=['context'], environ=auth_env(tests.UID), content={
+            'type': 'activity',
+            'title': 'title2',
+            'summary': 'summary',
+            'description': 'description',
+            })
+        self.assertEqual(
+                sorted([{'guid': guid1}, {'guid': guid2}]),
+                sorted(this.call(method='GET', path=['context'])['result']))
+        self.assertEqual(3, len(self.node_routes._find_cache))
+
+        volume['context'].commit()
+        self.assertEqual(0, len(self.node_routes._find_cache))
+
+        def authors():
+            reply = this.call(method='GET', path=['context'], reply=['author'])
+            return [i['author'][tests.UID]['name'] for i in reply['result']]
+
+        this.call(method='GET', path=['context'])
+        self.assertEqual(['user', 'user'], authors())
+        self.assertEqual(2, len(self.node_routes._find_cache))
+
+        volume['user'].update(tests.UID, {'name': 'user2'})
+        volume['user'].commit()
+        self.assertEqual(1, len(self.node_routes._find_cache))
+        self.assertEqual(['user2', 'user2'], authors())
+
     def test_DeletedDocuments(self):
         volume = self.start_master()
         volume['user'].create({'guid': tests.UID, 'name': 'user', 'pubkey': tests.PUBKEY})
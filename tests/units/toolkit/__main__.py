@@ -18,6 +18,7 @@ from ranges import *
 from packagekit import *
 from rrd import *
 from inotify import *
+from jsonlib import *
 
 if __name__ == '__main__':
     tests.main()
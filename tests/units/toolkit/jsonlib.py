@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+# sugar-lint: disable
+
+import json
+
+from __init__ import tests
+
+from sugar_network.toolkit import jsonlib
+
+
+class JsonlibTest(tests.Test):
+
+    def tearDown(self):
+        jsonlib.use()
+        tests.Test.tearDown(self)
+
+    def test_use(self):
+        value = {'guid': u'\u0444', 'list': [1, 0.1, None, True], 'str': 'a"\\\n'}
+
+        jsonlib.use('json')
+        self.assertEqual('json', jsonlib.encoder)
+        self.assertEqual('json', jsonlib.decoder)
+        self.assertEqual(json.dumps(value), jsonlib.dumps(value))
+        self.assertEqual(value, jsonlib.loads(jsonlib.dumps(value)))
+
+        jsonlib.use('fake')
+        self.assertEqual('json', jsonlib.encoder)
+        self.assertEqual('json', jsonlib.decoder)
+
+        jsonlib.use()
+        self.assertEqual(json.dumps(value), jsonlib.dumps(value))
+        self.assertEqual(repr(json.loads(json.dumps(value))), repr(jsonlib.loads(json.dumps(value))))
+
+    def test_dump(self):
+        with file('file', 'w') as f:
+            jsonlib.dump({'probe': [1, 2]}, f)
+        self.assertEqual('{"probe": [1, 2]}', file('file').read())
+        with file('file') as f:
+            self.assertEqual({'probe': [1, 2]}, jsonlib.load(f))
+
+
+if __name__ == '__main__':
+    tests.main()
@@ -289,6 +289,28 @@ class PacketsTest(tests.Test):
         self.assertRaises(StopIteration, packets_iter.next)
         self.assertEqual(len(stream.getvalue()), stream.tell())
 
+    def test_decode_LargeRecordsAndBlobs(self):
+        record = {'payload': 'x' * toolkit.BUFFER_SIZE * 3}
+        blob = 'b' * (toolkit.BUFFER_SIZE * 5 + 1)
+        data = \
+            json.dumps({}) + '\n' + \
+            json.dumps({'segment': 1}) + '\n' + \
+            json.dumps(record) + '\n' + \
+            json.dumps({'num': 1, 'content-length': len(blob)}) + '\n' + \
+            blob + '\n' + \
+            json.dumps(record) + '\n'
+
+        for stream in (zips(data), StringIO(data)):
+            packets_iter = iter(packets.decode(stream))
+            with next(packets_iter) as packet:
+                self.assertEqual([
+                    record,
+                    (1, hashlib.sha1(blob).hexdigest(), blob),
+                    record,
+                    ],
+                    [(i.meta['num'], i.digest, file(i.path).read()) if isinstance(i, File) else i for i in packet])
+            self.assertRaises(StopIteration, packets_iter.next)
+
     def test_decode_EmptyBlobs(self):
         stream = zips(
             json.dumps({}) + '\n' +
@@ -615,6 +637,31 @@ class PacketsTest(tests.Test):
                 'ccc' + '\n',
                 unzips(stream))
 
+    def test_encode_IncompressibleBlobs(self):
+        png = os.urandom(packets._ZIP_CHUNK_SIZE + 1)
+        self.touch(('png', png))
+        self.touch(('txt', '.' * len(png)))
+
+        stream = ''.join([i for i in packets.encode([
+            (1, None, [
+                File('png', 'digest', [('num', 1), ('content-type', 'image/png')]),
+                File('txt', 'digest', [('num', 2), ('content-type', 'text/plain')]),
+                File('png', 'digest', [('num', 3)]),
+                ]),
+            ])])
+
+        self.assertEqual(
+                json.dumps({}) + '\n' +
+                json.dumps({'segment': 1}) + '\n' +
+                json.dumps({'num': 1, 'content-type': 'image/png'}) + '\n' +
+                png + '\n' +
+                json.dumps({'num': 2, 'content-type': 'text/plain'}) + '\n' +
+                '.' * len(png) + '\n' +
+                json.dumps({'num': 3}) + '\n' +
+                png + '\n',
+                unzips(stream))
+        assert len(stream) < len(png) * 2.1
+
     def test_encode_BlobUrls(self):
 
         class Routes(object):
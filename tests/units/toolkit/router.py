@@ -11,7 +11,7 @@ from cStringIO import StringIO
 from __init__ import tests, src_root
 
 from sugar_network import db, client, toolkit
-from sugar_network.toolkit.router import Router, Request, _parse_accept_language, route, fallbackroute, preroute, postroute, File
+from sugar_network.toolkit.router import Router, Request, _parse_accept_language, route, fallbackroute, preroute, postroute, File, RawJson
 from sugar_network.toolkit.coroutine import this
 from sugar_network.toolkit import http, coroutine
 
@@ -1326,6 +1326,7 @@ class RouterTest(tests.Test):
         self.assertEqual([
             '200 OK',
             {
+                'accept-ranges': 'bytes',
                 'content-length': str(len(result)),
                 'content-disposition': 'attachment; filename="foo.bar"',
                 'content-type': 'application/octet-stream',
@@ -1333,6 +1334,222 @@ class RouterTest(tests.Test):
             ],
             response)
 
+    def test_FilesRanges(self):
+        self.touch(('blob.data', '0123456789'))
+
+        class CommandsProcessor(object):
+
+            @route('GET', [])
+            def probe(self, request):
+                return File('blob.data')
+
+            @route('HEAD', [])
+            def probe_meta(self, request):
+                return File('blob.data')
+
+        router = Router(CommandsProcessor())
+
+        def call(value, method='GET', **environ):
+            response = []
+            environ.update({
+                'PATH_INFO': '/',
+                'REQUEST_METHOD': method,
+                'HTTP_RANGE': value,
+                })
+            reply = router(environ,
+                lambda status, headers: response.extend([status, dict(headers)]))
+            return ''.join([i for i in reply]), response
+
+        self.assertEqual(
+                ('2345', ['206 Partial Content', {
+                    'accept-ranges': 'bytes',
+                    'content-length': '4',
+                    'content-range': 'bytes 2-5/10',
+                    'content-type': 'application/octet-stream',
+                    }]),
+                call('bytes=2-5'))
+        self.assertEqual(
+                ('789', ['206 Partial Content', {
+                    'accept-ranges': 'bytes',
+                    'content-length': '3',
+                    'content-range': 'bytes 7-9/10',
+                    'content-type': 'application/octet-stream',
+                    }]),
+                call('bytes=7-'))
+        self.assertEqual(
+                ('89', ['206 Partial Content', {
+                    'accept-ranges': 'bytes',
+                    'content-length': '2',
+                    'content-range': 'bytes 8-9/10',
+                    'content-type': 'application/octet-stream',
+                    }]),
+                call('bytes=-2'))
+        self.assertEqual(
+                ('56789', ['206 Partial Content', {
+                    'accept-ranges': 'bytes',
+                    'content-length': '5',
+                    'content-range': 'bytes 5-9/10',
+                    'content-type': 'application/octet-stream',
+                    }]),
+                call('bytes=5-100'))
+        self.assertEqual(
+                ('0123456789', ['200 OK', {
+                    'accept-ranges': 'bytes',
+                    'content-length': '10',
+                    'content-type': 'application/octet-stream',
+                    }]),
+                call('bytes=1-2,4-5'))
+
+        reply, response = call('bytes=10-')
+        self.assertEqual('416 Requested Range Not Satisfiable', response[0])
+        self.assertEqual('bytes */10', response[1]['content-range'])
+
+        self.assertEqual(
+                ('', ['206 Partial Content', {
+                    'accept-ranges': 'bytes',
+                    'content-length': '4',
+                    'content-range': 'bytes 2-5/10',
+                    'content-type': 'application/octet-stream',
+                    }]),
+                call('bytes=2-5', method='HEAD'))
+
+        mtime = int(os.stat('blob.data').st_mtime)
+        self.assertEqual('206 Partial Content',
+                call('bytes=2-5', HTTP_IF_RANGE=formatdate(mtime, usegmt=True))[1][0])
+        self.assertEqual('200 OK',
+                call('bytes=2-5', HTTP_IF_RANGE=formatdate(mtime - 1, usegmt=True))[1][0])
+        self.assertEqual('200 OK',
+                call('bytes=2-5', HTTP_IF_RANGE='"etag"')[1][0])
+
+    def test_FilesWrapper(self):
+        self.touch(('blob.data', 'value'))
+
+        class CommandsProcessor(object):
+
+            @route('GET', [])
+            def probe(self, request):
+                return File('blob.data')
+
+        class FileWrapper(object):
+
+            def __init__(self, f, size):
+                wrapped.append((f.name, size))
+                self.f = f
+
+            def __iter__(self):
+                return iter([self.f.read()])
+
+        router = Router(CommandsProcessor())
+        wrapped = []
+
+        response = []
+        reply = router({
+            'PATH_INFO': '/',
+            'REQUEST_METHOD': 'GET',
+            'wsgi.file_wrapper': FileWrapper,
+            },
+            lambda status, headers: response.extend([status, dict(headers)]))
+        self.assertEqual('value', ''.join([i for i in reply]))
+        self.assertEqual([('blob.data', toolkit.BUFFER_SIZE)], wrapped)
+        self.assertEqual([
+            '200 OK',
+            {
+                'accept-ranges': 'bytes',
+                'content-length': '5',
+                'content-type': 'application/octet-stream',
+                }
+            ],
+            response)
+
+        del wrapped[:]
+        response = []
+        reply = router({
+            'PATH_INFO': '/',
+            'REQUEST_METHOD': 'GET',
+            'HTTP_RANGE': 'bytes=1-2',
+            'wsgi.file_wrapper': FileWrapper,
+            },
+            lambda status, headers: response.extend([status, dict(headers)]))
+        self.assertEqual('al', ''.join([i for i in reply]))
+        self.assertEqual([], wrapped)
+
+    def test_RawJson(self):
+
+        class CommandsProcessor(object):
+
+            @route('GET', [], mime_type='application/json')
+            def get(self):
+                return RawJson('{"probe": [1, 2]}')
+
+        router = Router(CommandsProcessor())
+
+        response = []
+        reply = router({
+            'PATH_INFO': '/',
+            'REQUEST_METHOD': 'GET',
+            },
+            lambda status, headers: response.extend([status, dict(headers)]))
+        self.assertEqual('{"probe": [1, 2]}', ''.join([i for i in reply]))
+        self.assertEqual('200 OK', response[0])
+        self.assertEqual('17', response[1]['content-length'])
+
+        self.assertEqual({'probe': [1, 2]}, router.call(method='GET', path=[]))
+
+    def test_StreamLargeJson(self):
+        result = {
+            'total': 10000,
+            'result': [{'guid': str(i), 'title': 'title'} for i in range(10000)],
+            }
+
+        class CommandsProcessor(object):
+
+            @route('GET', [], mime_type='application/json')
+            def large(self):
+                return result
+
+            @route('GET', ['small'], mime_type='application/json')
+            def small(self):
+                return {'total': 1, 'result': [{'guid': '1'}]}
+
+        router = Router(CommandsProcessor())
+
+        response = []
+        reply = router({
+            'PATH_INFO': '/',
+            'REQUEST_METHOD': 'GET',
+            },
+            lambda status, headers: response.extend([status, dict(headers)]))
+        chunks = [i for i in reply]
+        self.assertEqual(json.dumps(result), ''.join(chunks))
+        assert len(chunks) > 1
+        self.assertEqual([
+            '200 OK',
+            {'content-type': 'application/json'},
+            ],
+            response)
+
+        response = []
+        reply = router({
+            'PATH_INFO': '/',
+            'QUERY_STRING': 'callback=foo',
+            'REQUEST_METHOD': 'GET',
+            },
+            lambda status, headers: response.extend([status, dict(headers)]))
+        self.assertEqual('foo(%s);' % json.dumps(result), ''.join([i for i in reply]))
+
+        response = []
+        reply = router({
+            'PATH_INFO': '/small',
+            'REQUEST_METHOD': 'GET',
+            },
+            lambda status, headers: response.extend([status, dict(headers)]))
+        self.assertEqual(['{"total": 1, "result": [{"guid": "1"}]}'], [i for i in reply])
+        self.assertEqual([
+            '200 OK',
+            {'content-length': '39', 'content-type': 'application/json'},
+            ],
+            response)
+
     def test_DoNotOverrideContentLengthForHEAD(self):
 
         class CommandsProcessor(object):